@@ -0,0 +1,79 @@
+"""
+Render the augmented AugMax/AugMix branches of the training set offline.
+For every utterance of the train csv, num_store_variants augmented variants
+are written to the memory-mapped shards of hparams.augmentation_store, which
+AugMaxAttack and AugMixModule then sample from instead of augmenting every
+batch during training.
+
+Example:
+
+`python precompute_augmentations.py train_configs/seq2seq_augmax.yaml\
+     --root=/path/to/data/and/results/folder\
+     --augmentation_store=/path/to/store\
+     --device=cuda:0`
+"""
+
+import logging
+import sys
+
+import speechbrain as sb
+import torch
+from hyperpyyaml import load_hyperpyyaml
+from tqdm import tqdm
+
+from robust_speech.adversarial.attacks.augmentation_engine import AugmentationEngine
+from robust_speech.adversarial.attacks.augmentation_store import (
+    AugmentationStoreWriter,
+)
+
+logger = logging.getLogger(__name__)
+
+if __name__ == "__main__":
+
+    # CLI:
+    hparams_file, run_opts, overrides = sb.parse_arguments(sys.argv[1:])
+
+    with open(hparams_file) as fin:
+        hparams = load_hyperpyyaml(fin, overrides)
+
+    if not hparams.get("augmentation_store"):
+        raise ValueError("augmentation_store must be set to the output folder")
+
+    # same utterances as the training set of dataio_prepare
+    train_data = sb.dataio.dataset.DynamicItemDataset.from_csv(
+        csv_path=hparams["train_csv"],
+        replacements={"data_root": hparams["data_folder"]},
+    )
+    train_data = train_data.filtered_sorted(
+        key_max_value={"duration": hparams["avoid_if_longer_than"]}
+    )
+
+    @sb.utils.data_pipeline.takes("wav")
+    @sb.utils.data_pipeline.provides("sig")
+    def audio_pipeline(wav):
+        sig = sb.dataio.dataio.read_audio(wav)
+        return sig
+
+    sb.dataio.dataset.add_dynamic_item([train_data], audio_pipeline)
+    sb.dataio.dataset.set_output_keys([train_data], ["id", "sig"])
+
+    # same chains as the online engines of AugMaxAttack and AugMixModule
+    engine = AugmentationEngine(
+        mixture_depth=hparams.get("mixture_depth", -1),
+        aug_severity=hparams.get("aug_severity", 3),
+        sample_rate=hparams["sample_rate"],
+        fuse_filters=hparams.get("fuse_filters", False),
+    )
+    device = run_opts.get("device", "cpu")
+    with AugmentationStoreWriter(
+        hparams["augmentation_store"],
+        hparams["num_store_variants"],
+        sample_rate=hparams["sample_rate"],
+    ) as writer:
+        for example in tqdm(train_data, dynamic_ncols=True):
+            wav = example["sig"].to(device)
+            writer.add(example["id"], engine.render(wav, writer.num_variants))
+    logger.info(
+        "Stored %d variants of %d utterances in %s"
+        % (writer.num_variants, len(writer.utterances), hparams["augmentation_store"])
+    )
@@ -22,6 +22,10 @@ class Attacker:
         if the attack is targeted.
     """
 
+    # whether the batches being attacked are training batches (set by the
+    # brain). State kept across epochs for each utterance is only used then.
+    training = False
+
     def on_evaluation_start(self, save_audio_path=None, sample_rate=16000):
         """
         Method to run at the beginning of an evaluation phase with adverersarial attacks.
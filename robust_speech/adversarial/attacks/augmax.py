@@ -1,89 +1,96 @@
 import os, sys, argparse, inspect
+import logging
 from cv2 import transform
 import numpy as np
 import torch
 import torch.nn as nn
-from torch_audiomentations import Compose
+import torchaudio
 from copy import deepcopy
 
 import robust_speech as rs
 from robust_speech.adversarial.attacks.attacker import Attacker
 from robust_speech.adversarial.utils import (
+    AttackGradScaler,
+    attack_autocast,
     l2_clamp_or_normalize,
     linf_clamp,
     rand_assign,
+    repeat_batch,
 )
 
-from robust_speech.adversarial.attacks.augmentations import augmentations
+from robust_speech.adversarial.attacks.augmentation_engine import AugmentationEngine
+from robust_speech.adversarial.attacks.packed_branches import PackedBranches, packed_mix
+from robust_speech.adversarial.attacks.warm_start import WarmStartCache
 
+logger = logging.getLogger(__name__)
 
 # data:
 def aug_one(x, mixture_depth, aug_severity):
     """Perform K random augmentation operations on the original speech signal xori
     Args:
         speech: orignal input speech
-        preprocess: a function that can convert the speech signoal into tensor, for input into NN
         mixture_depth: x_augi is generated by randomly selecting K augmentation methods
         aug_severity: level of augmentation operation
     Returns:
-        torch tensor of augmented speech (x_augi)
+        torch tensor of augmented speech (x_augi), on the device of x
     """
-    aug_list = augmentations
-
-    device = x.device.type
-    with torch.no_grad():
-        x_aug = x.unsqueeze(1).clone().to('cpu') # mono channel
-        depth = mixture_depth if mixture_depth > 0 else np.random.randint(1, 3)
-        transforms = []
-        for _ in range(depth):
-            op = np.random.choice(aug_list)
-            transforms.append(op(aug_severity))
-        aug = Compose(
-            transforms=transforms
-        )
-        # import pdb; pdb.set_trace()
-        x_aug = aug(x_aug, sample_rate=16000)
-        x_aug = x_aug.squeeze(1).to(device)
-    return x_aug
-
-# def aug_one(x, mixture_depth, aug_severity):
-#     return x
+    engine = AugmentationEngine(
+        mixture_depth=mixture_depth, aug_severity=aug_severity
+    )
+    return engine.aug_one(x)
 
 def aug_all(x, mixture_width=3, mixture_depth=-1, aug_severity=3):
     #input speech signal x (x_ori)
-    #output: xs: [xori, xaug1, xaug2, ...]
+    #output: xs: [xori, xaug1, xaug2, ...] stacked in a (mixture_width + 1, N, T) tensor
     # x.shape = 1, 381760
-    xs = [x]
-    for _ in range(mixture_width):
-        xs.append(
-            aug_one(x, mixture_depth, aug_severity)
-        )
-    return xs
+    engine = AugmentationEngine(
+        mixture_width=mixture_width,
+        mixture_depth=mixture_depth,
+        aug_severity=aug_severity,
+    )
+    return engine.aug_all(x)
+
+def mix_branches(xs, m, w, lengths=None):
+    '''
+    mix the augmented branches with explicit weights
+    Args:
+        xs: xs = [x_ori, x_aug1, x_aug2, x_aug3], list, (W+1, N, T) tensor or PackedBranches
+        m: Tensor. m.size=(N)
+        w: Tensor. w.size()=(N,3)
+        lengths: Tensor. relative lengths (N), the padding of the mix is zeroed if given
+    output:
+        (1-m)xori + m* \sum_i (wi*x_augi)
+    '''
+    if isinstance(xs, PackedBranches):
+        x_mix = packed_mix(xs, m, w)
+    else:
+        if isinstance(xs, (list, tuple)):
+            xs = torch.stack(xs)
+        x_ori = xs[0]
+        N = x_ori.size()[0]
+        x_mix = torch.einsum("nw,wnt->nt", w, xs[1:])
+        m = m.view((N, 1))
+        x_mix = (1 - m) * x_ori + m * x_mix
+    if lengths is not None:
+        T = x_mix.size(1)
+        valid = torch.arange(T, device=x_mix.device) < torch.round(lengths * T).unsqueeze(1)
+        x_mix = x_mix * valid
+    return x_mix
 
-def augmax_combine(xs, m, q, device='cuda'):
+def augmax_combine(xs, m, q, device=None, lengths=None):
     '''
     combine different aug operations to get the final augmentation
     Args:
         xs: xs = [x_ori, x_aug1, x_aug2, x_aug3]
         m: Tensor. m.size=(N)
         q: Tensor. q.size()=(N,3). w = softmax(q)
+        device: unused, the result is on the device of xs
+        lengths: Tensor. relative lengths (N), the padding of the result is zeroed if given
     output:
         final xaug = (1-m)xori + m* \sum_i (wi*x_augi)
     '''
-
-    x_ori = xs[0]
     w = torch.nn.functional.softmax(q, dim=1)  # w.size()=(N,3)
-
-    N = x_ori.size()[0]
-
-    x_mix = torch.zeros_like(x_ori).to(device)
-    for i, x_aug in enumerate(xs[1:]):
-        wi = w[:, i].view((N, 1)).expand_as(x_aug)
-        x_mix += wi * x_aug 
-
-    m = m.view((N, 1)).expand_as(x_ori)
-    x_mix = (1 - m) * x_ori + m * x_mix
-    return x_mix
+    return mix_branches(xs, m, w, lengths)
 
 
 class AugMaxAttack(Attacker):
@@ -114,6 +121,50 @@ class AugMaxAttack(Attacker):
        if the attack is targeted.
     train_mode_for_backward: bool
        whether to force training mode in backward passes (necessary for RNN models)
+    per_example_chains: bool
+       whether each utterance gets its own random augmentation chains
+       (otherwise a chain is shared by all utterances of a branch)
+    fuse_filters: bool
+       whether consecutive filter operations are applied with a single FFT
+       round trip (see fft_filters.py)
+    augmentation_store: Optional[str]
+       folder of precomputed branches (see augmentation_store.py) to sample
+       from instead of computing the branches of every batch
+    branch_dtype: str
+       storage of the augmented branches during the attack: float32, float16,
+       bfloat16 or int16 (with a per-utterance scale). They are upcast to
+       float32 only inside the mix (see packed_branches.py)
+    patience: Optional[int]
+       per-example early stopping (disabled if None). An example has converged
+       once, for patience consecutive iterations, its loss did not improve by
+       more than tol (relative) or its m stayed at a clamp bound. Converged
+       examples are frozen and the loop stops when all have converged.
+    tol: float
+       minimal relative loss improvement for early stopping.
+    restarts: int
+       number of independent branch sets and (m, q) initializations per
+       utterance. They are stacked along the batch dimension (R times the
+       memory of one restart) and, for each utterance, the mixture with the
+       highest loss over restarts and iterations is returned.
+    stft_mixing: bool
+       whether to compute the STFT of each branch once (with
+       asr_brain.compute_stft) and mix the branches in the STFT domain, so
+       that the iterations skip the STFTs of the feature pipeline. The
+       spectra take ~2.5 times the memory of the branches (with the default
+       Fbank settings), and the model must support compute_forward_from_stft.
+    warm_start_cache: Optional[int]
+       size of a per-utterance LRU cache (see warm_start.py) of the last
+       optimized (m, q) of the training utterances and, with
+       per_example_chains, of the augmentation chains of the branches.
+       Cached utterances start from them instead of a random initialization
+       (disabled if None).
+    warm_start_iter: Optional[int]
+       number of iterations for batches whose utterances are all cached
+       (nb_iter if None).
+    mixture_depth: int
+       number of operations of the augmentation chains (1 or 2 at random if -1).
+    aug_severity: int
+       severity of the augmentation operations.
     """
 
     def __init__(
@@ -123,6 +174,18 @@ class AugMaxAttack(Attacker):
         nb_iter=10,
         targeted=False,
         train_mode_for_backward=True,
+        per_example_chains=False,
+        fuse_filters=False,
+        augmentation_store=None,
+        branch_dtype="float32",
+        patience=None,
+        tol=1e-3,
+        restarts=1,
+        stft_mixing=False,
+        warm_start_cache=None,
+        warm_start_iter=None,
+        mixture_depth=-1,
+        aug_severity=3,
     ):
         #original pgd attack parameters
         self.eps = eps
@@ -131,14 +194,98 @@ class AugMaxAttack(Attacker):
         self.asr_brain = asr_brain
         #
         self.train_mode_for_backward = train_mode_for_backward
+        self.patience = patience
+        self.tol = tol
+        self.restarts = restarts
+        self.stft_mixing = stft_mixing
+        self.cache = None if warm_start_cache is None else WarmStartCache(warm_start_cache)
+        self.warm_start_iter = warm_start_iter
+        self.iterations = []  # iterations used by each batch
         #augmax settings
         self.mixture_width = 3
-        self.mixture_depth = -1
-        self.aug_severity = 3
+        self.mixture_depth = mixture_depth
+        self.aug_severity = aug_severity
+        self.branch_dtype = branch_dtype
+        self.engine = AugmentationEngine(
+            self.mixture_width,
+            self.mixture_depth,
+            self.aug_severity,
+            per_example_chains=per_example_chains,
+            fuse_filters=fuse_filters,
+            store=augmentation_store,
+        )
 
         assert isinstance(self.eps, torch.Tensor) or isinstance(self.eps, float)
 
-    def perturb(self, batch):
+    def iteration_stats(self):
+        """Mean, min and max number of iterations used by the batches
+        attacked since the last reset"""
+        if not self.iterations:
+            return {}
+        return {
+            "batches": len(self.iterations),
+            "mean_iterations": float(np.mean(self.iterations)),
+            "min_iterations": min(self.iterations),
+            "max_iterations": max(self.iterations),
+        }
+
+    def log_iterations(self):
+        """Log the iteration statistics and reset them"""
+        logger.info("AugMax attack: %s" % self.iteration_stats())
+        if self.cache is not None:
+            logger.info("AugMax warm-start cache: %s" % self.cache.stats())
+        self.iterations = []
+
+    def on_evaluation_end(self, logger):
+        super(AugMaxAttack, self).on_evaluation_end(logger)
+        logger.log_stats(
+            stats_meta={},
+            test_stats={"AugMax iterations": self.iteration_stats()},
+        )
+        self.iterations = []
+
+    def init_free(self, batch, xs=None):
+        """
+        Branches and randomly initialized mixing parameters of a batch for
+        free AugMax training (see AugMaxASRBrain.fit_batch_free).
+
+        Arguments
+        ---------
+        batch : sb.PaddedBatch
+           The input batch, on the device of the brain
+        xs : Optional[torch.Tensor]
+           (W + 1, N, T) augmented branches to mix, computed by the engine if None
+
+        Returns
+        -------
+        the branches, m (N,) and q (N, W), which require gradients
+        """
+        wavs, wav_lens = batch.sig
+        if xs is None:
+            xs = self.engine.aug_all(wavs, ids=batch.id, lengths=wav_lens)
+        N = wavs.size(0)
+        m = torch.rand(N, device=wavs.device, requires_grad=True)
+        q = torch.rand((N, self.mixture_width), device=wavs.device, requires_grad=True)
+        return xs, m, q
+
+    def mix(self, xs, m, q, lengths=None):
+        """AugMax mixture of the branches xs (see augmax_combine)"""
+        return augmax_combine(xs, m, q, lengths=lengths)
+
+    def free_step(self, m, q, grads=None):
+        """Sign-SGD ascent step of size eps on m and q from their gradients
+        (grads, or m.grad and q.grad if None), in place, with m clamped to
+        [0, 1]. Their gradients are reset."""
+        if grads is None:
+            grads = m.grad, q.grad
+        with torch.no_grad():
+            for param, grad in zip((m, q), grads):
+                if grad is not None:
+                    param.add_(self.eps * torch.sign(grad))
+                param.grad = None
+            m.clamp_(0, 1)
+
+    def perturb(self, batch, xs=None, eps=None, nb_iter=None):
         """
         Compute an adversarial perturbation
 
@@ -146,6 +293,14 @@ class AugMaxAttack(Attacker):
         ---------
         batch : sb.PaddedBatch
            The input batch to perturb
+        xs : Optional[torch.Tensor]
+           (W + 1, N, T) augmented branches to mix (e.g. shared with AugMix),
+           computed by the engine if None
+        eps : Optional[float]
+           step size of this attack (self.eps if None)
+        nb_iter : Optional[int]
+           number of iterations of this attack (self.nb_iter, or
+           self.warm_start_iter for warm-started batches, if None)
 
         Returns
         -------
@@ -161,42 +316,479 @@ class AugMaxAttack(Attacker):
         save_input = batch.sig[0]
         wav_init = torch.clone(save_input)
 
-        N = wav_init.size()[0] #return batch size
+        N = wav_init.size()[0] * self.restarts #return batch size (of all restarts)
+        device = wav_init.device
+        # restarts are stacked along the batch dimension
+        adv_batch = batch if self.restarts == 1 else repeat_batch(batch, self.restarts)
+        wav_lens = adv_batch.sig[1]
         # initialize m_adv:
-        m_adv = torch.rand(N).to(save_device)  # random initialize in [0,1)
+        m_adv = torch.rand(N, device=device)  # random initialize in [0,1)
         m_adv = torch.clamp(m_adv, 0, 1)  # clamp to range [0,1)
         m_adv.requires_grad = True
         # initialize ws_adv:
-        q_adv = torch.rand((N, self.mixture_width), requires_grad=True).to(save_device)  # random initialize
+        q_adv = torch.rand((N, self.mixture_width), device=device, requires_grad=True)  # random initialize
+        # warm start (of the first restart) from the cache:
+        num_utts = wav_init.size(0)
+        # validation and test attacks run from scratch and are not cached
+        use_cache = self.cache is not None and self.training
+        warm = [self.cache.get(utt_id) for utt_id in batch.id] if use_cache else []
+        # entries cached with another mixture width (see scheduler.py) are not used
+        warm = [e if e is None or e.q.numel() == self.mixture_width else None for e in warm]
+        chains = None
+        for i, entry in enumerate(warm):
+            if entry is not None:
+                m_adv.data[i] = entry.m
+                q_adv.data[i] = entry.q
+        if self.engine.per_example_chains and any(e is not None and e.chains is not None for e in warm):
+            chains = [
+                warm[i].chains[b] if warm[i] is not None and warm[i].chains is not None else self.engine.sample_chain()
+                for b in range(self.mixture_width)
+                for i in range(num_utts)
+            ]
+        if nb_iter is None:
+            nb_iter = self.nb_iter
+            if warm and self.warm_start_iter is not None and all(e is not None for e in warm):
+                nb_iter = self.warm_start_iter
         # initialize x_adv
-        xs = aug_all(wav_init, self.mixture_width, self.mixture_depth, self.aug_severity)
-        x_adv = augmax_combine(xs, m_adv, q_adv, save_device)
+        branch_sets = [
+            self.engine.aug_all(
+                wav_init,
+                chains=chains if r == 0 else None,
+                return_chains=True,
+                ids=batch.id,
+                lengths=batch.sig[1],
+            )
+            for r in range(0 if xs is None else 1, self.restarts)
+        ]
+        if xs is not None:
+            if xs.size(0) != self.mixture_width + 1:
+                raise ValueError(
+                    "expected %d branches, got %d" % (self.mixture_width + 1, xs.size(0))
+                )
+            branch_sets.insert(0, (xs.to(device), None))
+        xs, branch_chains = zip(*branch_sets)
+        xs = xs[0] if self.restarts == 1 else torch.cat(xs, dim=1)
+        if self.stft_mixing:
+            # the STFT is linear: mix the spectra of the (zero-padded) branches
+            spectra = self.asr_brain.compute_stft(xs.view(-1, xs.size(-1)))
+            stft_shape = spectra.shape[1:]
+            spectra = spectra.view(xs.size(0), N, -1)
+            if self.branch_dtype != "float32":
+                spectra = PackedBranches.pack(spectra, self.branch_dtype)
+        if self.branch_dtype != "float32":
+            xs = PackedBranches.pack(xs, self.branch_dtype)
+        if not self.stft_mixing:
+            x_adv = augmax_combine(xs, m_adv, q_adv, lengths=wav_lens)
         # attack step size
-        alpha = self.eps #pgd step
-        for t in range(self.nb_iter):
-            batch.sig = x_adv, batch.sig[1]
-            predictions = self.asr_brain.compute_forward(batch, rs.Stage.ATTACK)
-            if self.targeted:
-                loss_adv = -self.asr_brain.compute_objectives(predictions, batch, rs.Stage.ATTACK)
-            else:  # untargeted attack
-                loss_adv = self.asr_brain.compute_objectives(predictions, batch, rs.Stage.ATTACK)
-            # grad:
-            grad_m_adv, grad_q_adv = torch.autograd.grad(loss_adv, [m_adv, q_adv], only_inputs=True)
+        alpha = self.eps if eps is None else eps #pgd step
+        early_stopping = self.patience is not None
+        per_example = early_stopping or self.restarts > 1
+        reduction = "batch" if per_example else "mean"
+        best_loss = None
+        if early_stopping:
+            active = torch.ones(N, device=device)
+            stale = torch.zeros(N, dtype=torch.long, device=device)
+        if self.restarts > 1:
+            best_m, best_q = m_adv.detach().clone(), q_adv.detach().clone()
+        iterations = nb_iter
+        # forward passes in mixed precision with auto_mix_prec, (m, q) and the mix stay in float32
+        scaler = AttackGradScaler(self.asr_brain)
+        for t in range(nb_iter):
+            if self.stft_mixing:
+                stft_adv = augmax_combine(spectra, m_adv, q_adv).view((N,) + stft_shape)
+            else:
+                adv_batch.sig = x_adv, wav_lens
+            with attack_autocast(self.asr_brain):
+                if self.stft_mixing:
+                    predictions = self.asr_brain.compute_forward_from_stft(stft_adv, adv_batch, rs.Stage.ATTACK)
+                else:
+                    predictions = self.asr_brain.compute_forward(adv_batch, rs.Stage.ATTACK)
+                if self.targeted:
+                    loss_adv = -self.asr_brain.compute_objectives(predictions, adv_batch, rs.Stage.ATTACK, reduction=reduction)
+                else:  # untargeted attack
+                    loss_adv = self.asr_brain.compute_objectives(predictions, adv_batch, rs.Stage.ATTACK, reduction=reduction)
+            # grad (sign-SGD steps are the same for the sum and the mean of the losses):
+            grads = scaler.unscale(
+                *torch.autograd.grad(scaler.scale_loss(loss_adv.sum()), [m_adv, q_adv], only_inputs=True)
+            )
+            if grads is not None:
+                grad_m_adv, grad_q_adv = grads
+                step_m = alpha * torch.sign(grad_m_adv.data)
+                step_q = alpha * torch.sign(grad_q_adv.data)
+            if per_example:
+                loss = loss_adv.detach().float()
+                if best_loss is None:
+                    better = improved = torch.ones_like(loss, dtype=torch.bool)
+                    best_loss = loss
+                else:
+                    better = loss > best_loss
+                    improved = loss > best_loss + self.tol * best_loss.abs()
+                    best_loss = torch.maximum(best_loss, loss)
+            if self.restarts > 1:
+                # (m, q) of the mixture with the highest loss so far
+                best_m = torch.where(better, m_adv.detach(), best_m)
+                best_q = torch.where(better.unsqueeze(1), q_adv.detach(), best_q)
+            if early_stopping:
+                if grads is None:
+                    pinned = torch.zeros_like(improved)
+                else:
+                    # m stays at a clamp bound when sign-SGD pushes it outwards
+                    pinned = ((m_adv.data >= 1) & (step_m > 0)) | ((m_adv.data <= 0) & (step_m < 0))
+                stale = torch.where(improved & ~pinned, torch.zeros_like(stale), stale + 1)
+                active = active * (stale < self.patience)
+                if not active.any():
+                    iterations = t + 1
+                    break
+            if grads is None:  # float16 overflow, the scale was reduced: no step
+                if not self.stft_mixing:
+                    # the graph of x_adv was freed by the backward pass
+                    x_adv = augmax_combine(xs, m_adv, q_adv, lengths=wav_lens)
+                continue
+            if early_stopping:
+                step_m = step_m * active
+                step_q = step_q * active.unsqueeze(1)
             # update m:
-            m_adv.data.add_(alpha * torch.sign(grad_m_adv.data))  # gradient assend by Sign-SGD
+            m_adv.data.add_(step_m)  # gradient assend by Sign-SGD
             m_adv = torch.clamp(m_adv, 0, 1)  # clamp to RGB range [0,1]
             # update w1:
-            q_adv.data.add_(alpha * torch.sign(grad_q_adv.data))  # gradient assend by Sign-SGD
+            q_adv.data.add_(step_q)  # gradient assend by Sign-SGD
             # update x_adv:
-            x_adv = augmax_combine(xs, m_adv, q_adv, save_device)
+            if not self.stft_mixing:
+                x_adv = augmax_combine(xs, m_adv, q_adv, lengths=wav_lens)
+        self.iterations.append(iterations)
+        logger.debug("AugMax attack: %d/%d iterations" % (iterations, nb_iter))
+        if self.restarts > 1:
+            # worst case over the restarts of each utterance
+            x_adv = augmax_combine(xs, best_m, best_q, lengths=wav_lens)
+            if best_loss is None:
+                restart = torch.zeros(num_utts, dtype=torch.long, device=device)
+            else:
+                restart = best_loss.view(self.restarts, num_utts).argmax(dim=0)
+            rows = restart * num_utts + torch.arange(num_utts, device=device)
+            x_adv = x_adv[rows]
+            m_final, q_final = best_m[rows], best_q[rows]
+        else:
+            if self.stft_mixing:
+                x_adv = augmax_combine(xs, m_adv, q_adv, lengths=wav_lens)
+            restart = torch.zeros(num_utts, dtype=torch.long)
+            m_final, q_final = m_adv.detach(), q_adv.detach()
+        if use_cache:
+            for i, utt_id in enumerate(batch.id):
+                utt_chains = branch_chains[int(restart[i])]
+                if utt_chains is not None:
+                    utt_chains = [utt_chains[b * num_utts + i] for b in range(self.mixture_width)]
+                self.cache.put(utt_id, m_final[i], q_final[i], utt_chains)
         batch.sig = save_input, batch.sig[1]
         batch = batch.to(save_device)
         return x_adv.data.to(save_device)
 
 
+class FastAugMaxAttack(AugMaxAttack):
+    """
+    Single-step AugMax, in the spirit of fast adversarial training
+    (https://arxiv.org/abs/2001.03994): one sign-SGD step of size step_size
+    on (m, q) from their random initialization, i.e. one forward/backward
+    pass per batch instead of nb_iter.
+
+    Single-step training can overfit catastrophically to the single-step
+    attack. Every check_every batches, the full-strength attack (check_nb_iter
+    steps of size check_eps) is also run, and the losses of both attacks are
+    compared. If the full-strength loss exceeds check_ratio times the
+    single-step loss, a warning is logged and, with fallback, the
+    full-strength attack is used for the remaining batches.
+
+    Arguments
+    ---------
+    asr_brain: rs.adversarial.brain.ASRBrain
+       brain object.
+    step_size: float
+       size of the single sign-SGD step.
+    check_every: Optional[int]
+       period (in batches) of the full-strength check (disabled if None).
+    check_nb_iter: int
+       number of iterations of the full-strength attack.
+    check_eps: float
+       step size of the full-strength attack.
+    check_ratio: float
+       ratio of full-strength to single-step loss above which catastrophic
+       overfitting is reported.
+    fallback: bool
+       whether to switch to the full-strength attack once catastrophic
+       overfitting is reported.
+    **kwargs
+       other AugMaxAttack arguments.
+    """
+
+    def __init__(
+        self,
+        asr_brain,
+        step_size=1.0,
+        check_every=None,
+        check_nb_iter=10,
+        check_eps=0.1,
+        check_ratio=1.5,
+        fallback=False,
+        **kwargs
+    ):
+        super(FastAugMaxAttack, self).__init__(
+            asr_brain, eps=step_size, nb_iter=1, **kwargs
+        )
+        self.step_size = step_size
+        self.check_every = check_every
+        self.check_nb_iter = check_nb_iter
+        self.check_eps = check_eps
+        self.check_ratio = check_ratio
+        self.fallback = fallback
+        self.overfitting = False
+        self.batches = 0
+        self.checks = []  # (single-step loss, full-strength loss) of each check
+
+    def full_perturb(self, batch, xs=None):
+        """Run the full-strength attack on a batch"""
+        return super(FastAugMaxAttack, self).perturb(
+            batch, xs, eps=self.check_eps, nb_iter=self.check_nb_iter
+        )
+
+    def attack_loss(self, batch, wavs):
+        """Attack loss of the batch with the inputs replaced by wavs"""
+        save_device = batch.sig[0].device
+        batch = batch.to(self.asr_brain.device)
+        save_input = batch.sig[0]
+        batch.sig = wavs.to(self.asr_brain.device), batch.sig[1]
+        with torch.no_grad():
+            predictions = self.asr_brain.compute_forward(batch, rs.Stage.ATTACK)
+            loss = self.asr_brain.compute_objectives(predictions, batch, rs.Stage.ATTACK)
+        batch.sig = save_input, batch.sig[1]
+        batch = batch.to(save_device)
+        return float(loss)
+
+    def perturb(self, batch, xs=None):
+        """
+        Compute an adversarial perturbation
+
+        Arguments
+        ---------
+        batch : sb.PaddedBatch
+           The input batch to perturb
+        xs : Optional[torch.Tensor]
+           (W + 1, N, T) augmented branches to mix (e.g. shared with AugMix),
+           computed by the engine if None
+
+        Returns
+        -------
+        the tensor of the perturbed batch
+        """
+        self.batches += 1
+        if self.overfitting and self.fallback:
+            return self.full_perturb(batch, xs)
+        check = self.check_every and self.batches % self.check_every == 0
+        if check and xs is None:
+            # both attacks mix the same branches
+            wavs, wav_lens = batch.sig
+            xs = self.engine.aug_all(
+                wavs.to(self.asr_brain.device),
+                ids=batch.id,
+                lengths=wav_lens.to(self.asr_brain.device),
+            )
+        x_adv = super(FastAugMaxAttack, self).perturb(batch, xs)
+        if check:
+            x_full = self.full_perturb(batch, xs)
+            losses = self.attack_loss(batch, x_adv), self.attack_loss(batch, x_full)
+            self.checks.append(losses)
+            logger.debug("Fast AugMax check: single-step loss %.4f, full-strength loss %.4f" % losses)
+            if losses[1] > self.check_ratio * losses[0]:
+                self.overfitting = True
+                logger.warning(
+                    "Fast AugMax: full-strength loss %.4f exceeds %g times the "
+                    "single-step loss %.4f (catastrophic overfitting)%s"
+                    % (losses[1], self.check_ratio, losses[0],
+                       ", switching to the full-strength attack" if self.fallback else "")
+                )
+        return x_adv
+
+
+class AugMaxGenerator(nn.Module):
+    """
+    Small network predicting the AugMax mixing parameters of a batch in one
+    forward pass. Every branch is encoded from its log-mel frames (mean
+    pooled over the valid frames). The logit of each augmented branch is
+    predicted from its encoding and that of the clean branch, and m from the
+    clean encoding and the mean augmented encoding.
+
+    Arguments
+    ---------
+    mixture_width: int
+        number of augmented branches.
+    n_mels: int
+        number of mel bands of the input frames.
+    hidden_size: int
+        size of the frame and branch encodings.
+    sample_rate: int
+        audio sample rate.
+    """
+
+    def __init__(self, mixture_width=3, n_mels=40, hidden_size=64, sample_rate=16000):
+        super(AugMaxGenerator, self).__init__()
+        self.mixture_width = mixture_width
+        self.hop_length = sample_rate // 100
+        self.mel = torchaudio.transforms.MelSpectrogram(
+            sample_rate,
+            n_fft=sample_rate // 40,
+            hop_length=self.hop_length,
+            n_mels=n_mels,
+        )
+        self.encoder = nn.Sequential(
+            nn.Linear(n_mels, hidden_size),
+            nn.ReLU(),
+            nn.Linear(hidden_size, hidden_size),
+            nn.ReLU(),
+        )
+        self.q_head = nn.Linear(2 * hidden_size, 1)
+        self.m_head = nn.Linear(2 * hidden_size, 1)
+
+    def forward(self, xs, lengths=None):
+        '''
+        Args:
+            xs: (W+1, N, T) tensor. [x_ori, x_aug1, x_aug2, ...]
+            lengths: Tensor. relative lengths (N), only the valid frames are pooled if given
+        Returns:
+            m: Tensor. m.size=(N), in [0, 1]
+            q: Tensor. q.size()=(N,W), logits of the branch weights
+        '''
+        branches, N, T = xs.shape
+        with torch.no_grad():
+            feats = torch.log(self.mel(xs.reshape(-1, T)) + 1e-6).transpose(1, 2)
+        h = self.encoder(feats).view(branches, N, feats.size(1), -1)
+        if lengths is None:
+            h = h.mean(dim=2)
+        else:
+            frames = torch.arange(h.size(2), device=h.device)
+            valid = (frames < torch.ceil(lengths * T / self.hop_length).unsqueeze(1)).float()
+            h = (h * valid[:, :, None]).sum(dim=2) / valid.sum(dim=1, keepdim=True).clamp_min(1)
+        h_ori, h_aug = h[0], h[1:]
+        q = self.q_head(torch.cat([h_aug, h_ori.expand_as(h_aug)], dim=-1))
+        m = self.m_head(torch.cat([h_ori, h_aug.mean(dim=0)], dim=-1))
+        return torch.sigmoid(m.view(N)), q.squeeze(-1).t()
+
+
+class AugMaxGeneratorAttack(AugMaxAttack):
+    """
+    Amortized AugMax: the mixing parameters are predicted by an
+    AugMaxGenerator instead of being optimized by nb_iter sign-SGD steps.
+    The generator is trained jointly with the ASR model to maximize the ASR
+    loss of its mixtures: every update_every batches, the loss of the
+    mixture is backpropagated to the generator (one forward/backward pass of
+    the model) and the generator takes a gradient ascent step.
+    Every refresh_every batches, the iterative attack (nb_iter steps of size
+    eps) is used instead, so that the model keeps facing the full-strength
+    worst case. Updates and refreshes only happen in training mode
+    (generator.train(), set by AugMaxASRBrain on training batches).
+
+    Arguments
+    ---------
+    asr_brain: rs.adversarial.brain.ASRBrain
+       brain object.
+    lr: float
+       learning rate (Adam) of the generator.
+    update_every: int
+       period (in batches) of the generator updates.
+    refresh_every: Optional[int]
+       period (in batches) of the iterative attack (disabled if None).
+    hidden_size: int
+       hidden size of the generator.
+    sample_rate: int
+       audio sample rate.
+    **kwargs
+       other AugMaxAttack arguments (nb_iter and eps are used by the
+       refreshes).
+    """
+
+    def __init__(
+        self,
+        asr_brain,
+        lr=1e-3,
+        update_every=1,
+        refresh_every=None,
+        hidden_size=64,
+        sample_rate=16000,
+        **kwargs
+    ):
+        super(AugMaxGeneratorAttack, self).__init__(asr_brain, **kwargs)
+        self.generator = AugMaxGenerator(
+            self.mixture_width, hidden_size=hidden_size, sample_rate=sample_rate
+        ).to(asr_brain.device)
+        self.optimizer = torch.optim.Adam(self.generator.parameters(), lr=lr)
+        self.scaler = AttackGradScaler(asr_brain)
+        self.update_every = update_every
+        self.refresh_every = refresh_every
+        self.batches = 0
+
+    def update_generator(self, batch, x_adv):
+        """Gradient ascent step of the generator on the ASR loss of x_adv
+        (skipped if the scaled gradients overflow)"""
+        batch.sig = x_adv, batch.sig[1]
+        # forward pass in mixed precision with auto_mix_prec, like the iterative attack
+        with attack_autocast(self.asr_brain):
+            predictions = self.asr_brain.compute_forward(batch, rs.Stage.ATTACK)
+            loss = self.asr_brain.compute_objectives(predictions, batch, rs.Stage.ATTACK)
+        if self.targeted:
+            loss = -loss
+        params = [p for p in self.generator.parameters() if p.requires_grad]
+        grads = self.scaler.unscale(
+            *torch.autograd.grad(self.scaler.scale_loss(loss), params)
+        )
+        if grads is None:
+            return loss.detach()
+        self.optimizer.zero_grad()
+        for param, grad in zip(params, grads):
+            param.grad = -grad  # maximize the loss
+        self.optimizer.step()
+        return loss.detach()
+
+    def perturb(self, batch, xs=None):
+        """
+        Compute an adversarial perturbation
+
+        Arguments
+        ---------
+        batch : sb.PaddedBatch
+           The input batch to perturb
+        xs : Optional[torch.Tensor]
+           (W + 1, N, T) augmented branches to mix (e.g. shared with AugMix),
+           computed by the engine if None
+
+        Returns
+        -------
+        the tensor of the perturbed batch
+        """
+        training = self.generator.training
+        self.batches += training
+        if training and self.refresh_every and self.batches % self.refresh_every == 0:
+            return super(AugMaxGeneratorAttack, self).perturb(batch, xs)
+        if self.train_mode_for_backward:
+            self.asr_brain.module_train()
+        else:
+            self.asr_brain.module_eval()
+
+        save_device = batch.sig[0].device
+        batch = batch.to(self.asr_brain.device)
+        save_input = batch.sig[0]
+        wav_lens = batch.sig[1]
+        if xs is None:
+            xs = self.engine.aug_all(save_input, ids=batch.id, lengths=wav_lens)
+        m_adv, q_adv = self.generator(xs, wav_lens)
+        if self.branch_dtype != "float32":
+            xs = PackedBranches.pack(xs, self.branch_dtype)
+        x_adv = augmax_combine(xs, m_adv, q_adv, lengths=wav_lens)
+        if training and self.update_every and self.batches % self.update_every == 0:
+            self.update_generator(batch, x_adv)
+        batch.sig = save_input, batch.sig[1]
+        batch = batch.to(save_device)
+        return x_adv.data.to(save_device)
+
 
 class AugMixModule(nn.Module):
-    def __init__(self, mixture_width, mixture_depth=-1, aug_severity=3, device='cuda'):
+    def __init__(self, mixture_width, mixture_depth=-1, aug_severity=3, device='cuda', per_example_chains=False, fuse_filters=False, augmentation_store=None):
         super(AugMixModule, self).__init__()
 
         self.mixture_width = mixture_width
@@ -206,30 +798,30 @@ class AugMixModule(nn.Module):
         self.m_dist = torch.distributions.beta.Beta(1, 1)
 
         self.device = device
+        self.engine = AugmentationEngine(
+            mixture_width,
+            mixture_depth,
+            aug_severity,
+            per_example_chains=per_example_chains,
+            fuse_filters=fuse_filters,
+            store=augmentation_store,
+        )
 
-    def forward(self, wav):
+    def forward(self, wav, ids=None, lengths=None, xs=None):
         '''
         Args:
-            xs: tuple of Tensors. xs = (x_ori, x_aug1, x_aug2, x_aug3). x_ori.size()=(N,D)
+            wav: Tensor. wav.size()=(N,D)
+            ids: list. utterance ids, to sample the branches from the augmentation store
+            lengths: Tensor. relative lengths (N), only the valid spans are augmented if given
+            xs: Tensor. (W+1, N, D) branches to mix (e.g. shared with AugMax), computed if None
+        Returns:
+            the AugMix mixture of wav, on the device of wav
         '''
-        wav_init = torch.clone(wav)
-        
-        xs = aug_all(wav_init, self.mixture_width, self.mixture_depth, self.aug_severity)
-        
-        x_ori = xs[0]
-        N = x_ori.size()[0]
-        w = self.w_dist.sample([N]).to(self.device)
-        m = self.m_dist.sample([N]).to(self.device)
-
-        x_mix = torch.zeros_like(x_ori).to(self.device)
-        for i, x_aug in enumerate(xs[1:]):
-            wi = w[:,i].view((N, 1)).expand_as(x_aug)
-            x_mix += wi * x_aug 
-
-        m = m.view((N, 1)).expand_as(x_ori)
-        x_mix = (1-m) * x_ori + m * x_mix
-
-        return x_mix 
-
+        if xs is None:
+            xs = self.engine.aug_all(wav, ids=ids, lengths=lengths)
 
+        N = xs.size(1)
+        w = self.w_dist.sample([N]).to(wav.device)
+        m = self.m_dist.sample([N]).to(wav.device)
 
+        return mix_branches(xs, m, w, lengths)
@@ -0,0 +1,414 @@
+"""
+Batched augmentation engine used to build the AugMax and AugMix branches.
+"""
+
+import numpy as np
+import torch
+
+from robust_speech.adversarial.attacks.augmentation_store import AugmentationStore
+from robust_speech.adversarial.attacks.augmentations import augmentations, registry
+from robust_speech.adversarial.attacks.fft_filters import (
+    apply_filter_chains_,
+    is_filter,
+)
+
+FILTERS = "filters"  # group key of fused filter stages
+
+
+def valid_lengths(wav_lens, max_len):
+    """Absolute lengths of the utterances of a batch from their relative
+    lengths (batch.sig[1]), as a list of ints"""
+    return torch.round(wav_lens.float() * max_len).long().clamp(0, max_len).tolist()
+
+
+def length_buckets(lengths, max_padding=0.1):
+    """
+    Group the utterances of a batch by length.
+
+    Arguments
+    ---------
+    lengths: list
+        absolute lengths of the utterances
+    max_padding: float
+        largest fraction of padding allowed in a bucket
+
+    Returns
+    -------
+    list of (indices, span) where span is the longest length of the bucket
+    """
+    order = sorted(range(len(lengths)), key=lambda i: -lengths[i])
+    buckets = []
+    for i in order:
+        if buckets and lengths[i] >= (1 - max_padding) * buckets[-1][1]:
+            buckets[-1][0].append(i)
+        else:
+            buckets.append(([i], lengths[i]))
+    return buckets
+
+
+def _samples(output):
+    """Extract the samples returned by a torch_audiomentations transform
+    (a tensor or an ObjectDict depending on the library version)"""
+    return getattr(output, "samples", output)
+
+
+class AugmentationEngine:
+    """
+    Applies random chains of augmentation operations to batches of waveforms.
+    The batch never leaves its device: all branches are written in place in
+    a single (width + 1, N, T) buffer whose first slice is the clean input,
+    and transforms are applied directly on views of that buffer.
+
+    Arguments
+    ---------
+    mixture_width: int
+        number of augmented branches.
+    mixture_depth: int
+        number of operations in each chain (random in [1, 2] if non-positive).
+    aug_severity: int
+        level of augmentation operation.
+    sample_rate: int
+        audio sample rate.
+    ops: list
+        augmentation factories to sample chains from.
+    transforms: augmentations.AugmentationRegistry
+        cache of built transforms (shared module-level registry by default).
+    per_example_chains: bool
+        if True, every example of every branch gets its own random chain.
+        Examples sharing an operation are grouped, so that each operation
+        runs once per chain step whatever the batch size.
+    fuse_filters: bool
+        if True, consecutive filter operations of a chain (see
+        fft_filters.py) are merged and applied with a single FFT round trip.
+        Matches the sequential filters except near the signal edges.
+    store: Optional[str or AugmentationStore]
+        store of precomputed branches (see augmentation_store.py). When the
+        utterance ids of a batch are given and all are in the store, the
+        branches are sampled from it instead of being computed.
+    max_padding: float
+        when the lengths of the utterances are given, utterances are
+        augmented in buckets of similar lengths, cropped to the longest one,
+        with at most this fraction of padding in each bucket.
+    """
+
+    def __init__(
+        self,
+        mixture_width=3,
+        mixture_depth=-1,
+        aug_severity=3,
+        sample_rate=16000,
+        ops=None,
+        transforms=None,
+        per_example_chains=False,
+        fuse_filters=False,
+        store=None,
+        max_padding=0.1,
+    ):
+        self.mixture_width = mixture_width
+        self.mixture_depth = mixture_depth
+        self.aug_severity = aug_severity
+        self.sample_rate = sample_rate
+        self.ops = ops if ops is not None else augmentations
+        self.transforms = transforms if transforms is not None else registry
+        self.per_example_chains = per_example_chains
+        self.fuse_filters = fuse_filters
+        if isinstance(store, str):
+            store = AugmentationStore(store)
+        self.store = store
+        self.max_padding = max_padding
+        # number of samples processed by the ops, and how many of them are padding
+        self.augmented_samples = 0
+        self.padded_samples = 0
+        self._prefetched = None
+
+    def sample_chain(self):
+        """Randomly pick the operations of one augmentation chain"""
+        depth = (
+            self.mixture_depth if self.mixture_depth > 0 else np.random.randint(1, 3)
+        )
+        return [np.random.choice(self.ops) for _ in range(depth)]
+
+    def apply_op(self, op, samples):
+        """
+        Apply one augmentation operation in place.
+
+        Arguments
+        ---------
+        op: callable
+            augmentation factory (see augmentations.py)
+        samples: torch.Tensor
+            (N, T) tensor, modified in place
+        """
+        transform = self.transforms.get(op, self.aug_severity, self.sample_rate)
+        view = samples.unsqueeze(1)  # mono channel
+        # every op is used with p=1 in per_example mode: skip the generic
+        # forward, which clones the batch twice to select examples
+        transform.transform_parameters = {}
+        transform.randomize_parameters(view, self.sample_rate)
+        out = _samples(transform.apply_transform(view, self.sample_rate))
+        if out.data_ptr() != view.data_ptr():
+            view.copy_(out)
+        return samples
+
+    def stages(self, chain):
+        """
+        Split a chain into the stages applied one after another: single
+        operations, or tuples of consecutive filters when fuse_filters is set.
+        """
+        if not self.fuse_filters:
+            return list(chain)
+        stages = []
+        for op in chain:
+            if not is_filter(op):
+                stages.append(op)
+            elif stages and isinstance(stages[-1], tuple):
+                stages[-1] += (op,)
+            else:
+                stages.append((op,))
+        return stages
+
+    def apply_stages_(self, samples, stages):
+        """Apply the same stage to every example, in place"""
+        if isinstance(stages, tuple):
+            return apply_filter_chains_(
+                samples,
+                [stages] * samples.size(0),
+                self.transforms,
+                self.aug_severity,
+                self.sample_rate,
+            )
+        return self.apply_op(stages, samples)
+
+    def augment_(self, samples, chain=None):
+        """Apply a (random if None) chain of operations in place on a (N, T) tensor"""
+        if chain is None:
+            chain = self.sample_chain()
+        for stage in self.stages(chain):
+            self.apply_stages_(samples, stage)
+        return samples
+
+    def augment_per_example_(self, samples, chains=None):
+        """
+        Apply one chain per example in place. At each step of the chains,
+        the examples sharing an operation are gathered and processed in a
+        single call to that operation.
+
+        Arguments
+        ---------
+        samples: torch.Tensor
+            (N, T) tensor, modified in place
+        chains: Optional[list]
+            N chains of operations (sampled randomly if None)
+
+        Returns
+        -------
+        the list of chains applied to each example
+        """
+        n = samples.size(0)
+        if chains is None:
+            chains = [self.sample_chain() for _ in range(n)]
+        assert len(chains) == n
+        stages = [self.stages(chain) for chain in chains]
+        depth = max(len(stage) for stage in stages)
+        for step in range(depth):
+            groups = {}
+            for i, stage in enumerate(stages):
+                if step < len(stage):
+                    # fused filter stages of different examples run together
+                    key = FILTERS if isinstance(stage[step], tuple) else stage[step]
+                    groups.setdefault(key, []).append(i)
+            for key, idx in groups.items():
+                runs = [stages[i][step] for i in idx] if key is FILTERS else None
+                if len(idx) == n:
+                    self._apply_group_(samples, key, runs)
+                    continue
+                idx = torch.tensor(idx, device=samples.device)
+                group = samples.index_select(0, idx)
+                self._apply_group_(group, key, runs)
+                samples.index_copy_(0, idx, group)
+        return chains
+
+    def _apply_group_(self, samples, key, runs):
+        """Apply an operation, or the fused filter runs of each example"""
+        if key is FILTERS:
+            apply_filter_chains_(
+                samples, runs, self.transforms, self.aug_severity, self.sample_rate
+            )
+        else:
+            self.apply_op(key, samples)
+        return samples
+
+    def augment_valid_(self, samples, lengths, augment):
+        """
+        Apply an augmentation in place on the valid span of each utterance.
+        Utterances are grouped in length buckets, each bucket is cropped to
+        its longest utterance, and the padding is zeroed afterwards.
+
+        Arguments
+        ---------
+        samples: torch.Tensor
+            (N, T) tensor, modified in place
+        lengths: Optional[list]
+            absolute lengths of the utterances (the whole tensor is
+            augmented if None)
+        augment: callable
+            augment(bucket, indices) applies the augmentation in place on the
+            (len(indices), span) bucket holding utterances indices
+        """
+        n, max_len = samples.shape
+        if lengths is None:
+            augment(samples, list(range(n)))
+            self.augmented_samples += samples.numel()
+            return samples
+        for idx, span in length_buckets(lengths, self.max_padding):
+            self.augmented_samples += len(idx) * span
+            self.padded_samples += sum(span - lengths[i] for i in idx)
+            if len(idx) == n and span == max_len:
+                augment(samples, idx)
+                continue
+            index = torch.tensor(idx, device=samples.device)
+            bucket = samples[:, :span].index_select(0, index)
+            augment(bucket, idx)
+            samples[:, :span].index_copy_(0, index, bucket)
+        padding = torch.arange(max_len, device=samples.device) >= torch.tensor(
+            lengths, device=samples.device
+        ).unsqueeze(1)
+        return samples.masked_fill_(padding, 0)
+
+    def padding_ratio(self):
+        """Fraction of the samples processed by the ops that were padding"""
+        return self.padded_samples / max(self.augmented_samples, 1)
+
+    def aug_one(self, x, out=None, lengths=None):
+        """
+        Compute one augmented branch.
+
+        Arguments
+        ---------
+        x: torch.Tensor
+            (N, T) batch of waveforms
+        out: Optional[torch.Tensor]
+            (N, T) buffer in which to write the result
+        lengths: Optional[torch.Tensor]
+            (N,) relative lengths of the utterances (batch.sig[1])
+
+        Returns
+        -------
+        the augmented branch (``out`` if provided)
+        """
+        with torch.no_grad():
+            if out is None:
+                out = torch.empty_like(x)
+            out.copy_(x)
+            if lengths is not None:
+                lengths = valid_lengths(lengths, x.size(-1))
+            if self.per_example_chains:
+                chains = [self.sample_chain() for _ in range(x.size(0))]
+                self.augment_valid_(
+                    out,
+                    lengths,
+                    lambda bucket, idx: self.augment_per_example_(
+                        bucket, [chains[i] for i in idx]
+                    ),
+                )
+            else:
+                chain = self.sample_chain()
+                self.augment_valid_(
+                    out, lengths, lambda bucket, idx: self.augment_(bucket, chain)
+                )
+        return out
+
+    def render(self, x, num_variants):
+        """
+        Compute num_variants augmented variants of a single waveform, each
+        with its own random chain (used to fill an augmentation store).
+
+        Arguments
+        ---------
+        x: torch.Tensor
+            (T,) waveform
+
+        Returns
+        -------
+        (num_variants, T) tensor
+        """
+        with torch.no_grad():
+            variants = x.unsqueeze(0).repeat(num_variants, 1)
+            self.augment_per_example_(variants)
+        return variants
+
+    def prefetch(self, xs, ids=None):
+        """
+        Hand over branches computed in advance (see augmentation_pipeline.py).
+        The next call to aug_all on the batch with these ids returns them
+        instead of computing new ones. None drops them.
+        """
+        self._prefetched = None if xs is None else (list(ids), xs)
+
+    def aug_all(self, x, chains=None, return_chains=False, ids=None, lengths=None):
+        """
+        Compute all branches.
+
+        Arguments
+        ---------
+        x: torch.Tensor
+            (N, T) batch of waveforms
+        chains: Optional[list]
+            width * N chains (branch-major) to apply instead of random ones.
+            Only used with per_example_chains.
+        return_chains: bool
+            whether to also return the chains applied to each example
+            (None when chains are shared by whole branches or sampled
+            from the store)
+        ids: Optional[list]
+            utterance ids of the batch, to sample the branches from the store
+        lengths: Optional[torch.Tensor]
+            (N,) relative lengths of the utterances (batch.sig[1]). If given,
+            only the valid span of each utterance is augmented.
+
+        Returns
+        -------
+        (width + 1, N, T) tensor: [x_ori, x_aug1, x_aug2, ...]
+        """
+        if self._prefetched is not None and chains is None and ids is not None:
+            prefetched_ids, xs = self._prefetched
+            self._prefetched = None
+            if (
+                prefetched_ids == list(ids)
+                and xs.size(0) == self.mixture_width + 1
+                and xs.shape[1:] == x.shape
+            ):
+                xs = xs.to(x.device, non_blocking=True)
+                return (xs, None) if return_chains else xs
+        with torch.no_grad():
+            width = self.mixture_width
+            xs = x.new_empty((width + 1,) + tuple(x.shape))
+            xs[0].copy_(x)
+            if (
+                self.store is not None
+                and ids is not None
+                and all(utt_id in self.store for utt_id in ids)
+            ):
+                chains = None
+                xs[1:].copy_(self.store.sample(ids, width, x.size(-1), x.device))
+            elif self.per_example_chains:
+                xs[1:].copy_(x.unsqueeze(0).expand_as(xs[1:]))
+                if chains is None:
+                    chains = [self.sample_chain() for _ in range(width * x.size(0))]
+                if lengths is not None:
+                    lengths = valid_lengths(lengths, x.size(-1)) * width
+                # all branches are processed together as a (width * N, T) batch
+                self.augment_valid_(
+                    xs[1:].view(width * x.size(0), -1),
+                    lengths,
+                    lambda bucket, idx: self.augment_per_example_(
+                        bucket, [chains[i] for i in idx]
+                    ),
+                )
+            else:
+                chains = None
+                for i in range(1, width + 1):
+                    self.aug_one(x, out=xs[i], lengths=lengths)
+        if return_chains:
+            return xs, chains
+        return xs
@@ -0,0 +1,152 @@
+"""
+Pipelined computation of the augmented branches of the next training batches.
+
+Worker threads run AugmentationEngine.aug_all on the batches ahead of the one
+being attacked and trained, and hand the branch tensors over to the engines of
+the training thread. Threads share the memory of the training process and
+torch releases the GIL inside its ops, so the branches are computed in
+parallel and handed over by reference, without serialization or copies.
+"""
+
+import copy
+import logging
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+from robust_speech.adversarial.attacks.augmentations import AugmentationRegistry
+
+logger = logging.getLogger(__name__)
+
+
+class AugmentationPipeline:
+    """
+    Prefetch the augmented branches of upcoming batches.
+
+    Arguments
+    ---------
+    engines: list
+        AugmentationEngine objects of the training thread (e.g. those of the
+        AugMix module and of the AugMax attacker). Each batch gets branches
+        for every engine, handed over with AugmentationEngine.prefetch.
+    num_workers: int
+        number of worker threads.
+    queue_depth: int
+        number of batches whose branches are computed ahead of the current one.
+    """
+
+    def __init__(self, engines, num_workers=2, queue_depth=2):
+        self.engines = list(engines)
+        self.num_workers = num_workers
+        self.queue_depth = queue_depth
+        self._executor = ThreadPoolExecutor(
+            max_workers=num_workers, thread_name_prefix="augmentation"
+        )
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self.reset_stats()
+
+    def reset_stats(self):
+        """Reset the queue-depth and stall metrics"""
+        self.batches = 0
+        self.stalls = 0
+        self.stall_seconds = 0.0
+        self.worker_seconds = 0.0
+        self.queue_depth_sum = 0
+        self.max_queue_depth = 0
+
+    def stats(self):
+        """
+        Metrics of the pipeline since the last reset: number of batches,
+        mean and max number of batches whose branches were ready when a batch
+        was handed over (queue depth), number of hand-overs that had to wait
+        for the workers (stalls) and total waiting time, total worker time.
+        """
+        batches = max(self.batches, 1)
+        return {
+            "batches": self.batches,
+            "mean_queue_depth": self.queue_depth_sum / batches,
+            "max_queue_depth": self.max_queue_depth,
+            "stalls": self.stalls,
+            "stall_seconds": self.stall_seconds,
+            "worker_seconds": self.worker_seconds,
+        }
+
+    def _worker_engines(self):
+        """Copies of the engines owned by the current worker thread, with
+        their own transforms (transforms store their random parameters)"""
+        engines = getattr(self._local, "engines", None)
+        if engines is None:
+            engines = []
+            for engine in self.engines:
+                engine = copy.copy(engine)
+                engine.transforms = AugmentationRegistry(engine.sample_rate)
+                engine.prefetch(None)
+                engines.append(engine)
+            self._local.engines = engines
+        return engines
+
+    def _compute(self, wavs, wav_lens, ids, widths):
+        start = time.perf_counter()
+        branches = []
+        for engine, width in zip(self._worker_engines(), widths):
+            engine.mixture_width = width
+            branches.append(engine.aug_all(wavs, ids=ids, lengths=wav_lens))
+        with self._lock:
+            self.worker_seconds += time.perf_counter() - start
+        return branches
+
+    def submit(self, batch):
+        """Start computing the branches of a batch, with the current widths
+        of the engines (e.g. set by an AttackScheduler)"""
+        wavs, wav_lens = batch.sig
+        widths = [engine.mixture_width for engine in self.engines]
+        return self._executor.submit(
+            self._compute, wavs, wav_lens, list(batch.id), widths
+        )
+
+    def _hand_over(self, pending):
+        batch, future = pending.popleft()
+        # batches whose branches are ready, including this one
+        depth = future.done() + sum(f.done() for _, f in pending)
+        self.batches += 1
+        self.queue_depth_sum += depth
+        self.max_queue_depth = max(self.max_queue_depth, depth)
+        if not future.done():
+            self.stalls += 1
+            start = time.perf_counter()
+            future.result()
+            self.stall_seconds += time.perf_counter() - start
+        for engine, xs in zip(self.engines, future.result()):
+            engine.prefetch(xs, batch.id)
+        return batch
+
+    def prefetch(self, batches):
+        """
+        Iterate over batches while the branches of the next queue_depth
+        batches are computed in the background. When a batch is yielded,
+        its branches are ready in the engines.
+        """
+        pending = deque()
+        try:
+            for batch in batches:
+                pending.append((batch, self.submit(batch)))
+                if len(pending) > self.queue_depth:
+                    yield self._hand_over(pending)
+            while pending:
+                yield self._hand_over(pending)
+        finally:
+            for _, future in pending:
+                future.cancel()
+            for engine in self.engines:
+                engine.prefetch(None)
+
+    def log_stats(self):
+        """Log the metrics of the pipeline and reset them"""
+        logger.info("augmentation pipeline: %s" % self.stats())
+        self.reset_stats()
+
+    def shutdown(self):
+        """Stop the worker threads"""
+        self._executor.shutdown(wait=True)
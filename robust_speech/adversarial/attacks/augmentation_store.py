@@ -0,0 +1,182 @@
+"""
+Offline store of precomputed augmented branches.
+
+Only the mixing coefficients of AugMax and AugMix are optimized, so the
+augmented branches of each utterance can be rendered once before training
+(see recipes/precompute_augmentations.py) and sampled at training time.
+
+Layout of a store folder:
+    index.json       store metadata and the location of each utterance
+    shard_00000.bin  raw arrays, for each utterance K variants of its length
+    shard_00001.bin  ...
+"""
+
+import json
+import os
+
+import numpy as np
+import torch
+
+INDEX_FILE = "index.json"
+
+
+class AugmentationStoreWriter:
+    """
+    Write the augmented variants of utterances into memory-mappable shards.
+
+    Arguments
+    ---------
+    folder: str
+        folder of the store (created if needed).
+    num_variants: int
+        number of variants K stored for each utterance.
+    dtype: str
+        numpy dtype of the stored samples.
+    shard_size: int
+        maximal size of a shard, in samples.
+    sample_rate: int
+        audio sample rate (stored in the index).
+    """
+
+    def __init__(
+        self,
+        folder,
+        num_variants,
+        dtype="float32",
+        shard_size=2 ** 28,
+        sample_rate=16000,
+    ):
+        os.makedirs(folder, exist_ok=True)
+        self.folder = folder
+        self.num_variants = num_variants
+        self.dtype = np.dtype(dtype)
+        self.shard_size = shard_size
+        self.sample_rate = sample_rate
+        self.shards = []
+        self.utterances = {}
+        self._file = None
+        self._offset = 0
+
+    def _open_shard(self):
+        if self._file is not None:
+            self._file.close()
+        name = "shard_%05d.bin" % len(self.shards)
+        self.shards.append(name)
+        self._file = open(os.path.join(self.folder, name), "wb")
+        self._offset = 0
+
+    def add(self, utt_id, variants):
+        """
+        Append the variants of an utterance.
+
+        Arguments
+        ---------
+        utt_id: str
+            utterance id (the "ID" column of the csv files)
+        variants: torch.Tensor
+            (num_variants, T) augmented waveforms
+        """
+        assert variants.dim() == 2 and variants.size(0) == self.num_variants
+        array = variants.detach().cpu().numpy().astype(self.dtype)
+        if self._file is None or self._offset + array.size > self.shard_size:
+            self._open_shard()
+        array.tofile(self._file)
+        self.utterances[utt_id] = [len(self.shards) - 1, self._offset, array.shape[1]]
+        self._offset += array.size
+
+    def close(self):
+        """Close the last shard and write the index"""
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+        index = {
+            "num_variants": self.num_variants,
+            "dtype": self.dtype.name,
+            "sample_rate": self.sample_rate,
+            "shards": self.shards,
+            "utterances": self.utterances,
+        }
+        with open(os.path.join(self.folder, INDEX_FILE), "w") as f:
+            json.dump(index, f)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+class AugmentationStore:
+    """
+    Read-only access to a store written by AugmentationStoreWriter.
+    Shards are memory-mapped, so only the variants actually sampled are read.
+
+    Arguments
+    ---------
+    folder: str
+        folder of the store.
+    """
+
+    def __init__(self, folder):
+        self.folder = folder
+        with open(os.path.join(folder, INDEX_FILE)) as f:
+            index = json.load(f)
+        self.num_variants = index["num_variants"]
+        self.dtype = np.dtype(index["dtype"])
+        self.sample_rate = index["sample_rate"]
+        self.shards = index["shards"]
+        self.utterances = index["utterances"]
+        self._maps = {}
+
+    def __len__(self):
+        return len(self.utterances)
+
+    def __contains__(self, utt_id):
+        return utt_id in self.utterances
+
+    def _map(self, shard):
+        array = self._maps.get(shard)
+        if array is None:
+            path = os.path.join(self.folder, self.shards[shard])
+            array = np.memmap(path, dtype=self.dtype, mode="r")
+            self._maps[shard] = array
+        return array
+
+    def variants(self, utt_id):
+        """(num_variants, T) read-only array of the variants of an utterance"""
+        shard, offset, length = self.utterances[utt_id]
+        size = self.num_variants * length
+        return self._map(shard)[offset : offset + size].reshape(
+            self.num_variants, length
+        )
+
+    def sample(self, ids, width, length, device="cpu"):
+        """
+        Sample augmented branches for a batch.
+
+        Arguments
+        ---------
+        ids: list
+            utterance ids of the batch
+        width: int
+            number of branches. Variants are drawn without replacement when
+            the store holds at least width variants per utterance.
+        length: int
+            padded length of the batch. Variants are zero-padded to it.
+        device: str
+            device of the returned tensor
+
+        Returns
+        -------
+        (width, N, length) tensor
+        """
+        out = torch.zeros((width, len(ids), length))
+        replace = self.num_variants < width
+        for i, utt_id in enumerate(ids):
+            variants = self.variants(utt_id)
+            choice = np.sort(np.random.choice(self.num_variants, width, replace))
+            span = min(variants.shape[1], length)
+            out[:, i, :span] = torch.from_numpy(
+                variants[choice, :span].astype(np.float32)
+            )
+        return out.to(device)
@@ -1,3 +1,7 @@
+from collections import Counter
+
+from robust_speech.adversarial.attacks.pitch_shift import BatchedPitchShift
+
 from torch_audiomentations import Gain, \
                                   AddBackgroundNoise, \
                                   BandPassFilter, \
@@ -10,7 +14,7 @@ from torch_audiomentations import Gain, \
                                   PolarityInversion
 #define a series of speech augmentation techniques here
 
-def gain(aug_severity):
+def gain(aug_severity, sample_rate=16000):
     """
     input is the batch original speech signal x_or
     output is the augmented speech signal x_aug
@@ -22,7 +26,7 @@ def gain(aug_severity):
         p=1,
     )
 
-# def add_background_noise(aug_severity):
+# def add_background_noise(aug_severity, sample_rate=16000):
 #     """
 #     need background noise audio
 #     """
@@ -34,7 +38,7 @@ def gain(aug_severity):
 #         p=1,
 #     )
 
-def band_pass_filter(aug_severity):
+def band_pass_filter(aug_severity, sample_rate=16000):
     return BandPassFilter(
         min_center_frequency=200,
         max_center_frequency=4000,
@@ -44,7 +48,7 @@ def band_pass_filter(aug_severity):
         p=1,
     )
 
-def band_stop_filter(aug_severity):
+def band_stop_filter(aug_severity, sample_rate=16000):
     return BandStopFilter(
         min_center_frequency=200,
         max_center_frequency=4000,
@@ -54,7 +58,7 @@ def band_stop_filter(aug_severity):
         p=1,
     )
 
-def add_colored_noise(aug_severity):
+def add_colored_noise(aug_severity, sample_rate=16000):
     return AddColoredNoise(
         min_snr_in_db=3.0,
         max_snr_in_db=30.0,
@@ -64,7 +68,7 @@ def add_colored_noise(aug_severity):
         p=1,
     )
 
-def high_pass_filter(aug_severity):
+def high_pass_filter(aug_severity, sample_rate=16000):
     return HighPassFilter(
         min_cutoff_freq=20,
         max_cutoff_freq=2400,
@@ -72,7 +76,7 @@ def high_pass_filter(aug_severity):
         p=1,
     )
 
-def low_pass_filter(aug_severity):
+def low_pass_filter(aug_severity, sample_rate=16000):
     return LowPassFilter(
         min_cutoff_freq=150,
         max_cutoff_freq=7500,
@@ -80,7 +84,7 @@ def low_pass_filter(aug_severity):
         p=1,
     )
 
-def peak_noramalization(aug_severity):
+def peak_noramalization(aug_severity, sample_rate=16000):
     """
     Apply a constant amount of gain, so that highest signal level present in each audio snippet
     in the batch becomes 0 dBFS, i.e. the loudest level allowed if all samples must be between
@@ -96,19 +100,31 @@ def peak_noramalization(aug_severity):
         p=1,
     )
 
-def pitch_shift(aug_severity):
+def pitch_shift(aug_severity, sample_rate=16000):
     """
     Pitch-shift sounds up or down without changing the tempo.
+    Batched implementation, see pitch_shift.py.
+    """
+    return BatchedPitchShift(
+        min_transpose_semitones=-4.0,
+        max_transpose_semitones=4.0,
+        sample_rate=sample_rate,
+    )
+
+def sequential_pitch_shift(aug_severity, sample_rate=16000):
+    """
+    torch_audiomentations pitch shift, processing one example at a time.
+    Much slower than pitch_shift.
     """
     return PitchShift(
         min_transpose_semitones=-4.0,
         max_transpose_semitones=4.0,
         mode="per_example",
         p=1,
-        sample_rate=16000
+        sample_rate=sample_rate
     )
 
-# def polarity_inversion(aug_severity):
+# def polarity_inversion(aug_severity, sample_rate=16000):
 #     """
 #     Flip the audio samples upside-down, reversing their polarity. In other words, multiply the
 #     waveform by -1, so negative values become positive, and vice versa. The result will sound
@@ -132,4 +148,60 @@ augmentations = [
     low_pass_filter,
     peak_noramalization,
     pitch_shift
-]
\ No newline at end of file
+]
+
+
+class AugmentationRegistry:
+    """
+    Cache of augmentation transforms. Each operation is built once per
+    (op, aug_severity, sample_rate) and reused afterwards: the random parameters
+    of torch_audiomentations transforms are sampled again at every call, so
+    there is no need to rebuild them (PitchShift for instance precomputes its
+    table of shift ratios in its constructor).
+
+    Arguments
+    ---------
+    sample_rate: int
+        default sample rate of the transforms.
+    """
+
+    def __init__(self, sample_rate=16000):
+        self.sample_rate = sample_rate
+        self._transforms = {}
+        self.build_counts = Counter()
+
+    def get(self, op, aug_severity, sample_rate=None):
+        """
+        Return the transform built by factory op, building it on first use.
+
+        Arguments
+        ---------
+        op: callable
+            one of the augmentation factories above
+        aug_severity: int
+            level of augmentation operation
+        sample_rate: Optional[int]
+            audio sample rate (defaults to the registry sample rate)
+        """
+        sample_rate = sample_rate if sample_rate is not None else self.sample_rate
+        key = (op, aug_severity, sample_rate)
+        transform = self._transforms.get(key)
+        if transform is None:
+            transform = op(aug_severity, sample_rate=sample_rate)
+            self._transforms[key] = transform
+            self.build_counts[op.__name__] += 1
+        return transform
+
+    def build_count(self, op=None):
+        """Number of times op (or any op if None) has been built"""
+        if op is None:
+            return sum(self.build_counts.values())
+        name = op if isinstance(op, str) else op.__name__
+        return self.build_counts[name]
+
+    def clear(self):
+        """Drop all cached transforms (build counts are kept)"""
+        self._transforms.clear()
+
+
+registry = AugmentationRegistry()
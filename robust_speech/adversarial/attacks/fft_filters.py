@@ -0,0 +1,196 @@
+"""
+Fused frequency-domain implementation of the linear filter augmentations
+(band-pass, band-stop, high-pass and low-pass).
+
+The torch_audiomentations filters are julius windowed-sinc FIR filters applied
+one example and one filter at a time. Here the frequency response of a whole
+chain of filters is computed for every example, and the chain is applied with
+a single rFFT, multiplication and irFFT over the batch.
+
+Tolerance: away from the signal edges, the fused chain matches the sequential
+chain up to float32 rounding (max absolute error below 1e-5 of the signal peak).
+Within the first and last `half_size` samples of each filter (at most
+`4 * sample_rate / cutoff`), outputs differ slightly, because julius pads the
+input of every filter by replicating its edges while the fused chain replicates
+the edges of the input once.
+"""
+
+import math
+
+import torch
+import torch.nn.functional as F
+
+from robust_speech.adversarial.attacks.augmentations import (
+    band_pass_filter,
+    band_stop_filter,
+    high_pass_filter,
+    low_pass_filter,
+)
+
+filter_augmentations = (
+    band_pass_filter,
+    band_stop_filter,
+    high_pass_filter,
+    low_pass_filter,
+)
+
+BAND_FILTERS = (band_pass_filter, band_stop_filter)
+
+
+def is_filter(op):
+    """Whether an augmentation operation is a linear filter that can be fused"""
+    return op in filter_augmentations
+
+
+def next_fast_len(n):
+    """Smallest integer >= n whose only prime factors are 2, 3 and 5"""
+    best = 2 ** math.ceil(math.log2(max(n, 1)))
+    p5 = 1
+    while p5 < best:
+        p35 = p5
+        while p35 < best:
+            quotient = -(-n // p35)
+            p2 = 2 ** max(math.ceil(math.log2(quotient)), 0)
+            best = min(best, p2 * p35)
+            p35 *= 3
+        p5 *= 5
+    return best
+
+
+def half_sizes(cutoffs, zeros=8):
+    """Half size of the julius windowed-sinc lowpass filters with these cutoffs
+    (expressed as fractions of the sample rate)"""
+    return torch.floor(zeros / cutoffs.double() / 2).long()
+
+
+def lowpass_responses(cutoffs, half_size, n_fft):
+    """
+    Real frequency response of the zero-phase julius lowpass filters.
+
+    Arguments
+    ---------
+    cutoffs: torch.Tensor
+        (B,) cutoff frequencies, as fractions of the sample rate
+    half_size: torch.Tensor
+        (B,) half sizes of the filters
+    n_fft: int
+        FFT size
+
+    Returns
+    -------
+    (B, n_fft // 2 + 1) tensor
+    """
+    device = cutoffs.device
+    max_half = int(half_size.max())
+    time = torch.arange(-max_half, max_half + 1, device=device, dtype=torch.float32)
+    hs = half_size.to(torch.float32).unsqueeze(1)
+    # symmetric hann window of size 2 * half_size + 1, zero outside
+    window = torch.where(
+        time.abs() <= hs,
+        0.5 + 0.5 * torch.cos(math.pi * time / hs),
+        torch.zeros((), device=device),
+    )
+    arg = 2 * math.pi * cutoffs.unsqueeze(1) * time
+    sinc = torch.where(
+        arg == 0, torch.ones((), device=device), torch.sin(arg) / arg
+    )
+    kernels = 2 * cutoffs.unsqueeze(1) * window * sinc
+    kernels = kernels / kernels.sum(dim=1, keepdim=True)
+    # center the kernel on sample 0 to get a zero-phase (real) response
+    circular = kernels.new_zeros((kernels.size(0), n_fft))
+    circular[:, : max_half + 1] = kernels[:, max_half:]
+    if max_half > 0:
+        circular[:, n_fft - max_half :] = kernels[:, :max_half]
+    return torch.fft.rfft(circular, n=n_fft).real
+
+
+def sample_cutoffs(transform, op, n, sample_rate, device):
+    """
+    Sample the cutoffs of n filters with the distributions of a
+    torch_audiomentations filter transform.
+
+    Returns
+    -------
+    (low, high) cutoffs as fractions of the sample rate.
+    high is None for lowpass and highpass filters.
+    """
+    transform.transform_parameters = {}
+    # filters only read the shape and device of the samples
+    transform.randomize_parameters(torch.empty((n, 1, 1), device=device), sample_rate)
+    params = transform.transform_parameters
+    if op in BAND_FILTERS:
+        center, bandwidth = params["center_freq"], params["bandwidth"]
+        low = center * (1 - 0.5 * bandwidth) / sample_rate
+        high = center * (1 + 0.5 * bandwidth) / sample_rate
+        return low, high
+    return params["cutoff_freq"] / sample_rate, None
+
+
+def apply_filter_chains_(
+    samples, chains, transforms, aug_severity, sample_rate=16000, zeros=8
+):
+    """
+    Apply one chain of filters per example in place, in the frequency domain.
+
+    Arguments
+    ---------
+    samples: torch.Tensor
+        (N, T) tensor, modified in place
+    chains: list
+        N lists of filter augmentations (see filter_augmentations)
+    transforms: augmentations.AugmentationRegistry
+        registry providing the transforms whose parameter distributions are used
+    aug_severity: int
+        level of augmentation operation
+    sample_rate: int
+        audio sample rate
+    zeros: int
+        number of zero crossings of the windowed-sinc filters (julius default)
+
+    Returns
+    -------
+    samples
+    """
+    n, length = samples.shape
+    device = samples.device
+    # 1. sample the cutoffs of every filter, grouping examples per step and op
+    groups = []
+    total_half = torch.zeros(n, dtype=torch.long, device=device)
+    for step in range(max(len(chain) for chain in chains)):
+        per_op = {}
+        for i, chain in enumerate(chains):
+            if step < len(chain):
+                per_op.setdefault(chain[step], []).append(i)
+        for op, idx in per_op.items():
+            assert is_filter(op), "%s is not a filter augmentation" % op.__name__
+            idx = torch.tensor(idx, device=device)
+            transform = transforms.get(op, aug_severity, sample_rate)
+            low, high = sample_cutoffs(transform, op, len(idx), sample_rate, device)
+            half = half_sizes(low, zeros).to(device)
+            total_half[idx] += half
+            groups.append((op, idx, low, high, half))
+
+    # 2. the padding must cover the support of the whole chain
+    pad = int(total_half.max())
+    n_fft = next_fast_len(length + 2 * pad)
+
+    # 3. combined frequency response of each chain
+    response = torch.ones((n, n_fft // 2 + 1), device=device)
+    for op, idx, low, high, half in groups:
+        if op in BAND_FILTERS:
+            both = lowpass_responses(
+                torch.cat([low, high]), torch.cat([half, half]), n_fft
+            )
+            band = both[len(idx) :] - both[: len(idx)]
+            filter_response = band if op is band_pass_filter else 1 - band
+        else:
+            lowpass = lowpass_responses(low, half, n_fft)
+            filter_response = lowpass if op is low_pass_filter else 1 - lowpass
+        response[idx] *= filter_response
+
+    # 4. single FFT round trip over the replicate-padded batch
+    padded = F.pad(samples.unsqueeze(1), (pad, pad), mode="replicate").squeeze(1)
+    spectrum = torch.fft.rfft(padded, n=n_fft)
+    filtered = torch.fft.irfft(spectrum * response, n=n_fft)
+    samples.copy_(filtered[:, pad : pad + length])
+    return samples
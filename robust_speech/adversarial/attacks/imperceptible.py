@@ -15,6 +15,7 @@ from torch.autograd import Variable
 
 import robust_speech as rs
 from robust_speech.adversarial.attacks.attacker import Attacker
+from robust_speech.adversarial.utils import AttackGradScaler, attack_autocast
 
 
 class ImperceptibleASRAttack(Attacker):
@@ -268,6 +269,8 @@ class ImperceptibleASRAttack(Attacker):
         successful_adv_input: List[Optional["torch.Tensor"]] = [None] * local_batch_size
         trans = [None] * local_batch_size
 
+        # forward passes in mixed precision with auto_mix_prec, delta stays in float32
+        scaler = AttackGradScaler(self.asr_brain)
         for iter_1st_stage_idx in range(self.max_iter_1):
             # Zero the parameter gradients
             self.optimizer_1.zero_grad()
@@ -288,13 +291,15 @@ class ImperceptibleASRAttack(Attacker):
                 input_mask=input_mask,
                 real_lengths=real_lengths,
             )
-            loss.backward()
+            scaler.scale_loss(loss).backward()
+            grads = scaler.unscale(self.global_optimal_delta.grad)
 
             # Get sign of the gradients
-            self.global_optimal_delta.grad = torch.sign(self.global_optimal_delta.grad)
+            if grads is not None:
+                self.global_optimal_delta.grad = torch.sign(grads[0])
 
-            # Do optimization
-            self.optimizer_1.step()
+                # Do optimization
+                self.optimizer_1.step()
 
             # Save the best adversarial example and adjust the rescale
             # coefficient if successful
@@ -374,8 +379,11 @@ class ImperceptibleASRAttack(Attacker):
 
         # Compute loss and decoded output
         batch.sig = masked_adv_input, batch.sig[1]
-        predictions = self.asr_brain.compute_forward(batch, rs.Stage.ATTACK)
-        loss = self.asr_brain.compute_objectives(predictions, batch, rs.Stage.ATTACK)
+        with attack_autocast(self.asr_brain):
+            predictions = self.asr_brain.compute_forward(batch, rs.Stage.ATTACK)
+            loss = self.asr_brain.compute_objectives(
+                predictions, batch, rs.Stage.ATTACK
+            )
         self.asr_brain.module_eval()
         val_predictions = self.asr_brain.compute_forward(batch, sb.Stage.VALID)
         decoded_output = self.asr_brain.get_tokens(val_predictions)
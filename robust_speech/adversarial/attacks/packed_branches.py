@@ -0,0 +1,132 @@
+"""
+Reduced-precision storage of the augmented branches of AugMax.
+
+The branches are constant during the attack, only the mixing coefficients are
+optimized. They can be stored as float16/bfloat16, or as int16 PCM with one
+scale per branch and utterance, and are only upcast to float32 chunk by chunk
+inside the mix, forward and backward.
+"""
+
+import torch
+
+BRANCH_DTYPES = {
+    "float32": torch.float32,
+    "float16": torch.float16,
+    "bfloat16": torch.bfloat16,
+    "int16": torch.int16,
+}
+
+INT16_MAX = 32767
+
+
+class PackedBranches:
+    """
+    The clean batch and its augmented branches in reduced precision.
+
+    Arguments
+    ---------
+    clean: torch.Tensor
+        (N, T) clean batch, kept in float32
+    data: torch.Tensor
+        (W, N, T) augmented branches in the storage dtype
+    scale: Optional[torch.Tensor]
+        (W, N, 1) float32 scales of the int16 branches
+    """
+
+    def __init__(self, clean, data, scale=None):
+        self.clean = clean
+        self.data = data
+        self.scale = scale
+
+    @classmethod
+    def pack(cls, xs, dtype="float16"):
+        """
+        Pack the (W + 1, N, T) output of AugmentationEngine.aug_all.
+
+        Arguments
+        ---------
+        xs: torch.Tensor
+            [x_ori, x_aug1, x_aug2, ...]
+        dtype: str
+            one of BRANCH_DTYPES
+        """
+        if dtype not in BRANCH_DTYPES:
+            raise ValueError(
+                "branch dtype must be one of %s, got %s" % (list(BRANCH_DTYPES), dtype)
+            )
+        branches = xs[1:]
+        if dtype != "int16":
+            return cls(xs[0], branches.to(BRANCH_DTYPES[dtype]))
+        scale = branches.abs().amax(dim=-1, keepdim=True).clamp_min(1e-8) / INT16_MAX
+        data = torch.round(branches / scale).clamp_(-INT16_MAX, INT16_MAX)
+        return cls(xs[0], data.to(torch.int16), scale)
+
+    @property
+    def width(self):
+        return self.data.size(0)
+
+    def size(self, dim=None):
+        """Size of the equivalent (W + 1, N, T) tensor"""
+        size = torch.Size((self.width + 1,) + tuple(self.clean.shape))
+        return size if dim is None else size[dim]
+
+    def branches(self, start=0, end=None):
+        """Augmented branches upcast to float32, on samples [start, end)"""
+        data = self.data[..., start:end].float()
+        if self.scale is not None:
+            data = data * self.scale
+        return data
+
+    def unpack(self):
+        """Equivalent float32 (W + 1, N, T) tensor"""
+        return torch.cat([self.clean.unsqueeze(0).float(), self.branches()])
+
+    def nbytes(self):
+        """Memory used by the augmented branches"""
+        size = self.data.numel() * self.data.element_size()
+        if self.scale is not None:
+            size += self.scale.numel() * self.scale.element_size()
+        return size
+
+
+class PackedMix(torch.autograd.Function):
+    """
+    (1 - m) x_ori + m * sum_i w_i x_augi over packed branches. Branches are
+    upcast chunk by chunk, and only the packed branches are kept for the
+    backward pass (which gives gradients for m and w).
+    """
+
+    @staticmethod
+    def forward(ctx, clean, data, scale, m, w, chunk_size):
+        packed = PackedBranches(clean, data, scale)
+        out = torch.empty_like(clean, dtype=torch.float32)
+        m_ = m.view(-1, 1)
+        for start in range(0, clean.size(-1), chunk_size):
+            end = start + chunk_size
+            x_aug = torch.einsum("nw,wnt->nt", w, packed.branches(start, end))
+            x_ori = clean[:, start:end].float()
+            out[:, start:end] = x_ori + m_ * (x_aug - x_ori)
+        ctx.save_for_backward(clean, data, scale, m, w)
+        ctx.chunk_size = chunk_size
+        return out
+
+    @staticmethod
+    def backward(ctx, grad_output):
+        clean, data, scale, m, w = ctx.saved_tensors
+        packed = PackedBranches(clean, data, scale)
+        grad_m = torch.zeros_like(m, dtype=torch.float32)
+        grad_w = torch.zeros_like(w, dtype=torch.float32)
+        for start in range(0, clean.size(-1), ctx.chunk_size):
+            end = start + ctx.chunk_size
+            grad = grad_output[:, start:end].float()
+            branches = packed.branches(start, end)
+            x_aug = torch.einsum("nw,wnt->nt", w, branches)
+            grad_m += (grad * (x_aug - clean[:, start:end].float())).sum(dim=-1)
+            grad_w += torch.einsum("nt,wnt->nw", grad, branches)
+        grad_w = grad_w * m.view(-1, 1)
+        return None, None, None, grad_m.to(m.dtype), grad_w.to(w.dtype), None
+
+
+def packed_mix(packed, m, w, chunk_size=2 ** 16):
+    """Mix packed branches with explicit weights (see PackedMix)"""
+    return PackedMix.apply(packed.clean, packed.data, packed.scale, m, w, chunk_size)
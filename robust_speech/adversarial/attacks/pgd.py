@@ -2,6 +2,8 @@
 Variations of the PGD attack (https://arxiv.org/abs/1706.06083)
 """
 
+import logging
+
 import numpy as np
 import torch
 import torch.nn as nn
@@ -10,12 +12,17 @@ import sys
 sys.path.append('/root/class/cmu/DL/project/robust_speech')
 import robust_speech as rs
 from robust_speech.adversarial.attacks.attacker import Attacker
+from robust_speech.adversarial.attacks.replay_buffer import ReplayBuffer
 from robust_speech.adversarial.utils import (
+    AttackGradScaler,
+    attack_autocast,
     l2_clamp_or_normalize,
     linf_clamp,
     rand_assign,
 )
 
+logger = logging.getLogger(__name__)
+
 
 def reverse_bound_from_rel_bound(batch, rel, order=2):
     """From a relative eps bound, reconstruct the absolute bound for the given batch"""
@@ -28,6 +35,57 @@ def reverse_bound_from_rel_bound(batch, rel, order=2):
     return torch.tensor(epss).to(wavs.device)
 
 
+def pgd_step(
+    delta, grad, wav_init, eps, eps_iter, order=np.inf, clip_min=None, clip_max=None
+):
+    """
+    One projected gradient ascent step on the perturbation (in place).
+
+    Arguments
+    ---------
+    delta: torch.Tensor
+       (N, T) perturbation.
+    grad: torch.Tensor
+       (N, T) gradient of the loss with respect to delta.
+    wav_init: torch.Tensor
+       (N, T) unperturbed input.
+    eps: float or torch.Tensor
+       maximum distortion (global or per example).
+    eps_iter: float or torch.Tensor
+       attack step size (global or per example).
+    order: (optional) int
+       the order of maximum distortion (inf or 2).
+    clip_min: (optional) float
+       mininum value per input dimension.
+    clip_max: (optional) float
+       maximum value per input dimension.
+    """
+    if isinstance(eps_iter, torch.Tensor) and eps_iter.dim() == 1:
+        eps_iter = eps_iter.unsqueeze(1)
+    if order == np.inf:
+        grad_sign = grad.sign()
+        delta.data = delta.data + eps_iter * grad_sign
+        delta.data = linf_clamp(delta.data, eps)
+        delta.data = (
+            torch.clamp(wav_init.data + delta.data, clip_min, clip_max)
+            - wav_init.data
+        )
+
+    elif order == 2:
+        grad = l2_clamp_or_normalize(grad)
+        delta.data = delta.data + eps_iter * grad
+        delta.data = (
+            torch.clamp(wav_init.data + delta.data, clip_min, clip_max)
+            - wav_init.data
+        )
+        if eps is not None:
+            delta.data = l2_clamp_or_normalize(delta.data, eps)
+    else:
+        raise NotImplementedError(
+            "PGD attack only supports order=2 or order=np.inf"
+        )
+
+
 def pgd_loop(
     batch,
     asr_brain,
@@ -84,35 +142,27 @@ def pgd_loop(
         assert eps_iter.dim() == 1
         eps_iter = eps_iter.unsqueeze(1)
     delta.requires_grad_()
+    # forward passes in mixed precision with auto_mix_prec, delta stays in float32
+    scaler = AttackGradScaler(asr_brain)
     for _ in range(nb_iter):
         batch.sig = wav_init + delta, wav_lens
-        predictions = asr_brain.compute_forward(batch, rs.Stage.ATTACK)
-        loss = asr_brain.compute_objectives(predictions, batch, rs.Stage.ATTACK)
+        with attack_autocast(asr_brain):
+            predictions = asr_brain.compute_forward(batch, rs.Stage.ATTACK)
+            loss = asr_brain.compute_objectives(predictions, batch, rs.Stage.ATTACK)
         if minimize:
             loss = -loss
-        loss.backward()
-        if order == np.inf:
-            grad_sign = delta.grad.data.sign()
-            delta.data = delta.data + eps_iter * grad_sign
-            delta.data = linf_clamp(delta.data, eps)
-            delta.data = (
-                torch.clamp(wav_init.data + delta.data, clip_min, clip_max)
-                - wav_init.data
-            )
-
-        elif order == 2:
-            grad = delta.grad.data
-            grad = l2_clamp_or_normalize(grad)
-            delta.data = delta.data + eps_iter * grad
-            delta.data = (
-                torch.clamp(wav_init.data + delta.data, clip_min, clip_max)
-                - wav_init.data
-            )
-            if eps is not None:
-                delta.data = l2_clamp_or_normalize(delta.data, eps)
-        else:
-            raise NotImplementedError(
-                "PGD attack only supports order=2 or order=np.inf"
+        scaler.scale_loss(loss).backward()
+        grads = scaler.unscale(delta.grad.data)
+        if grads is not None:
+            pgd_step(
+                delta,
+                grads[0],
+                wav_init,
+                eps,
+                eps_iter,
+                order=order,
+                clip_min=clip_min,
+                clip_max=clip_max,
             )
         delta.grad.data.zero_()
         # print(loss)
@@ -150,6 +200,17 @@ class ASRPGDAttack(Attacker):
        if the attack is targeted.
     train_mode_for_backward: bool
        whether to force training mode in backward passes (necessary for RNN models)
+    replay_buffer: Optional[int]
+       size of a per-utterance replay buffer (see replay_buffer.py) of the
+       last perturbations of the training utterances. Buffered utterances
+       start from their perturbation instead of a random initialization
+       (disabled if None).
+    replay_iter: Optional[int]
+       number of refinement iterations for batches whose utterances are all
+       buffered (nb_iter if None).
+    replay_folder: Optional[str]
+       folder in which the buffered perturbations are saved (kept in memory
+       if None).
     """
 
     def __init__(
@@ -165,6 +226,9 @@ class ASRPGDAttack(Attacker):
         l1_sparsity=None,
         targeted=False,
         train_mode_for_backward=True,
+        replay_buffer=None,
+        replay_iter=None,
+        replay_folder=None,
     ):
 
         self.clip_min = clip_min if clip_min is not None else -10
@@ -178,6 +242,13 @@ class ASRPGDAttack(Attacker):
         self.asr_brain = asr_brain
         self.l1_sparsity = l1_sparsity
         self.train_mode_for_backward = train_mode_for_backward
+        self.replay_buffer = (
+            None
+            if replay_buffer is None
+            else ReplayBuffer(replay_buffer, folder=replay_folder)
+        )
+        self.replay_iter = replay_iter
+        self.iterations = []  # iterations used by each batch
 
         assert isinstance(self.rel_eps_iter, torch.Tensor) or isinstance(
             self.rel_eps_iter, float
@@ -217,11 +288,18 @@ class ASRPGDAttack(Attacker):
                 torch.clamp(wav_init + delta.data, min=clip_min, max=clip_max)
                 - wav_init
             )
+        nb_iter = self.nb_iter
+        # validation and test perturbations are neither buffered nor replayed
+        replay = self.replay_buffer is not None and self.training
+        if replay and self.replay(batch, delta):
+            if self.replay_iter is not None:
+                nb_iter = self.replay_iter
+        self.iterations.append(nb_iter)
 
         wav_adv = pgd_loop(
             batch,
             self.asr_brain,
-            nb_iter=self.nb_iter,
+            nb_iter=nb_iter,
             eps=self.eps,
             eps_iter=self.rel_eps_iter * self.eps,
             minimize=self.targeted,
@@ -231,12 +309,71 @@ class ASRPGDAttack(Attacker):
             delta_init=delta,
             l1_sparsity=self.l1_sparsity,
         )
+        if replay:
+            deltas = (wav_adv - wav_init).detach()
+            lengths = self.utterance_lengths(batch)
+            for i, utt_id in enumerate(batch.id):
+                self.replay_buffer.put(utt_id, deltas[i, : lengths[i]])
 
         batch.sig = save_input, batch.sig[1]
         batch = batch.to(save_device)
       #   self.asr_brain.module_eval()
         return wav_adv.data.to(save_device)
 
+    @staticmethod
+    def utterance_lengths(batch):
+        """Lengths in samples of the utterances of a batch"""
+        wavs, wav_lens = batch.sig
+        return [int(round(float(r) * wavs.size(1))) for r in wav_lens]
+
+    def replay(self, batch, delta):
+        """
+        Start the perturbations of the buffered utterances of a batch from
+        their last perturbation, projected on the current eps ball.
+
+        Arguments
+        ---------
+        batch : sb.PaddedBatch
+           The input batch to perturb
+        delta : torch.nn.Parameter
+           (N, T) initial perturbation, modified in place
+
+        Returns
+        -------
+        whether all the utterances of the batch were buffered
+        """
+        wav_init = batch.sig[0]
+        lengths = self.utterance_lengths(batch)
+        found = 0
+        for i, utt_id in enumerate(batch.id):
+            stored = self.replay_buffer.get(utt_id)
+            if stored is not None and stored.numel() == lengths[i]:
+                delta.data[i, : lengths[i]] = stored.to(delta.device)
+                found += 1
+        if self.order == np.inf:
+            delta.data = linf_clamp(delta.data, self.eps)
+        elif self.order == 2:
+            delta.data = l2_clamp_or_normalize(delta.data, self.eps)
+        delta.data = (
+            torch.clamp(wav_init + delta.data, self.clip_min, self.clip_max)
+            - wav_init
+        )
+        return found == len(batch.id)
+
+    def log_iterations(self):
+        """Log the iterations and replay buffer statistics and reset them"""
+        if self.iterations:
+            logger.info(
+                "PGD attack: %s"
+                % {
+                    "batches": len(self.iterations),
+                    "mean_iterations": float(np.mean(self.iterations)),
+                }
+            )
+        if self.replay_buffer is not None:
+            logger.info("PGD replay buffer: %s" % self.replay_buffer.stats())
+        self.iterations = []
+
 
 class ASRL2PGDAttack(ASRPGDAttack):
     """
@@ -261,6 +398,12 @@ class ASRL2PGDAttack(ASRPGDAttack):
        if the attack is targeted.
     train_mode_for_backward: bool
        whether to force training mode in backward passes (necessary for RNN models)
+    replay_buffer: Optional[int]
+       size of the replay buffer of the last perturbations (see ASRPGDAttack).
+    replay_iter: Optional[int]
+       number of iterations for batches whose utterances are all buffered.
+    replay_folder: Optional[str]
+       folder of the buffered perturbations (kept in memory if None).
     """
 
     def __init__(
@@ -274,6 +417,9 @@ class ASRL2PGDAttack(ASRPGDAttack):
         clip_max=None,
         targeted=False,
         train_mode_for_backward=True,
+        replay_buffer=None,
+        replay_iter=None,
+        replay_folder=None,
     ):
         order = 2
         super(ASRL2PGDAttack, self).__init__(
@@ -286,6 +432,9 @@ class ASRL2PGDAttack(ASRPGDAttack):
             clip_max=clip_max,
             targeted=targeted,
             train_mode_for_backward=train_mode_for_backward,
+            replay_buffer=replay_buffer,
+            replay_iter=replay_iter,
+            replay_folder=replay_folder,
             order=order,
         )
 
@@ -313,6 +462,12 @@ class ASRLinfPGDAttack(ASRPGDAttack):
        if the attack is targeted.
     train_mode_for_backward: bool
        whether to force training mode in backward passes (necessary for RNN models)
+    replay_buffer: Optional[int]
+       size of the replay buffer of the last perturbations (see ASRPGDAttack).
+    replay_iter: Optional[int]
+       number of iterations for batches whose utterances are all buffered.
+    replay_folder: Optional[str]
+       folder of the buffered perturbations (kept in memory if None).
     """
 
     def __init__(
@@ -326,6 +481,9 @@ class ASRLinfPGDAttack(ASRPGDAttack):
         clip_max=None,
         targeted=False,
         train_mode_for_backward=True,
+        replay_buffer=None,
+        replay_iter=None,
+        replay_folder=None,
     ):
         order = np.inf
         super(ASRLinfPGDAttack, self).__init__(
@@ -338,6 +496,9 @@ class ASRLinfPGDAttack(ASRPGDAttack):
             clip_max=clip_max,
             targeted=targeted,
             train_mode_for_backward=train_mode_for_backward,
+            replay_buffer=replay_buffer,
+            replay_iter=replay_iter,
+            replay_folder=replay_folder,
             order=order,
         )
 
@@ -366,6 +527,12 @@ class SNRPGDAttack(ASRL2PGDAttack):
        if the attack is targeted.
     train_mode_for_backward: bool
        whether to force training mode in backward passes (necessary for RNN models)
+    replay_buffer: Optional[int]
+       size of the replay buffer of the last perturbations (see ASRPGDAttack).
+    replay_iter: Optional[int]
+       number of iterations for batches whose utterances are all buffered.
+    replay_folder: Optional[str]
+       folder of the buffered perturbations (kept in memory if None).
     """
 
     def __init__(
@@ -379,6 +546,9 @@ class SNRPGDAttack(ASRL2PGDAttack):
         clip_max=None,
         targeted=False,
         train_mode_for_backward=True,
+        replay_buffer=None,
+        replay_iter=None,
+        replay_folder=None,
     ):
         super(SNRPGDAttack, self).__init__(
             asr_brain=asr_brain,
@@ -390,6 +560,9 @@ class SNRPGDAttack(ASRL2PGDAttack):
             clip_max=clip_max,
             targeted=targeted,
             train_mode_for_backward=train_mode_for_backward,
+            replay_buffer=replay_buffer,
+            replay_iter=replay_iter,
+            replay_folder=replay_folder,
         )
         assert isinstance(snr, int)
         self.rel_eps = torch.pow(torch.tensor(10.0), float(snr) / 20)
@@ -440,6 +613,12 @@ class MaxSNRPGDAttack(ASRLinfPGDAttack):
        if the attack is targeted.
     train_mode_for_backward: bool
        whether to force training mode in backward passes (necessary for RNN models)
+    replay_buffer: Optional[int]
+       size of the replay buffer of the last perturbations (see ASRPGDAttack).
+    replay_iter: Optional[int]
+       number of iterations for batches whose utterances are all buffered.
+    replay_folder: Optional[str]
+       folder of the buffered perturbations (kept in memory if None).
     """
 
     def __init__(
@@ -453,6 +632,9 @@ class MaxSNRPGDAttack(ASRLinfPGDAttack):
         clip_max=None,
         targeted=False,
         train_mode_for_backward=True,
+        replay_buffer=None,
+        replay_iter=None,
+        replay_folder=None,
     ):
         super(MaxSNRPGDAttack, self).__init__(
             asr_brain=asr_brain,
@@ -464,6 +646,9 @@ class MaxSNRPGDAttack(ASRLinfPGDAttack):
             clip_max=clip_max,
             targeted=targeted,
             train_mode_for_backward=train_mode_for_backward,
+            replay_buffer=replay_buffer,
+            replay_iter=replay_iter,
+            replay_folder=replay_folder,
         )
         assert isinstance(snr, int)
         self.rel_eps = torch.pow(torch.tensor(10.0), float(snr) / 20)
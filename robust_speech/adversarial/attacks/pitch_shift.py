@@ -0,0 +1,221 @@
+"""
+Batched pitch shift, a drop-in replacement for torch_audiomentations PitchShift.
+
+PitchShift processes examples one at a time and builds a new resampler and
+time stretcher for every example. Here examples are grouped by shift ratio,
+each group goes through the STFT, time stretching and resampling in a single
+batched call (with the STFT settings of torch_pitch_shift), and the resampling
+kernels, windows and phase advances are cached across calls.
+"""
+
+import math
+from fractions import Fraction
+
+import torch
+import torch.nn.functional as F
+from torchaudio.transforms import Resample
+from torch_pitch_shift import get_fast_shifts, semitones_to_ratio
+
+
+class BatchedPitchShift(torch.nn.Module):
+    """
+    Pitch-shift sounds up or down without changing the tempo.
+
+    Exposes the randomize_parameters/apply_transform interface of
+    torch_audiomentations transforms (mode="per_example", p=1).
+
+    Arguments
+    ---------
+    min_transpose_semitones: float
+        minimum pitch shift transposition in semitones.
+    max_transpose_semitones: float
+        maximum pitch shift transposition in semitones.
+    sample_rate: int
+        audio sample rate.
+    n_fft: Optional[int]
+        size of the STFT used for time stretching (sample_rate // 64 if None,
+        as torch_pitch_shift).
+    hop_length: Optional[int]
+        hop of the STFT used for time stretching (n_fft // 32 if None, as
+        torch_pitch_shift).
+    semitone_step: Optional[float]
+        if set, shifts are drawn from a grid of multiples of semitone_step
+        semitones within the transpose range instead of the "fast" ratios of
+        the sample rate (torch_pitch_shift.get_fast_shifts). Each grid point
+        is rounded to a ratio of small integers so that its resampling kernel
+        stays small.
+    max_denominator: int
+        largest denominator of the grid ratios.
+    """
+
+    def __init__(
+        self,
+        min_transpose_semitones=-4.0,
+        max_transpose_semitones=4.0,
+        sample_rate=16000,
+        n_fft=None,
+        hop_length=None,
+        semitone_step=None,
+        max_denominator=64,
+    ):
+        super(BatchedPitchShift, self).__init__()
+        if min_transpose_semitones > max_transpose_semitones:
+            raise ValueError("max_transpose_semitones must be > min_transpose_semitones")
+        self.sample_rate = sample_rate
+        self.n_fft = n_fft or sample_rate // 64
+        self.hop_length = hop_length or self.n_fft // 32
+        low = semitones_to_ratio(min_transpose_semitones)
+        high = semitones_to_ratio(max_transpose_semitones)
+        if semitone_step is None:
+            shifts = get_fast_shifts(
+                sample_rate, lambda x: x >= low and x <= high and x != 1
+            )
+        else:
+            # multiples of semitone_step within the transpose range
+            first = math.ceil(min_transpose_semitones / semitone_step - 1e-9)
+            last = math.floor(max_transpose_semitones / semitone_step + 1e-9)
+            shifts = {
+                self._grid_ratio(k * semitone_step, low, high, max_denominator)
+                for k in range(first, last + 1)
+                if k != 0
+            }
+            shifts.discard(Fraction(1))
+        if not len(shifts):
+            raise ValueError("No pitch-shift ratio in the given transpose range.")
+        self.shifts = sorted(shifts)
+        self.transform_parameters = {}
+        self._windows = {}
+        self._phase_advances = {}
+        self._resamplers = {}
+
+    @staticmethod
+    def _grid_ratio(semitones, low, high, max_denominator):
+        """Ratio of small integers closest to a shift, kept within
+        [low, high]"""
+        target = 2.0 ** (semitones / 12)
+        ratio = Fraction(target).limit_denominator(max_denominator)
+        if ratio < low:
+            candidates = [
+                Fraction(math.ceil(low * d), d) for d in range(1, max_denominator + 1)
+            ]
+        elif ratio > high:
+            candidates = [
+                Fraction(math.floor(high * d), d)
+                for d in range(1, max_denominator + 1)
+            ]
+        else:
+            return ratio
+        return min(candidates, key=lambda c: abs(c - Fraction(target)))
+
+    def _window(self, device):
+        window = self._windows.get(device)
+        if window is None:
+            # rectangular window, as torch_pitch_shift
+            window = torch.ones(self.n_fft, device=device)
+            self._windows[device] = window
+        return window
+
+    def _phase_advance(self, n_freq, device):
+        key = (n_freq, device)
+        phase_advance = self._phase_advances.get(key)
+        if phase_advance is None:
+            phase_advance = torch.linspace(
+                0, math.pi * self.hop_length, n_freq, device=device
+            )[..., None]
+            self._phase_advances[key] = phase_advance
+        return phase_advance
+
+    def _stretch(self, spec, rate, phase_advance):
+        """
+        Same as torchaudio.functional.phase_vocoder, but the phases and
+        magnitudes of the input frames are computed once instead of once per
+        output frame (twice as many when stretching).
+        """
+        spec = F.pad(spec, [0, 2])
+        phase, norm = spec.angle(), spec.abs()
+        time_steps = torch.arange(
+            0, spec.size(-1) - 2, rate, device=spec.device, dtype=norm.dtype
+        )
+        index = time_steps.long()
+        alphas = time_steps - index
+        delta = phase[..., 1:] - phase[..., :-1] - phase_advance
+        delta = delta - 2 * math.pi * torch.round(delta / (2 * math.pi))
+        delta = delta + phase_advance
+        phase_acc = torch.cat(
+            [phase[..., :1], delta.index_select(-1, index[:-1])], dim=-1
+        ).cumsum(-1)
+        norm_0 = norm.index_select(-1, index)
+        mag = torch.lerp(norm_0, norm.index_select(-1, index + 1), alphas)
+        return torch.polar(mag, phase_acc)
+
+    def _resample(self, waveform, shift):
+        """Resample by 1 / shift with a cached torchaudio Resample module"""
+        key = (shift, waveform.device, waveform.dtype)
+        resampler = self._resamplers.get(key)
+        if resampler is None:
+            # same frequencies as torch_pitch_shift, Resample precomputes its
+            # sinc kernel at construction
+            resampler = Resample(
+                self.sample_rate,
+                int(self.sample_rate / shift),
+                dtype=waveform.dtype,
+            ).to(waveform.device)
+            self._resamplers[key] = resampler
+        return resampler(waveform)
+
+    def randomize_parameters(self, samples=None, sample_rate=None, **kwargs):
+        """Draw one shift ratio per example of a (N, C, T) batch"""
+        n = samples.size(0)
+        choice = torch.randint(len(self.shifts), (n,)).tolist()
+        self.transform_parameters["transpositions"] = [self.shifts[i] for i in choice]
+
+    def apply_transform(self, samples=None, sample_rate=None, **kwargs):
+        """
+        Pitch-shift a (N, C, T) batch in place, with the ratios drawn by
+        randomize_parameters.
+        """
+        if sample_rate is not None and sample_rate != self.sample_rate:
+            raise ValueError(
+                "sample_rate must match the value of sample_rate "
+                + "passed into the BatchedPitchShift constructor"
+            )
+        batch_size, channels, length = samples.shape
+        device = samples.device
+        waveforms = samples.reshape(batch_size * channels, length)
+        window = self._window(device)
+        phase_advance = self._phase_advance(self.n_fft // 2 + 1, device)
+
+        groups = {}
+        for i, shift in enumerate(self.transform_parameters["transpositions"]):
+            groups.setdefault(shift, []).append(i)
+        for shift, idx in groups.items():
+            if len(idx) == batch_size:
+                idx, group = None, waveforms
+            else:
+                idx = torch.tensor(idx, device=device)
+                if channels > 1:
+                    channel = torch.arange(channels, device=device)
+                    idx = (idx[:, None] * channels + channel).flatten()
+                group = waveforms.index_select(0, idx)
+            spec = torch.stft(
+                group, self.n_fft, self.hop_length, window=window, return_complex=True
+            )
+            stretched = self._stretch(spec, float(1 / shift), phase_advance)
+            output = torch.istft(stretched, self.n_fft, self.hop_length, window=window)
+            output = self._resample(output, shift)
+            if output.size(-1) >= length:
+                output = output[:, :length]
+            else:
+                output = F.pad(output, (0, length - output.size(-1)))
+            if idx is None:
+                waveforms.copy_(output)
+            else:
+                waveforms.index_copy_(0, idx, output.to(waveforms.dtype))
+        if waveforms.data_ptr() != samples.data_ptr():
+            samples.copy_(waveforms.view_as(samples))
+        return samples
+
+    def forward(self, samples, sample_rate=None):
+        """Randomize the shifts and apply them to a (N, C, T) batch"""
+        self.randomize_parameters(samples, sample_rate)
+        return self.apply_transform(samples, sample_rate)
@@ -0,0 +1,107 @@
+"""
+Replay buffer of the PGD perturbations of the training utterances.
+
+The last perturbation of each utterance is kept across epochs so that the next
+attack of the utterance can start from it and only run a few refinement
+iterations instead of a full attack from a random initialization.
+Perturbations are kept in memory, or saved in a folder with only their index
+in memory.
+"""
+
+import os
+
+import torch
+
+from robust_speech.adversarial.attacks.utterance_cache import UtteranceCache
+
+STORAGE_DTYPES = {
+    "float32": torch.float32,
+    "float16": torch.float16,
+    "bfloat16": torch.bfloat16,
+}
+
+
+class ReplayBuffer(UtteranceCache):
+    """
+    Bounded per-utterance buffer of perturbations with least-recently-used
+    eviction.
+
+    Arguments
+    ---------
+    max_size: int
+        maximal number of utterances kept.
+    max_bytes: Optional[int]
+        maximal size of the stored perturbations (unbounded if None).
+    folder: Optional[str]
+        folder in which perturbations are saved (created if needed). They are
+        kept in memory if None.
+    dtype: str
+        storage dtype of the perturbations, one of STORAGE_DTYPES.
+    """
+
+    def __init__(self, max_size=300000, max_bytes=None, folder=None, dtype="float32"):
+        if dtype not in STORAGE_DTYPES:
+            raise ValueError(
+                "storage dtype must be one of %s, got %s"
+                % (list(STORAGE_DTYPES), dtype)
+            )
+        super(ReplayBuffer, self).__init__(max_size)
+        self.max_bytes = max_bytes
+        self.folder = folder
+        self.dtype = STORAGE_DTYPES[dtype]
+        if folder is not None:
+            os.makedirs(folder, exist_ok=True)
+        # entries are (perturbation or file path, size in bytes)
+        self.nbytes = 0
+
+    def _path(self, utt_id):
+        return os.path.join(self.folder, "%s.pt" % utt_id.replace(os.sep, "_"))
+
+    def get(self, utt_id):
+        """The float32 perturbation of an utterance (None if not stored)"""
+        entry = self._lookup(utt_id)
+        if entry is None:
+            return None
+        delta = entry[0] if self.folder is None else torch.load(entry[0])
+        return delta.float()
+
+    def put(self, utt_id, delta):
+        """
+        Store the perturbation of an utterance.
+
+        Arguments
+        ---------
+        utt_id: str
+            utterance id
+        delta: torch.Tensor
+            (T,) perturbation of the utterance, without padding
+        """
+        self._discard(utt_id)
+        delta = delta.detach().to("cpu", self.dtype)
+        size = delta.numel() * delta.element_size()
+        if self.folder is None:
+            entry = (delta, size)
+        else:
+            entry = (self._path(utt_id), size)
+            torch.save(delta.clone(), entry[0])
+        self.nbytes += size
+        self._store(utt_id, entry)
+
+    def _full(self):
+        return super(ReplayBuffer, self)._full() or (
+            self.max_bytes is not None and self.nbytes > self.max_bytes
+        )
+
+    def _discard(self, utt_id):
+        entry = super(ReplayBuffer, self)._discard(utt_id)
+        if entry is not None:
+            self.nbytes -= entry[1]
+            if self.folder is not None and os.path.exists(entry[0]):
+                os.remove(entry[0])
+        return entry
+
+    def stats(self):
+        """Size and hit rate of the buffer"""
+        stats = super(ReplayBuffer, self).stats()
+        stats["bytes"] = self.nbytes
+        return stats
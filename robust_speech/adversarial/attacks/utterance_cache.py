@@ -0,0 +1,67 @@
+"""
+Bounded per-utterance map with least-recently-used eviction, the base of the
+caches that keep attack state across epochs (warm_start.py, replay_buffer.py).
+"""
+
+from collections import OrderedDict
+
+
+class UtteranceCache:
+    """
+    Bounded per-utterance map with least-recently-used eviction. Subclasses
+    define the stored entries and may bound the cache further by overriding
+    _full and release the resources of evicted entries in _discard.
+
+    Arguments
+    ---------
+    max_size: int
+        maximal number of utterances kept.
+    """
+
+    def __init__(self, max_size=300000):
+        self.max_size = max_size
+        self._entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, utt_id):
+        return utt_id in self._entries
+
+    def _lookup(self, utt_id):
+        """The entry of an utterance, marked as recently used (None if not
+        stored)"""
+        entry = self._entries.get(utt_id)
+        if entry is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self._entries.move_to_end(utt_id)
+        return entry
+
+    def _store(self, utt_id, entry):
+        """Store the entry of an utterance and evict the least recently used
+        ones while the cache is full"""
+        self._discard(utt_id)
+        self._entries[utt_id] = entry
+        while self._full():
+            self._discard(next(iter(self._entries)))
+
+    def _full(self):
+        return len(self._entries) > self.max_size
+
+    def _discard(self, utt_id):
+        """Remove the entry of an utterance (if stored) and return it"""
+        return self._entries.pop(utt_id, None)
+
+    def stats(self):
+        """Size and hit rate of the cache"""
+        lookups = max(self.hits + self.misses, 1)
+        return {
+            "size": len(self._entries),
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups,
+        }
@@ -0,0 +1,47 @@
+"""
+Warm-start cache of the AugMax mixing parameters.
+
+The optimized (m, q) of an utterance, and the augmentation chains of its
+branches, are kept across epochs so that the next attack of the utterance
+can start from them instead of a random initialization.
+"""
+
+from collections import namedtuple
+
+from robust_speech.adversarial.attacks.utterance_cache import UtteranceCache
+
+WarmStart = namedtuple("WarmStart", ["m", "q", "chains"])
+
+
+class WarmStartCache(UtteranceCache):
+    """
+    Bounded per-utterance cache of WarmStart entries with least-recently-used
+    eviction.
+
+    Arguments
+    ---------
+    max_size: int
+        maximal number of utterances kept.
+    """
+
+    def get(self, utt_id):
+        """The WarmStart of an utterance (None if not cached)"""
+        return self._lookup(utt_id)
+
+    def put(self, utt_id, m, q, chains=None):
+        """
+        Store the parameters of an utterance.
+
+        Arguments
+        ---------
+        utt_id: str
+            utterance id
+        m: torch.Tensor
+            scalar mixing weight of the augmented branches
+        q: torch.Tensor
+            (width,) logits of the branch weights
+        chains: Optional[list]
+            the augmentation chain of each branch (None if the chains are
+            shared by the batch and cannot be replayed per utterance)
+        """
+        self._store(utt_id, WarmStart(m.detach().cpu(), q.detach().cpu(), chains))
@@ -2,14 +2,15 @@
 Multiple Brain classes that extend sb.Brain to enable attacks.
 """
 
+import contextlib
 import logging
 import time
 import warnings
 
 import speechbrain as sb
 import torch
-import torch.nn.functional as F
 from speechbrain.dataio.dataloader import LoopedLoader
+from speechbrain.processing.features import spectral_magnitude
 from speechbrain.utils.distributed import run_on_main
 from torch.utils.data import DataLoader
 from tqdm import tqdm
@@ -18,7 +19,15 @@ import sys
 sys.path.append('/root/class/cmu/DL/project/robust_speech')
 import robust_speech as rs
 from robust_speech.adversarial.attacks.attacker import Attacker
-from robust_speech.adversarial.utils import replace_tokens_in_batch
+from robust_speech.adversarial.attacks.augmentation_pipeline import AugmentationPipeline
+from robust_speech.adversarial.attacks.pgd import (
+    pgd_step,
+    reverse_bound_from_rel_bound,
+)
+from robust_speech.adversarial.losses import jsd_consistency
+from robust_speech.adversarial.producer import AdversarialProducer
+from robust_speech.adversarial.scheduler import AttackScheduler
+from robust_speech.adversarial.utils import repeat_batch, replace_tokens_in_batch
 
 warnings.simplefilter("once", RuntimeWarning)
 
@@ -56,6 +65,64 @@ class ASRBrain(sb.Brain):
         """
         raise NotImplementedError
 
+    def compute_stft(self, wavs):
+        """
+        Complex STFT of waveforms, as computed by the Fbank features of the
+        model (hparams.compute_features). The STFT is linear, so attacks that
+        only mix fixed inputs can mix their spectra instead of the waveforms
+        and skip the STFTs with compute_forward_from_stft.
+
+        Arguments
+        ---------
+        wavs : torch.Tensor
+            (N, T) waveforms
+
+        Returns
+        -------
+        torch.Tensor
+            (N, frames, n_fft // 2 + 1, 2) real and imaginary parts
+        """
+        compute_stft = getattr(self.hparams.compute_features, "compute_STFT", None)
+        if compute_stft is None:
+            raise ValueError(
+                "STFT-domain inputs require Fbank features, got %s"
+                % type(self.hparams.compute_features).__name__
+            )
+        return compute_stft(wavs)
+
+    def compute_features_from_stft(self, stft):
+        """Fbank features (hparams.compute_features) from the output of
+        compute_stft, with the same steps as sb.lobes.features.Fbank"""
+        fbank = self.hparams.compute_features
+        feats = fbank.compute_fbanks(spectral_magnitude(stft))
+        if fbank.deltas:
+            delta1 = fbank.compute_deltas(feats)
+            delta2 = fbank.compute_deltas(delta1)
+            feats = torch.cat([feats, delta1, delta2], dim=2)
+        if fbank.context:
+            feats = fbank.context_window(feats)
+        return feats
+
+    def compute_forward_from_stft(self, stft, batch, stage):
+        """Forward pass from the STFT of the inputs (see compute_stft)
+        instead of batch.sig, to be overridden by sub-classes.
+
+        Arguments
+        ---------
+        stft : torch.Tensor
+            output of compute_stft for the inputs of the batch
+        batch : torch.Tensor or tensors
+            An element from the dataloader (batch.sig[1] gives the lengths).
+        stage : Union[sb.Stage, rs.Stage]
+            The stage of the experiment
+
+        Returns
+        -------
+        torch.Tensor or Tensors
+            The outputs of compute_forward.
+        """
+        raise NotImplementedError
+
     def compute_objectives(
         self, predictions, batch, stage, adv=False, targeted=False, reduction="mean"
     ):
@@ -85,6 +152,182 @@ class ASRBrain(sb.Brain):
         """
         raise NotImplementedError
 
+    def accumulation_steps(self):
+        """Number of micro-batches whose gradients are accumulated before each
+        optimizer step (hparams.gradient_accumulation, 1 if not set)"""
+        return max(int(getattr(self.hparams, "gradient_accumulation", 1) or 1), 1)
+
+    def reset_accumulation(self):
+        """Forget the micro-batches accumulated since the last optimizer step"""
+        self.micro_batches = 0
+        self.micro_batch_samples = 0
+        self.micro_batch_loss = 0.0
+        self.micro_batch_steps = 1
+
+    def accumulate_gradients(self, loss, batch_size, accumulation_steps=None):
+        """
+        Gradient-accumulation engine shared by the fit_batch methods: backward
+        pass of the loss of a micro-batch, divided by the number k of
+        accumulation steps (and scaled by the GradScaler with automatic mixed
+        precision), and an optimizer step every k micro-batches
+        (see step_accumulated).
+
+        Arguments
+        ---------
+        loss : torch.Tensor
+            loss of the micro-batch
+        batch_size : int
+            number of utterances in the micro-batch
+        accumulation_steps : Optional[int]
+            k, accumulation_steps() if None
+
+        Returns
+        -------
+        whether the optimizer stepped on this micro-batch
+        """
+        if not hasattr(self, "micro_batches"):
+            self.reset_accumulation()
+        steps = accumulation_steps or self.accumulation_steps()
+        if self.auto_mix_prec:
+            self.scaler.scale(loss / steps).backward()
+        else:
+            (loss / steps).backward()
+        self.micro_batches += 1
+        self.micro_batch_samples += batch_size
+        # non-finite if the loss of any micro-batch is
+        self.micro_batch_loss = self.micro_batch_loss + loss.detach()
+        self.micro_batch_steps = steps
+        if self.micro_batches < steps:
+            return False
+        self.step_accumulated()
+        return True
+
+    def step_accumulated(self):
+        """
+        Optimizer step on the accumulated gradients, after gradient checks
+        and clipping (on unscaled gradients with automatic mixed precision).
+        If fewer micro-batches than accumulation steps were accumulated (at
+        the end of an epoch), their gradients are rescaled to a mean.
+        """
+        if not getattr(self, "micro_batches", 0):
+            return
+        if self.micro_batches < self.micro_batch_steps:
+            scale = self.micro_batch_steps / self.micro_batches
+            for param in self.modules.parameters():
+                if param.grad is not None:
+                    param.grad.mul_(scale)
+        loss = self.micro_batch_loss / self.micro_batches
+        if self.auto_mix_prec:
+            self.scaler.unscale_(self.optimizer)
+            if self.check_gradients(loss):
+                self.scaler.step(self.optimizer)
+            self.scaler.update()
+        elif self.check_gradients(loss):
+            self.optimizer.step()
+        self.optimizer.zero_grad()
+        self.optimizer_steps = getattr(self, "optimizer_steps", 0) + 1
+        self.step_samples = getattr(self, "step_samples", 0) + self.micro_batch_samples
+        self.reset_accumulation()
+
+    def log_accumulation(self):
+        """Log the optimizer steps since the last call and their mean effective
+        batch size (utterances per step), and reset them"""
+        steps = getattr(self, "optimizer_steps", 0)
+        if steps:
+            logger.info(
+                "gradient accumulation: %s"
+                % {
+                    "optimizer_steps": steps,
+                    "accumulation_steps": self.accumulation_steps(),
+                    "effective_batch_size": self.step_samples / steps,
+                }
+            )
+        self.optimizer_steps = 0
+        self.step_samples = 0
+
+    def free_replays(self):
+        """Number of replays of each batch in free adversarial training
+        (hparams.free_replays, 1 if not set)"""
+        return getattr(self.hparams, "free_replays", None) or 1
+
+    def init_attack_scheduler(self, checkpointer=None):
+        """
+        Create the scheduler of the attack strength used for adversarial
+        training if hparams.attack_schedule is set (see scheduler.py), and
+        register it in the checkpointer to resume the loss_gap schedule.
+
+        Arguments
+        ---------
+        checkpointer : Optional[speechbrain.Checkpointer]
+            the checkpointer of the brain
+        """
+        self.attack_scheduler = None
+        schedule = getattr(self.hparams, "attack_schedule", None)
+        if getattr(self, "attacker", None) is None or schedule is None:
+            return
+        self.attack_scheduler = AttackScheduler(
+            [self.attacker],
+            schedule=schedule,
+            start=getattr(self.hparams, "attack_schedule_start", 0.25),
+            warmup_epochs=getattr(self.hparams, "attack_warmup_epochs", 5),
+            cycle_epochs=getattr(self.hparams, "attack_cycle_epochs", 4),
+            gap_threshold=getattr(self.hparams, "attack_gap_threshold", 0.1),
+            gap_step=getattr(self.hparams, "attack_gap_step", 0.25),
+            forward_budget=getattr(self.hparams, "attack_forward_budget", None),
+            min_iter=getattr(self.hparams, "attack_min_iter", 1),
+            schedule_eps=getattr(self.hparams, "attack_schedule_eps", True),
+            # branches shared with AugMix have the width of the AugMix engine
+            schedule_width=not getattr(self.hparams, "share_branches", False),
+        )
+        if checkpointer is not None:
+            checkpointer.add_recoverable("attack_scheduler", self.attack_scheduler)
+
+    def init_adversarial_producer(self):
+        """
+        Create the producer computing the adversarial examples of the next
+        training batches in a background thread, with a snapshot of the model
+        refreshed every hparams.async_refresh_every steps, if
+        hparams.async_attack is set (see producer.py). Free adversarial
+        training replays each batch with the current model instead of
+        attacking it, so it cannot be combined with async_attack.
+        """
+        self.adversarial_producer = None
+        if getattr(self, "attacker", None) is None or not getattr(
+            self.hparams, "async_attack", False
+        ):
+            return
+        if self.free_replays() > 1:
+            raise ValueError("async_attack cannot be combined with free_replays")
+        self.adversarial_producer = AdversarialProducer(
+            self.attacker,
+            refresh_every=getattr(self.hparams, "async_refresh_every", 10),
+            queue_size=getattr(self.hparams, "async_queue_size", 2),
+            max_staleness=getattr(self.hparams, "async_max_staleness", None),
+        )
+
+    @contextlib.contextmanager
+    def training_batches(self, train_set):
+        """
+        Context of the batches of a training epoch, whose adversarial
+        examples are computed ahead by the adversarial producer if there is
+        one. The producer is stopped when the context exits, also on errors.
+
+        Arguments
+        ---------
+        train_set : DataLoader
+            the training batches of the epoch
+        """
+        if getattr(self, "adversarial_producer", None) is None:
+            yield train_set
+            return
+        # adversarial examples of the next batches are computed ahead
+        batches = self.adversarial_producer.produce(train_set)
+        try:
+            yield batches
+        finally:
+            batches.close()  # stop the producer
+        self.adversarial_producer.log_stats()
+
     def module_train(self):
         """
         Set PyTorch modules to training mode
@@ -313,6 +556,8 @@ class AdvASRBrain(ASRBrain):
             attacker=attacker,
         )
         self.tokenizer = None
+        self.adversarial_producer = None
+        self.init_attack_scheduler(checkpointer)
 
     def __setattr__(self, name, value, attacker_brain=True):
         """Maintain similar attributes for the main and nested brain"""
@@ -378,8 +623,11 @@ class AdvASRBrain(ASRBrain):
         wavs = batch.sig[0]
         if self.attacker is not None:
             batch = batch.to(self.device)
+            self.attacker.training = stage == sb.Stage.TRAIN
             if stage == sb.Stage.TEST:
                 adv_wavs = self.attacker.perturb_and_log(batch)
+            elif stage == sb.Stage.TRAIN and self.adversarial_producer is not None:
+                adv_wavs = self.adversarial_producer.adversarial_wavs(batch)
             else:
                 adv_wavs = self.attacker.perturb(batch)
             adv_wavs = adv_wavs.detach()
@@ -410,32 +658,10 @@ class AdvASRBrain(ASRBrain):
         detached loss
         """
         # Managing automatic mixed precision
-        if self.auto_mix_prec:
-            self.optimizer.zero_grad()
-            with torch.cuda.amp.autocast():
-                outputs = self.compute_forward(batch, sb.Stage.TRAIN)
-                loss = self.compute_objectives(outputs, batch, sb.Stage.TRAIN)
-            self.scaler.scale(loss).backward()
-            self.scaler.unscale_(self.optimizer)
-            if self.check_gradients(loss):
-                self.scaler.step(self.optimizer)
-            self.scaler.update()
-        else:
+        with torch.cuda.amp.autocast(enabled=self.auto_mix_prec):
             outputs = self.compute_forward(batch, sb.Stage.TRAIN)
             loss = self.compute_objectives(outputs, batch, sb.Stage.TRAIN, adv=False)
-
-            # normalize the loss by gradient_accumulation step
-            (loss / self.hparams.gradient_accumulation).backward()
-            if self.step % self.hparams.gradient_accumulation == 0:
-                # gradient clipping & early stop if loss is not fini
-                self.check_gradients(loss)
-                self.optimizer.step()
-                self.optimizer.zero_grad()
-
-            if self.check_gradients(loss):
-                self.optimizer.step()
-            self.optimizer.zero_grad()
-
+        self.accumulate_gradients(loss, batch.batchsize)
         return loss.detach().cpu()
 
     def fit_batch_adversarial(self, batch):
@@ -468,32 +694,79 @@ class AdvASRBrain(ASRBrain):
         #     RuntimeWarning,
         # )
         # Managing automatic mixed precision
-        if self.auto_mix_prec:
-            self.optimizer.zero_grad()
-            with torch.cuda.amp.autocast():
-                outputs, _ = self.compute_forward_adversarial(batch, sb.Stage.TRAIN)
-                loss = self.compute_objectives(outputs, batch, sb.Stage.TRAIN)
-            self.scaler.scale(loss).backward()
-            self.scaler.unscale_(self.optimizer)
-            if self.check_gradients(loss):
-                self.scaler.step(self.optimizer)
-            self.scaler.update()
-        else:
+        with torch.cuda.amp.autocast(enabled=self.auto_mix_prec):
             outputs, _ = self.compute_forward_adversarial(batch, sb.Stage.TRAIN)
             loss = self.compute_objectives(outputs, batch, sb.Stage.TRAIN, adv=True)
+        self.accumulate_gradients(loss, batch.batchsize)
+        return loss.detach().cpu()
 
-            # normalize the loss by gradient_accumulation step
-            (loss / self.hparams.gradient_accumulation).backward()
-            if self.step % self.hparams.gradient_accumulation == 0:
-                # gradient clipping & early stop if loss is not fini
-                self.check_gradients(loss)
-                self.optimizer.step()
-                self.optimizer.zero_grad()
+    def fit_batch_free(self, batch):
+        """Fit one batch with "free" adversarial training
+        (https://arxiv.org/abs/1904.12843).
+
+        The batch is replayed hparams.free_replays times. The backward pass
+        of each replay gives both the gradients of the model, for an
+        optimizer step, and the gradient of the perturbation, for an attack
+        step, so that there is no separate attack loop. The perturbation is
+        kept from one replay to the next. To train on the same number of
+        batches as without replays, divide the number of epochs by
+        free_replays.
+
+        The perturbation is bounded like that of the attacker (a PGD attack):
+        each replay takes a step of size attacker.eps along the sign (Linf)
+        or the normalized (L2) gradient, and projects on the eps ball. The
+        forward passes run in the attack stage, in which the gradients reach
+        the inputs: the train-time corruptions (env_corrupt) and
+        augmentations are not applied and the input normalization statistics
+        are frozen.
+
+        Each replay takes its own optimizer step, so free training cannot be
+        combined with gradient accumulation (hparams.gradient_accumulation).
 
-            if self.check_gradients(loss):
-                self.optimizer.step()
-            self.optimizer.zero_grad()
+        Arguments
+        ---------
+        batch : list of torch.Tensors
+            Batch of data to use for training. Default implementation assumes
+            this batch has two elements: inputs and targets.
 
+        Returns
+        -------
+        detached loss of the last replay
+        """
+        if not hasattr(self.attacker, "order"):
+            raise ValueError("free adversarial training requires a PGD attacker")
+        if self.accumulation_steps() > 1:
+            raise ValueError(
+                "free adversarial training does not support gradient accumulation"
+            )
+        batch = batch.to(self.device)
+        wavs, wav_lens = batch.sig
+        order = self.attacker.order
+        eps = self.attacker.eps
+        if hasattr(self.attacker, "rel_eps"):  # SNR bounds
+            eps = reverse_bound_from_rel_bound(batch, self.attacker.rel_eps, order)
+        delta = torch.zeros_like(wavs, requires_grad=True)
+        self.step_accumulated()
+        for _ in range(self.free_replays()):
+            batch.sig = wavs + delta, wav_lens
+            with torch.cuda.amp.autocast(enabled=self.auto_mix_prec):
+                outputs = self.compute_forward(batch, rs.Stage.ATTACK)
+                loss = self.compute_objectives(outputs, batch, rs.Stage.ATTACK)
+            # one optimizer step per replay, the perturbation keeps its gradient
+            self.accumulate_gradients(loss, batch.batchsize, accumulation_steps=1)
+            grad = torch.nan_to_num(delta.grad.data, nan=0.0, posinf=0.0, neginf=0.0)
+            pgd_step(
+                delta,
+                grad,
+                wavs,
+                eps,
+                eps,
+                order=order,
+                clip_min=self.attacker.clip_min,
+                clip_max=self.attacker.clip_max,
+            )
+            delta.grad = None
+        batch.sig = wavs, wav_lens
         return loss.detach().cpu()
 
     def evaluate_batch_adversarial(self, batch, stage, target=None):
@@ -619,6 +892,15 @@ class AdvASRBrain(ASRBrain):
             )
 
         self.on_fit_start()
+        if self.adversarial_producer is None:
+            self.init_adversarial_producer()
+            if (
+                self.adversarial_producer is not None
+                and self.attack_scheduler is not None
+            ):
+                self.attack_scheduler.add_listener(
+                    self.adversarial_producer.set_attack_settings
+                )
 
         if progressbar is None:
             progressbar = not self.noprogressbar
@@ -637,20 +919,30 @@ class AdvASRBrain(ASRBrain):
             ):
                 self.train_sampler.set_epoch(epoch)
 
+            if self.attack_scheduler is not None:
+                self.attack_scheduler.on_epoch_start(epoch, len(train_set))
+
             # Time since last intra-epoch checkpoint
             last_ckpt_time = time.time()
 
             # Only show progressbar if requested and main_process
             enable = progressbar and sb.utils.distributed.if_main_process()
-            with tqdm(
-                train_set,
+            with self.training_batches(train_set) as train_batches, tqdm(
+                train_batches,
                 initial=self.step,
+                total=len(train_set),
                 dynamic_ncols=True,
                 disable=not enable,
             ) as pbar:
                 for batch in pbar:
                     self.step += 1
-                    if self.attacker is not None:
+                    if self.attack_scheduler is not None:
+                        self.attack_scheduler.on_step(
+                            self.free_replays() if self.free_replays() > 1 else None
+                        )
+                    if self.attacker is not None and self.free_replays() > 1:
+                        loss = self.fit_batch_free(batch)
+                    elif self.attacker is not None:
                         loss = self.fit_batch_adversarial(batch)
                     else:
                         loss = self.fit_batch(batch)
@@ -680,6 +972,15 @@ class AdvASRBrain(ASRBrain):
                             self._save_intra_epoch_ckpt()
                         last_ckpt_time = time.time()
 
+            if hasattr(self.attacker, "log_iterations"):
+                self.attacker.log_iterations()
+            if self.attack_scheduler is not None:
+                self.attack_scheduler.on_epoch_end()
+
+            # step on the micro-batches left at the end of the epoch
+            self.step_accumulated()
+            self.log_accumulation()
+
             # Run train "on_stage_end" on all processes
             self.on_stage_end(sb.Stage.TRAIN, self.avg_train_loss, epoch)
             self.avg_train_loss = 0.0
@@ -709,6 +1010,11 @@ class AdvASRBrain(ASRBrain):
                     if self.debug and self.step == self.debug_batches:
                         break
 
+                if self.attack_scheduler is not None:
+                    self.attack_scheduler.on_validation_end(
+                        avg_valid_loss, avg_valid_adv_loss
+                    )
+
                 # Only run validation "on_stage_end" on main process
                 self.step = 0
                 run_on_main(
@@ -721,6 +1027,10 @@ class AdvASRBrain(ASRBrain):
             if self.debug and epoch == self.debug_epochs:
                 break
 
+        if self.attack_scheduler is not None:
+            # evaluation attacks run at full strength
+            self.attack_scheduler.restore()
+
     def evaluate(
         self,
         test_set,
@@ -1075,6 +1385,15 @@ class AugMaxASRBrain(ASRBrain):
             attacker=attacker,
         )
         self.tokenizer = None
+        self.augmentation_pipeline = None
+        self.adversarial_producer = None
+        self.init_attack_scheduler(checkpointer)
+        if checkpointer is not None and hasattr(self.attacker, "generator"):
+            # the AugMax generator (AugMaxGeneratorAttack) is trained with the model
+            checkpointer.add_recoverable("augmax_generator", self.attacker.generator)
+            checkpointer.add_recoverable(
+                "augmax_generator_optimizer", self.attacker.optimizer
+            )
 
     def __setattr__(self, name, value, attacker_brain=True):
         """Maintain similar attributes for the main and nested brain"""
@@ -1115,7 +1434,7 @@ class AugMaxASRBrain(ASRBrain):
         else:
             self.attacker = None
 
-    def compute_forward_adversarial(self, batch, stage):
+    def compute_forward_adversarial(self, batch, stage, xs=None):
         """Forward pass applied to an adversarial example.
 
         The default implementation depends on a few methods being defined
@@ -1129,6 +1448,9 @@ class AugMaxASRBrain(ASRBrain):
             An element from the dataloader, including inputs for processing.
         stage : Stage
             The stage of the experiment: Stage.TRAIN, Stage.VALID, Stage.TEST
+        xs : Optional[torch.Tensor]
+            (W + 1, N, T) augmented branches for the attack to mix (see
+            shared_branches), computed by the attack if None
 
         Returns
         -------
@@ -1139,16 +1461,106 @@ class AugMaxASRBrain(ASRBrain):
         assert stage != rs.Stage.ATTACK
         wavs = batch.sig[0]
         if self.attacker is not None:
-            if stage == sb.Stage.TEST:
-                adv_wavs = self.attacker.perturb_and_log(batch)
-            else:
-                adv_wavs = self.attacker.perturb(batch)
-            adv_wavs = adv_wavs.detach()
+            adv_wavs = self.adversarial_wavs(batch, stage, xs=xs)
             batch.sig = adv_wavs, batch.sig[1]
         res = self.compute_forward(batch, stage)
         batch.sig = wavs, batch.sig[1]
         return res, adv_wavs
 
+    def adversarial_wavs(self, batch, stage, xs=None):
+        """Compute the adversarial (AugMax) inputs of a batch with the
+        attacker (see compute_forward_adversarial). With an adversarial
+        producer, training inputs are produced in the background on their
+        own branches (xs is ignored)."""
+        if hasattr(self.attacker, "generator"):
+            # the AugMax generator only learns from training batches
+            self.attacker.generator.train(stage == sb.Stage.TRAIN)
+        self.attacker.training = stage == sb.Stage.TRAIN
+        if stage == sb.Stage.TEST:
+            adv_wavs = self.attacker.perturb_and_log(batch)
+        elif stage == sb.Stage.TRAIN and self.adversarial_producer is not None:
+            adv_wavs = self.adversarial_producer.adversarial_wavs(batch)
+        elif xs is not None:
+            adv_wavs = self.attacker.perturb(batch, xs=xs)
+        else:
+            adv_wavs = self.attacker.perturb(batch)
+        return adv_wavs.detach()
+
+    def compute_forward_views(self, batch, stage):
+        """
+        Forward passes of the clean, AugMix and AugMax views of a batch.
+        With hparams.concat_views, the three views are concatenated along
+        the batch dimension (with tiled targets) into a single forward pass,
+        whose outputs are split back. This requires an AugMixModule
+        ``augmix_model`` and an attacker. The views then share their
+        normalization statistics: during training, the BatchNorm layers of
+        the model normalize the 3N concatenated batch, AugMax view included,
+        and their running statistics and those of ``normalize`` are updated
+        once on it instead of once per view.
+
+        Arguments
+        ---------
+        batch : torch.Tensor or tensors
+            An element from the dataloader, including inputs for processing.
+        stage : Stage
+            The stage of the experiment: Stage.TRAIN, Stage.VALID, Stage.TEST
+
+        Returns
+        -------
+        the outputs of compute_forward on the clean, AugMix and AugMax views
+        """
+        xs = self.shared_branches(batch)
+        if not getattr(self.hparams, "concat_views", False):
+            outputs = self.compute_forward(batch, stage, augmix=False)
+            augmix_outputs = self.compute_forward(batch, stage, augmix=True, xs=xs)
+            augmax_outputs, _ = self.compute_forward_adversarial(batch, stage, xs=xs)
+            return outputs, augmix_outputs, augmax_outputs
+        batch = batch.to(self.device)
+        wavs, wav_lens = batch.sig
+        adv_wavs = self.adversarial_wavs(batch, stage, xs=xs).to(self.device)
+        augmix_wavs = self.augmix_model(wavs, ids=batch.id, lengths=wav_lens, xs=xs)
+        views = repeat_batch(batch, 3)
+        views.sig = torch.cat([wavs, augmix_wavs, adv_wavs]), wav_lens.repeat(3)
+        outputs = self.compute_forward(views, stage)
+        return tuple(zip(*[output.chunk(3) for output in outputs]))
+
+    def consistency_loss(self, outputs, augmix_outputs, augmax_outputs):
+        """
+        Jensen-Shannon consistency between the log-probabilities (first
+        output of compute_forward) of the clean, AugMix and AugMax views,
+        weighted by hparams.consistency_weight. The fused loss is computed
+        in chunks of hparams.consistency_chunk_size time steps.
+
+        Arguments
+        ---------
+        outputs, augmix_outputs, augmax_outputs : tuple
+            the outputs of compute_forward_views
+
+        Returns
+        -------
+        the weighted consistency loss
+        """
+        weight = getattr(self.hparams, "consistency_weight", 10)
+        chunk_size = getattr(self.hparams, "consistency_chunk_size", 32)
+        log_probs = [outputs[0], augmax_outputs[0], augmix_outputs[0]]
+        return weight * jsd_consistency(log_probs, chunk_size=chunk_size)
+
+    def shared_branches(self, batch):
+        """
+        Augmented branches of a batch shared by its AugMix and AugMax views
+        if hparams.share_branches is set (None otherwise). AugMix samples its
+        mixing weights and AugMax optimizes them over the same branches, so
+        each training step renders mixture_width augmented copies instead of
+        twice as many.
+        """
+        engines = self.augmentation_engines()
+        if not getattr(self.hparams, "share_branches", False) or not engines:
+            return None
+        wavs, wav_lens = batch.sig
+        return engines[0].aug_all(
+            wavs.to(self.device), ids=batch.id, lengths=wav_lens.to(self.device)
+        )
+
     def fit_batch(self, batch):
         """Fit one batch, override to do multiple updates.
 
@@ -1171,32 +1583,10 @@ class AugMaxASRBrain(ASRBrain):
         detached loss
         """
         # Managing automatic mixed precision
-        if self.auto_mix_prec:
-            self.optimizer.zero_grad()
-            with torch.cuda.amp.autocast():
-                outputs = self.compute_forward(batch, sb.Stage.TRAIN)
-                loss = self.compute_objectives(outputs, batch, sb.Stage.TRAIN)
-            self.scaler.scale(loss).backward()
-            self.scaler.unscale_(self.optimizer)
-            if self.check_gradients(loss):
-                self.scaler.step(self.optimizer)
-            self.scaler.update()
-        else:
+        with torch.cuda.amp.autocast(enabled=self.auto_mix_prec):
             outputs = self.compute_forward(batch, sb.Stage.TRAIN)
             loss = self.compute_objectives(outputs, batch, sb.Stage.TRAIN, adv=False)
-
-            # normalize the loss by gradient_accumulation step
-            (loss / self.hparams.gradient_accumulation).backward()
-            if self.step % self.hparams.gradient_accumulation == 0:
-                # gradient clipping & early stop if loss is not fini
-                self.check_gradients(loss)
-                self.optimizer.step()
-                self.optimizer.zero_grad()
-
-            if self.check_gradients(loss):
-                self.optimizer.step()
-            self.optimizer.zero_grad()
-
+        self.accumulate_gradients(loss, batch.batchsize)
         return loss.detach().cpu()
 
     def fit_batch_adversarial(self, batch):
@@ -1232,71 +1622,88 @@ class AugMaxASRBrain(ASRBrain):
 
         # output = log softmax
 
-        if self.auto_mix_prec:
-            self.optimizer.zero_grad()
-            with torch.cuda.amp.autocast():
-                # origin
-                outputs = self.compute_forward(batch, sb.Stage.TRAIN, augmix=False)
-                p_clean = torch.exp(outputs[0])
-                loss_clean = self.compute_objectives(outputs, batch, sb.Stage.TRAIN)
-
-                # augmix
-                augmix_outputs = self.compute_forward(batch, sb.Stage.TRAIN, augmix=True)
-                p_augmix = torch.exp(augmix_outputs[0])
-                
-                # augmax
-                augmax_outputs, _ = self.compute_forward_adversarial(batch, sb.Stage.TRAIN)
-                p_augmax = torch.exp(augmax_outputs[0])
-
-                p_mixture = torch.clamp((p_clean + p_augmax + p_augmix) / 3., 1e-7, 1).log()
-                loss_lambda = 10 # hapram
-                loss_cst = loss_lambda * (
-                            F.kl_div(p_mixture, p_clean, reduction='batchmean') +
-                            F.kl_div(p_mixture, p_augmax, reduction='batchmean') +
-                            F.kl_div(p_mixture, p_augmix, reduction='batchmean')
-                            ) / 3.
-                loss = loss_clean + loss_cst
-                # loss = self.compute_objectives(outputs, batch, sb.Stage.TRAIN)
-            self.scaler.scale(loss).backward()
-            self.scaler.unscale_(self.optimizer)
-            if self.check_gradients(loss):
-                self.scaler.step(self.optimizer)
-            self.scaler.update()
-        else:
-            # origin
-            outputs = self.compute_forward(batch, sb.Stage.TRAIN, augmix=False)
-            p_clean = torch.exp(outputs)
+        with torch.cuda.amp.autocast(enabled=self.auto_mix_prec):
+            # origin, augmix and augmax views
+            outputs, augmix_outputs, augmax_outputs = self.compute_forward_views(
+                batch, sb.Stage.TRAIN
+            )
             loss_clean = self.compute_objectives(outputs, batch, sb.Stage.TRAIN, adv=True)
-
-            # augmix
-            augmix_outputs = self.compute_forward(batch, sb.Stage.TRAIN, augmix=True)
-            p_augmix = torch.exp(augmix_outputs)
-            
-            # augmax
-            augmax_outputs, _ = self.compute_forward_adversarial(batch, sb.Stage.TRAIN)
-            p_augmax = torch.exp(augmax_outputs)
-
-            p_mixture = torch.clamp((p_clean + p_augmax + p_augmix) / 3., 1e-7, 1).log()
-            loss_lambda = 10 # hapram
-            loss_cst = loss_lambda * (
-                        F.kl_div(p_mixture, p_clean, reduction='batchmean') +
-                        F.kl_div(p_mixture, p_augmax, reduction='batchmean') +
-                        F.kl_div(p_mixture, p_augmix, reduction='batchmean')
-                        ) / 3.
+            loss_cst = self.consistency_loss(outputs, augmix_outputs, augmax_outputs)
             loss = loss_clean + loss_cst
+        self.accumulate_gradients(loss, batch.batchsize)
+        return loss.detach().cpu()
 
-            # normalize the loss by gradient_accumulation step
-            (loss / self.hparams.gradient_accumulation).backward()
-            if self.step % self.hparams.gradient_accumulation == 0:
-                # gradient clipping & early stop if loss is not fini
-                self.check_gradients(loss)
-                self.optimizer.step()
-                self.optimizer.zero_grad()
+    def fit_batch_free(self, batch):
+        """Fit one batch with "free" AugMax training, in the spirit of free
+        adversarial training (https://arxiv.org/abs/1904.12843).
+
+        The batch is replayed hparams.free_replays times. The backward pass
+        of each replay gives both the gradients of the model, for an
+        optimizer step, and the gradient of the perturbation, for an attack
+        step, so that there is no separate attack loop. The perturbation is
+        kept from one replay to the next. To train on the same number of
+        batches as without replays, divide the number of epochs by
+        free_replays.
+
+        The perturbation is the AugMax mixture of the batch: its parameters
+        (m, q) take a sign-SGD step of size attacker.eps on each replay, with
+        m clamped to [0, 1] (see AugMaxAttack.free_step), along the gradient
+        of the ASR loss of the AugMax view, as in AugMaxAttack.perturb. The
+        model is trained on the clean and consistency losses. The AugMax view
+        runs in the attack stage, in which the gradients reach the inputs:
+        the train-time corruptions (env_corrupt) and augmentations are not
+        applied to it and the input normalization statistics are frozen.
+
+        Each replay takes its own optimizer step, so free training cannot be
+        combined with gradient accumulation (hparams.gradient_accumulation).
 
-            if self.check_gradients(loss):
-                self.optimizer.step()
-            self.optimizer.zero_grad()
+        Arguments
+        ---------
+        batch : list of torch.Tensors
+            Batch of data to use for training. Default implementation assumes
+            this batch has two elements: inputs and targets.
 
+        Returns
+        -------
+        detached loss of the last replay
+        """
+        if not hasattr(self.attacker, "free_step"):
+            raise ValueError("free AugMax training requires an AugMax attacker")
+        if self.accumulation_steps() > 1:
+            raise ValueError(
+                "free AugMax training does not support gradient accumulation"
+            )
+        batch = batch.to(self.device)
+        wavs, wav_lens = batch.sig
+        shared = self.shared_branches(batch)
+        xs, m, q = self.attacker.init_free(batch, xs=shared)
+        self.step_accumulated()
+        for _ in range(self.free_replays()):
+            with torch.cuda.amp.autocast(enabled=self.auto_mix_prec):
+                outputs = self.compute_forward(batch, sb.Stage.TRAIN, augmix=False)
+                augmix_outputs = self.compute_forward(
+                    batch, sb.Stage.TRAIN, augmix=True, xs=shared
+                )
+                batch.sig = self.attacker.mix(xs, m, q, lengths=wav_lens), wav_lens
+                augmax_outputs = self.compute_forward(batch, rs.Stage.ATTACK)
+                batch.sig = wavs, wav_lens
+                loss_clean = self.compute_objectives(outputs, batch, sb.Stage.TRAIN)
+                loss_cst = self.consistency_loss(
+                    outputs, augmix_outputs, augmax_outputs
+                )
+                loss = loss_clean + loss_cst
+                loss_adv = self.compute_objectives(
+                    augmax_outputs, batch, rs.Stage.ATTACK
+                )
+            if self.attacker.targeted:
+                loss_adv = -loss_adv
+            if self.auto_mix_prec:  # only the sign of the gradients is used
+                loss_adv = self.scaler.scale(loss_adv)
+            # (m, q) ascend the ASR loss of the AugMax view
+            grads = torch.autograd.grad(loss_adv, [m, q], retain_graph=True)
+            # one optimizer step per replay
+            self.accumulate_gradients(loss, batch.batchsize, accumulation_steps=1)
+            self.attacker.free_step(m, q, grads)
         return loss.detach().cpu()
 
     def evaluate_batch_adversarial(self, batch, stage, target=None):
@@ -1422,6 +1829,15 @@ class AugMaxASRBrain(ASRBrain):
             )
 
         self.on_fit_start()
+        if self.adversarial_producer is None:
+            self.init_adversarial_producer()
+            if (
+                self.adversarial_producer is not None
+                and self.attack_scheduler is not None
+            ):
+                self.attack_scheduler.add_listener(
+                    self.adversarial_producer.set_attack_settings
+                )
 
         if progressbar is None:
             progressbar = not self.noprogressbar
@@ -1440,20 +1856,30 @@ class AugMaxASRBrain(ASRBrain):
             ):
                 self.train_sampler.set_epoch(epoch)
 
+            if self.attack_scheduler is not None:
+                self.attack_scheduler.on_epoch_start(epoch, len(train_set))
+
             # Time since last intra-epoch checkpoint
             last_ckpt_time = time.time()
 
             # Only show progressbar if requested and main_process
             enable = progressbar and sb.utils.distributed.if_main_process()
-            with tqdm(
-                train_set,
+            with self.training_batches(train_set) as train_batches, tqdm(
+                train_batches,
                 initial=self.step,
+                total=len(train_set),
                 dynamic_ncols=True,
                 disable=not enable,
             ) as pbar:
                 for batch in pbar:
                     self.step += 1
-                    if self.attacker is not None:
+                    if self.attack_scheduler is not None:
+                        self.attack_scheduler.on_step(
+                            self.free_replays() if self.free_replays() > 1 else None
+                        )
+                    if self.attacker is not None and self.free_replays() > 1:
+                        loss = self.fit_batch_free(batch)
+                    elif self.attacker is not None:
                         loss = self.fit_batch_adversarial(batch)
                     else:
                         loss = self.fit_batch(batch)
@@ -1483,6 +1909,15 @@ class AugMaxASRBrain(ASRBrain):
                             self._save_intra_epoch_ckpt()
                         last_ckpt_time = time.time()
 
+            if hasattr(self.attacker, "log_iterations"):
+                self.attacker.log_iterations()
+            if self.attack_scheduler is not None:
+                self.attack_scheduler.on_epoch_end()
+
+            # step on the micro-batches left at the end of the epoch
+            self.step_accumulated()
+            self.log_accumulation()
+
             # Run train "on_stage_end" on all processes
             self.on_stage_end(sb.Stage.TRAIN, self.avg_train_loss, epoch)
             self.avg_train_loss = 0.0
@@ -1512,6 +1947,11 @@ class AugMaxASRBrain(ASRBrain):
                     if self.debug and self.step == self.debug_batches:
                         break
 
+                if self.attack_scheduler is not None:
+                    self.attack_scheduler.on_validation_end(
+                        avg_valid_loss, avg_valid_adv_loss
+                    )
+
                 # Only run validation "on_stage_end" on main process
                 self.step = 0
                 run_on_main(
@@ -1524,6 +1964,73 @@ class AugMaxASRBrain(ASRBrain):
             if self.debug and epoch == self.debug_epochs:
                 break
 
+        if self.attack_scheduler is not None:
+            # evaluation attacks run at full strength
+            self.attack_scheduler.restore()
+
+    def augmentation_engines(self):
+        """Augmentation engines used to train on a batch (AugMix and AugMax,
+        only the first one if they share their branches)"""
+        engines = []
+        if getattr(self, "augmix_model", None) is not None:
+            engines.append(self.augmix_model.engine)
+        if (
+            getattr(self.attacker, "engine", None) is not None
+            and self.adversarial_producer is None
+        ):
+            # the adversarial producer computes its own branches
+            engines.append(self.attacker.engine)
+        if getattr(self.hparams, "share_branches", False):
+            return engines[:1]
+        return engines
+
+    @contextlib.contextmanager
+    def training_batches(self, train_set):
+        """
+        Context of the batches of a training epoch, whose AugMax examples
+        are computed ahead by the adversarial producer and whose branches
+        are computed ahead by an augmentation pipeline, if there are ones.
+        The pipeline lives for the epoch: its worker threads are stopped when
+        the context exits, also on errors.
+
+        Arguments
+        ---------
+        train_set : DataLoader
+            the training batches of the epoch
+        """
+        with super(AugMaxASRBrain, self).training_batches(train_set) as batches:
+            self.init_augmentation_pipeline()
+            if self.augmentation_pipeline is None:
+                yield batches
+                return
+            try:
+                # branches of the next batches are computed in the background
+                batches = self.augmentation_pipeline.prefetch(batches)
+                try:
+                    yield batches
+                finally:
+                    batches.close()  # drop the batches prefetched ahead
+                self.augmentation_pipeline.log_stats()
+            finally:
+                # stop the worker threads
+                self.augmentation_pipeline.shutdown()
+                self.augmentation_pipeline = None
+
+    def init_augmentation_pipeline(self):
+        """
+        Create the pipeline computing the augmented branches of the next
+        training batches in background threads, if hparams.augmentation_workers
+        is positive (see augmentation_pipeline.py).
+        """
+        self.augmentation_pipeline = None
+        num_workers = getattr(self.hparams, "augmentation_workers", 0)
+        if num_workers > 0 and self.augmentation_engines():
+            self.augmentation_pipeline = AugmentationPipeline(
+                self.augmentation_engines(),
+                num_workers=num_workers,
+                queue_depth=getattr(self.hparams, "augmentation_queue_depth", 2),
+            )
+
     def evaluate(
         self,
         test_set,
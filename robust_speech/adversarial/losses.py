@@ -0,0 +1,83 @@
+"""
+Losses of the adversarial and augmentation training procedures.
+"""
+
+import math
+
+import torch
+
+
+class JSDConsistency(torch.autograd.Function):
+    """
+    Jensen-Shannon consistency between K distributions given by their
+    log-probabilities, computed in log space and chunk by chunk along the
+    time dimension. Only the inputs are kept for the backward pass, which
+    recomputes the mixture of each chunk.
+
+    Equivalent to
+        M = clamp(mean_k exp(l_k), eps, 1)
+        sum_k F.kl_div(log(M), exp(l_k), reduction="batchmean") / K
+    with gradients for every l_k.
+    """
+
+    @staticmethod
+    def _chunk(log_probs, start, end, log_eps):
+        log_probs = torch.stack([l[:, start:end] for l in log_probs])
+        # half precision log-probabilities are upcast chunk by chunk
+        log_probs = log_probs.to(torch.promote_types(log_probs.dtype, torch.float32))
+        log_mixture = torch.logsumexp(log_probs, dim=0) - math.log(len(log_probs))
+        clamped = log_mixture < log_eps
+        log_mixture = log_mixture.clamp(log_eps, 0)
+        probs = torch.exp(log_probs)
+        # 0 * log(0) = 0, as in F.kl_div
+        terms = torch.where(
+            probs > 0, probs * (log_probs - log_mixture), torch.zeros_like(probs)
+        )
+        return probs, terms, clamped
+
+    @staticmethod
+    def forward(ctx, chunk_size, eps, *log_probs):
+        log_eps = math.log(eps)
+        loss = 0
+        for start in range(0, log_probs[0].size(1), chunk_size):
+            _, terms, _ = JSDConsistency._chunk(
+                log_probs, start, start + chunk_size, log_eps
+            )
+            loss = loss + terms.sum()
+        ctx.save_for_backward(*log_probs)
+        ctx.chunk_size = chunk_size
+        ctx.log_eps = log_eps
+        return loss / (len(log_probs) * log_probs[0].size(0))
+
+    @staticmethod
+    def backward(ctx, grad_output):
+        log_probs = ctx.saved_tensors
+        scale = grad_output / (len(log_probs) * log_probs[0].size(0))
+        grads = [torch.empty_like(l) for l in log_probs]
+        for start in range(0, log_probs[0].size(1), ctx.chunk_size):
+            end = start + ctx.chunk_size
+            probs, terms, clamped = JSDConsistency._chunk(
+                log_probs, start, end, ctx.log_eps
+            )
+            # the derivatives through the mixture cancel the +p_k term of
+            # d(p_k log p_k), unless the mixture is clamped
+            grad = terms + probs * clamped
+            for k, g in enumerate(grads):
+                g[:, start:end] = (scale * grad[k]).to(g.dtype)
+        return (None, None) + tuple(grads)
+
+
+def jsd_consistency(log_probs, chunk_size=32, eps=1e-7):
+    """
+    Jensen-Shannon consistency loss (see JSDConsistency)
+
+    Arguments
+    ---------
+    log_probs: list
+        (N, L, V) log-probabilities of each view
+    chunk_size: int
+        number of time steps processed at once.
+    eps: float
+        lower bound of the mixture probabilities.
+    """
+    return JSDConsistency.apply(chunk_size, eps, *log_probs)
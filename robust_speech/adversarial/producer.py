@@ -0,0 +1,264 @@
+"""
+Asynchronous generation of the adversarial examples of the training batches.
+
+A producer thread iterates over the training batches and attacks them with a
+snapshot of the model: a copy of the modules of the attacked brain, refreshed
+with the weights of the trainer every few training steps. Adversarial batches
+are handed over to the trainer through a bounded queue, so that the attacks of
+the next batches overlap with the training steps instead of running before
+each of them. The staleness of an adversarial example is the number of
+training steps between the snapshot that produced it and the step that
+consumes it.
+"""
+
+import copy
+import logging
+import queue
+import threading
+import time
+
+import torch
+
+from robust_speech.adversarial.attacks.augmentations import AugmentationRegistry
+from robust_speech.adversarial.scheduler import set_attack_settings
+
+logger = logging.getLogger(__name__)
+
+_END = object()
+
+# state an attacker keeps across batches, which its snapshot would share
+_SHARED_STATE = {
+    "cache": "warm_start_cache",
+    "replay_buffer": "replay_buffer",
+    "generator": "the generator attack",
+}
+
+
+class AdversarialProducer:
+    """
+    Produce the adversarial examples of upcoming training batches in a
+    background thread.
+
+    Arguments
+    ---------
+    attacker: robust_speech.adversarial.attacks.attacker.Attacker
+        attacker of the training brain. Examples are produced by a copy of it
+        whose brain uses a snapshot of the modules, and computed by the
+        attacker itself when they are too stale.
+    refresh_every: int
+        training steps between two refreshes of the snapshot. A refresh
+        copies the weights of the model twice.
+    queue_size: int
+        number of adversarial batches produced ahead of the current one.
+    max_staleness: Optional[int]
+        adversarial examples staler than this number of steps are recomputed
+        with the current model (None to always use them).
+    """
+
+    def __init__(self, attacker, refresh_every=10, queue_size=2, max_staleness=None):
+        for name, option in _SHARED_STATE.items():
+            if getattr(attacker, name, None) is not None:
+                raise ValueError(
+                    "async_attack cannot be combined with %s: the producer "
+                    "thread and the trainer would update it concurrently" % option
+                )
+        self.attacker = attacker
+        self.refresh_every = refresh_every
+        self.queue_size = queue_size
+        self.max_staleness = max_staleness
+        self.snapshot_attacker = self._snapshot_attacker(attacker)
+        self._lock = threading.Lock()
+        # weights handed over to the snapshot, allocated once
+        self._staging = [
+            tensor.detach().clone()
+            for tensor in self._state_tensors(self.snapshot_attacker)
+        ]
+        self._pending = None  # step of the weights to load in the snapshot
+        self._settings = None  # attack settings to load in the snapshot
+        self._ready = {}  # handed-over examples, by utterance ids
+        self.snapshot_step = 0
+        self.steps = 0
+        self.last_refresh = 0
+        self.reset_stats()
+
+    @staticmethod
+    def _snapshot_attacker(attacker):
+        """Copy of the attacker attacking a copy of the modules of its brain,
+        with its own augmentation transforms (they store their random
+        parameters) and its own record of the iterations used"""
+        snapshot = copy.copy(attacker)
+        snapshot.training = True  # only attacks training batches
+        if hasattr(attacker, "iterations"):
+            snapshot.iterations = []
+        snapshot.asr_brain = copy.copy(attacker.asr_brain)
+        snapshot.asr_brain.modules = copy.deepcopy(attacker.asr_brain.modules)
+        engine = getattr(attacker, "engine", None)
+        if engine is not None:
+            snapshot.engine = copy.copy(engine)
+            snapshot.engine.transforms = AugmentationRegistry(engine.sample_rate)
+            snapshot.engine.prefetch(None)
+        return snapshot
+
+    def reset_stats(self):
+        """Reset the staleness and stall metrics"""
+        self.batches = 0
+        self.recomputed = 0
+        self.staleness_sum = 0
+        self.max_staleness_seen = 0
+        self.stalls = 0
+        self.stall_seconds = 0.0
+        self.producer_seconds = 0.0
+        if hasattr(self.snapshot_attacker, "iterations"):
+            self.snapshot_attacker.iterations = []
+
+    def stats(self):
+        """
+        Metrics of the producer since the last reset: number of training
+        batches, mean and max staleness of the adversarial examples used,
+        number of examples recomputed by the trainer (too stale or not
+        produced), number of batches the trainer had to wait for (stalls) and
+        total waiting time, total attack time of the producer and mean number
+        of attack iterations of the batches it attacked.
+        """
+        used = max(self.batches - self.recomputed, 1)
+        iterations = getattr(self.snapshot_attacker, "iterations", None) or [0]
+        return {
+            "batches": self.batches,
+            "mean_staleness": self.staleness_sum / used,
+            "max_staleness": self.max_staleness_seen,
+            "recomputed": self.recomputed,
+            "stalls": self.stalls,
+            "stall_seconds": self.stall_seconds,
+            "producer_seconds": self.producer_seconds,
+            "mean_iterations": sum(iterations) / len(iterations),
+        }
+
+    @staticmethod
+    def _state_tensors(attacker):
+        """Parameters and buffers of the modules of the attacked brain"""
+        return list(
+            attacker.asr_brain.modules.state_dict(keep_vars=True).values()
+        )
+
+    def refresh(self):
+        """Hand the current weights of the attacked brain over to the
+        snapshot, which loads them before its next attack. Weights are
+        copied in place into a staging copy, so that the snapshot is never
+        modified during an attack."""
+        with self._lock, torch.no_grad():
+            for staged, tensor in zip(
+                self._staging, self._state_tensors(self.attacker)
+            ):
+                staged.copy_(tensor)
+            self._pending = self.steps
+        self.last_refresh = self.steps
+
+    def set_attack_settings(self, settings):
+        """Hand attack settings (e.g. of an AttackScheduler) over to the
+        snapshot attacker, which loads them before its next attack"""
+        with self._lock:
+            self._settings = dict(settings)
+
+    def _load_pending(self):
+        with self._lock, torch.no_grad():
+            if self._settings is not None:
+                set_attack_settings(self.snapshot_attacker, self._settings)
+                self._settings = None
+            if self._pending is None:
+                return
+            for tensor, staged in zip(
+                self._state_tensors(self.snapshot_attacker), self._staging
+            ):
+                tensor.copy_(staged)
+            self.snapshot_step, self._pending = self._pending, None
+
+    def _put(self, out, stop, item):
+        while not stop.is_set():
+            try:
+                out.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def _produce(self, batches, out, stop):
+        try:
+            for batch in batches:
+                self._load_pending()
+                start = time.perf_counter()
+                batch = batch.to(self.snapshot_attacker.asr_brain.device)
+                adv_wavs = self.snapshot_attacker.perturb(batch).detach()
+                self.producer_seconds += time.perf_counter() - start
+                if not self._put(out, stop, (batch, adv_wavs, self.snapshot_step)):
+                    return
+            self._put(out, stop, _END)
+        except Exception as e:  # raised in the training thread
+            self._put(out, stop, e)
+
+    def produce(self, batches):
+        """
+        Iterate over batches while the adversarial examples of the next
+        queue_size batches are computed in the background. When a batch is
+        yielded, its adversarial example is ready (see adversarial_wavs).
+        """
+        out = queue.Queue(maxsize=self.queue_size)
+        stop = threading.Event()
+        thread = threading.Thread(
+            target=self._produce,
+            args=(batches, out, stop),
+            name="adversarial-producer",
+            daemon=True,
+        )
+        thread.start()
+        try:
+            while True:
+                if out.empty():
+                    self.stalls += 1
+                    start = time.perf_counter()
+                    item = out.get()
+                    self.stall_seconds += time.perf_counter() - start
+                else:
+                    item = out.get()
+                if item is _END:
+                    break
+                if isinstance(item, Exception):
+                    raise item
+                batch, adv_wavs, snapshot_step = item
+                self._ready[tuple(batch.id)] = (adv_wavs, snapshot_step)
+                yield batch
+        finally:
+            stop.set()
+            thread.join()
+            self._ready.clear()
+
+    def adversarial_wavs(self, batch):
+        """
+        Adversarial example of the batch of the current training step: the
+        one handed over by the producer, or one computed by the attacker if
+        it is too stale or the batch was not produced.
+
+        Arguments
+        ---------
+        batch: sb.dataio.batch.PaddedBatch
+            the training batch
+        """
+        if self.steps - self.last_refresh >= self.refresh_every:
+            self.refresh()
+        ready = self._ready.pop(tuple(batch.id), None)
+        self.batches += 1
+        self.steps += 1
+        if ready is not None:
+            adv_wavs, snapshot_step = ready
+            staleness = self.steps - 1 - snapshot_step
+            if self.max_staleness is None or staleness <= self.max_staleness:
+                self.staleness_sum += staleness
+                self.max_staleness_seen = max(self.max_staleness_seen, staleness)
+                return adv_wavs
+        self.recomputed += 1
+        return self.attacker.perturb(batch).detach()
+
+    def log_stats(self):
+        """Log the metrics of the producer and reset them. Call it when no
+        producer thread is running (see produce)."""
+        logger.info("adversarial producer: %s" % self.stats())
+        self.reset_stats()
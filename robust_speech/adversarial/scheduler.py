@@ -0,0 +1,308 @@
+"""
+Schedules of the strength of the attack used for adversarial training.
+
+The strength of the attacker (number of iterations and bound or, for AugMax,
+mixture width) is scaled by a factor in (0, 1] that changes over training:
+the model is trained against weak attacks while it is weak, which costs few
+attack iterations, and against full-strength attacks later on. The number of
+model forward passes spent by the attack in an epoch can also be bounded, in
+which case the iterations of the remaining batches are capped. The forward
+passes charged are those of the iterations the attacker actually ran.
+"""
+
+import json
+import logging
+
+from speechbrain.utils.checkpoints import (
+    mark_as_loader,
+    mark_as_saver,
+    register_checkpoint_hooks,
+)
+
+logger = logging.getLogger(__name__)
+
+SCHEDULES = ["constant", "linear", "cyclic", "loss_gap"]
+
+
+def set_attack_settings(attacker, settings):
+    """Set the settings (nb_iter, eps or rel_eps, mixture_width) of an
+    attacker and, for AugMax attackers, the width of their engine"""
+    for name, value in settings.items():
+        setattr(attacker, name, value)
+        if name == "mixture_width":
+            attacker.engine.mixture_width = value
+
+
+@register_checkpoint_hooks
+class AttackScheduler:
+    """
+    Scale the strength of attackers over the epochs of adversarial training.
+
+    The full strength is the one the attacker was configured with. With
+    strength s, the attacker runs max(min_iter, round(s * nb_iter))
+    iterations with bound s * eps (SNR attackers: a signal-to-noise ratio
+    20 * log10(1 / s) dB higher). AugMax attackers mix
+    max(1, round(s * mixture_width)) augmented branches; their eps is the
+    step size of (m, q), not a bound, and is not scaled.
+
+    Arguments
+    ---------
+    attackers: list
+        attackers to schedule, configured with their full strength. The
+        first one is the attacker of the trainer, the others are copies of
+        it used by the same thread.
+    schedule: str
+        one of SCHEDULES. "constant" always uses the full strength, "linear"
+        increases it linearly from start to 1 over warmup_epochs, "cyclic"
+        goes from start to 1 and back to start every cycle_epochs, and
+        "loss_gap" starts at start and increases it by gap_step whenever the
+        relative gap between the adversarial and clean validation losses
+        falls below gap_threshold.
+    start: float
+        strength of the first epoch.
+    warmup_epochs: int
+        number of epochs of the linear warm-up.
+    cycle_epochs: int
+        period of the cyclic schedule, in epochs.
+    gap_threshold: float
+        relative loss gap (adv_loss - loss) / loss under which the
+        loss_gap schedule increases the strength.
+    gap_step: float
+        strength increment of the loss_gap schedule.
+    forward_budget: Optional[int]
+        maximal number of attack forward passes per epoch (unbounded if
+        None). One attack iteration costs one forward pass per restart. The
+        iterations of a batch are those recorded by the attacker (its
+        iterations list, which accounts for early stopping, warm starts and
+        replays), nb_iter if it does not record them. Attacks run by an
+        adversarial producer thread are not charged.
+    min_iter: int
+        minimal number of attack iterations per batch, even when the budget
+        is exhausted.
+    schedule_eps: bool
+        whether the bound of the attack is scaled.
+    schedule_width: bool
+        whether the mixture width of AugMax attackers is scaled.
+    """
+
+    def __init__(
+        self,
+        attackers,
+        schedule="linear",
+        start=0.25,
+        warmup_epochs=5,
+        cycle_epochs=4,
+        gap_threshold=0.1,
+        gap_step=0.25,
+        forward_budget=None,
+        min_iter=1,
+        schedule_eps=True,
+        schedule_width=True,
+    ):
+        if schedule not in SCHEDULES:
+            raise ValueError(
+                "attack schedule must be one of %s, got %s" % (SCHEDULES, schedule)
+            )
+        if not 0 < start <= 1:
+            raise ValueError("start strength must be in (0, 1], got %s" % start)
+        self.attackers = []
+        self.listeners = []
+        self.schedule = schedule
+        self.start = start
+        self.warmup_epochs = warmup_epochs
+        self.cycle_epochs = cycle_epochs
+        self.gap_threshold = gap_threshold
+        self.gap_step = gap_step
+        self.forward_budget = forward_budget
+        self.min_iter = min_iter
+        self.schedule_eps = schedule_eps
+        self.schedule_width = schedule_width
+        self.full = self._strength_of(attackers[0])
+        for attacker in attackers:
+            self.attach(attacker)
+        self.strength = 1.0 if schedule == "constant" else start
+        self.settings = dict(self.full)
+        self.epoch_steps = 0
+        self.step = 0
+        self.forwards = 0
+        # iterations list of the attacker and number of entries charged
+        self._recorded = (None, 0)
+        self._unrecorded = 0  # forward passes of an attacker without records
+
+    @staticmethod
+    def _strength_of(attacker):
+        full = {"nb_iter": attacker.nb_iter}
+        if getattr(attacker, "engine", None) is not None:
+            # AugMax: eps is the step size of (m, q), the width is the
+            # strength (that of the AugMax generator is fixed)
+            if not hasattr(attacker, "generator"):
+                full["mixture_width"] = attacker.mixture_width
+        elif hasattr(attacker, "rel_eps"):  # SNR bounds
+            full["rel_eps"] = attacker.rel_eps
+        else:
+            full["eps"] = attacker.eps
+        return full
+
+    def attach(self, attacker):
+        """Schedule another copy of the attacker"""
+        self.attackers.append(attacker)
+
+    def add_listener(self, callback):
+        """Call callback(settings) whenever the settings change, e.g. to hand
+        them over to an attacker used by another thread"""
+        self.listeners.append(callback)
+
+    def epoch_strength(self, epoch):
+        """Strength of an epoch (starting from 1) under the epoch-based
+        schedules"""
+        if self.schedule == "linear":
+            progress = min(1.0, (epoch - 1) / max(self.warmup_epochs, 1))
+            return self.start + (1 - self.start) * progress
+        if self.schedule == "cyclic":
+            phase = ((epoch - 1) % self.cycle_epochs) / self.cycle_epochs
+            return self.start + (1 - self.start) * (1 - abs(2 * phase - 1))
+        if self.schedule == "loss_gap":
+            return self.strength
+        return 1.0
+
+    def settings_of(self, strength):
+        """Attacker settings for a strength"""
+        settings = {
+            "nb_iter": max(
+                self.min_iter, int(round(strength * self.full["nb_iter"]))
+            )
+        }
+        if self.schedule_eps and "rel_eps" in self.full:
+            settings["rel_eps"] = self.full["rel_eps"] / strength
+        elif self.schedule_eps and "eps" in self.full:
+            settings["eps"] = self.full["eps"] * strength
+        if self.schedule_width and "mixture_width" in self.full:
+            settings["mixture_width"] = max(
+                1, int(round(strength * self.full["mixture_width"]))
+            )
+        return settings
+
+    def apply(self, settings):
+        """Set the settings of all the attackers"""
+        self.settings = settings
+        for attacker in self.attackers:
+            set_attack_settings(attacker, settings)
+        for callback in self.listeners:
+            callback(dict(settings))
+
+    def on_epoch_start(self, epoch, epoch_steps):
+        """
+        Set the strength of a training epoch.
+
+        Arguments
+        ---------
+        epoch: int
+            the epoch, starting from 1
+        epoch_steps: int
+            number of training batches of the epoch
+        """
+        self.strength = self.epoch_strength(epoch)
+        self.epoch_steps = epoch_steps
+        self.step = 0
+        self.forwards = 0
+        # the iterations recorded so far (e.g. validation attacks) are not charged
+        self._recorded = (getattr(self.attackers[0], "iterations", None), 0)
+        if self._recorded[0] is not None:
+            self._recorded = (self._recorded[0], len(self._recorded[0]))
+        self._unrecorded = 0
+        self.apply(self.settings_of(self.strength))
+
+    def _charge(self):
+        """Charge the forward passes of the batches attacked since the last
+        call"""
+        attacker = self.attackers[0]
+        restarts = getattr(attacker, "restarts", 1)
+        iterations = getattr(attacker, "iterations", None)
+        if iterations is not None:
+            recorded, charged = self._recorded
+            if recorded is not None and recorded is not iterations:
+                # the attacker started a new list (log_iterations)
+                self.forwards += sum(recorded[charged:]) * restarts
+                charged = 0
+            self.forwards += sum(iterations[charged:]) * restarts
+            self._recorded = (iterations, len(iterations))
+        self.forwards += self._unrecorded
+        self._unrecorded = 0
+
+    def on_step(self, forwards=None):
+        """
+        Charge the forward passes of the previous training batch and cap the
+        iterations of the next one to the budget left.
+
+        Arguments
+        ---------
+        forwards: Optional[int]
+            attack forward passes of the next batch, if they are not spent
+            by the attacker (e.g. free adversarial training)
+        """
+        self._charge()
+        restarts = getattr(self.attackers[0], "restarts", 1)
+        if self.forward_budget is not None and forwards is None:
+            nb_iter = self.settings_of(self.strength)["nb_iter"]
+            remaining_steps = max(self.epoch_steps - self.step, 1)
+            per_step = (self.forward_budget - self.forwards) // remaining_steps
+            nb_iter = max(self.min_iter, min(nb_iter, per_step // restarts))
+            if nb_iter != self.settings["nb_iter"]:
+                self.apply(dict(self.settings, nb_iter=nb_iter))
+        self.step += 1
+        if forwards is not None:
+            self.forwards += forwards
+        elif getattr(self.attackers[0], "iterations", None) is None:
+            self._unrecorded = self.settings["nb_iter"] * restarts
+
+    def on_epoch_end(self):
+        """Log the strength and cost of the training epoch, and use the
+        uncapped settings of the epoch for validation"""
+        self._charge()
+        logger.info(
+            "attack schedule: %s"
+            % {
+                "strength": self.strength,
+                "settings": self.settings,
+                "steps": self.step,
+                "attack_forwards": self.forwards,
+            }
+        )
+        self.apply(self.settings_of(self.strength))
+
+    def on_validation_end(self, loss, adv_loss):
+        """
+        With the loss_gap schedule, increase the strength if the attack of
+        the epoch no longer makes a difference on the validation set.
+
+        Arguments
+        ---------
+        loss: float
+            clean validation loss
+        adv_loss: float
+            adversarial validation loss, against the attack of the epoch
+        """
+        if self.schedule != "loss_gap" or adv_loss is None:
+            return
+        gap = (adv_loss - loss) / max(abs(loss), 1e-8)
+        if gap < self.gap_threshold:
+            self.strength = min(1.0, self.strength + self.gap_step)
+            logger.info(
+                "attack schedule: loss gap %.3f < %.3f, strength %.3f"
+                % (gap, self.gap_threshold, self.strength)
+            )
+
+    def restore(self):
+        """Restore the full strength of the attackers (e.g. for evaluation)"""
+        self.apply(dict(self.full))
+
+    @mark_as_saver
+    def _save(self, path):
+        with open(path, "w") as f:
+            json.dump({"strength": self.strength}, f)
+
+    @mark_as_loader
+    def _recover(self, path, end_of_epoch, device=None):
+        del end_of_epoch, device
+        with open(path) as f:
+            self.strength = json.load(f)["strength"]
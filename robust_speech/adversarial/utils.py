@@ -8,7 +8,7 @@ import numpy as np
 import speechbrain as sb
 import torch
 import torchaudio
-from speechbrain.dataio.batch import PaddedBatch  # noqa
+from speechbrain.dataio.batch import PaddedBatch, PaddedData  # noqa
 from speechbrain.dataio.preprocess import AudioNormalizer
 from speechbrain.pretrained import EncoderDecoderASR
 from speechbrain.pretrained.fetching import fetch
@@ -89,6 +89,57 @@ def replace_tokens_in_batch(batch, sent, tokenizer, hparams):
     return new_batch
 
 
+def _is_padded(value, batch_size):
+    """Whether a batch value is PaddedData, or a (data, lengths) pair set by an
+    attack (PaddedBatch.to turns it into a list)"""
+    if isinstance(value, PaddedData):
+        return True
+    return (
+        isinstance(value, (tuple, list))
+        and len(value) == 2
+        and all(isinstance(item, torch.Tensor) for item in value)
+        and value[1].dim() == 1
+        and value[0].size(0) == value[1].size(0) == batch_size
+    )
+
+
+def repeat_batch(batch, repeats):
+    """
+    Tile a padded batch along the batch dimension: example r * N + i of the
+    result is example i of the batch (repeat-major)
+    """
+
+    def repeat(value):
+        if isinstance(value, torch.Tensor):
+            return value.repeat(repeats, *[1] * (value.dim() - 1))
+        return list(value) * repeats
+
+    # the public attributes of a batch are its keys, in order
+    values = {}
+    for key, value in vars(batch).items():
+        if key.startswith("_"):
+            continue
+        if _is_padded(value, len(batch)):
+            value = PaddedData(*[repeat(item) for item in value])
+        else:
+            value = repeat(value)
+        values[key] = value
+    new_batch = PaddedBatch(
+        [dict.fromkeys(values)] * (len(batch) * repeats),
+        padded_keys=[],
+        device_prep_keys=[
+            key
+            for key, value in values.items()
+            if isinstance(value, (torch.Tensor, PaddedData))
+        ],
+        apply_default_convert=False,
+        nonpadded_stack=False,
+    )
+    for key, value in values.items():
+        setattr(new_batch, key, value)
+    return new_batch
+
+
 def transcribe_batch(asr_brain, batch):
     """Outputs transcriptions from an input batch"""
     out = asr_brain.compute_forward(batch, stage=sb.Stage.TEST)
@@ -153,3 +204,67 @@ def linf_clamp(tensor, eps):
     if isinstance(eps, torch.Tensor) and eps.dim() == 1:
         eps = eps.unsqueeze(1)
     return torch.clamp(tensor, min=-eps, max=eps)
+
+
+def attack_autocast(asr_brain):
+    """
+    Autocast context of the forward passes of attack iterations: float16 on
+    CUDA and bfloat16 on CPU if the brain runs with automatic mixed precision
+    (auto_mix_prec), disabled otherwise. Perturbations and their projections
+    stay in float32 outside of it.
+    """
+    device_type = torch.device(asr_brain.device).type
+    enabled = bool(getattr(asr_brain, "auto_mix_prec", False))
+    dtype = torch.float16 if device_type == "cuda" else torch.bfloat16
+    return torch.autocast(device_type=device_type, dtype=dtype, enabled=enabled)
+
+
+class AttackGradScaler:
+    """
+    Dynamic loss scaling of the backward passes of attack iterations under
+    float16 autocast, so that the gradients of the perturbation do not
+    underflow. Gradients are unscaled to float32. When they overflow, the
+    iteration is skipped and the scale is halved; it is doubled after
+    growth_interval iterations without overflow. Scaling is disabled without
+    float16 autocast (bfloat16 has the range of float32).
+
+    Arguments
+    ---------
+    asr_brain: rs.adversarial.brain.ASRBrain
+        the attacked brain.
+    init_scale: float
+        initial loss scale.
+    growth_interval: int
+        number of iterations without overflow before doubling the scale.
+    """
+
+    def __init__(self, asr_brain, init_scale=2.0 ** 16, growth_interval=100):
+        self.enabled = (
+            bool(getattr(asr_brain, "auto_mix_prec", False))
+            and torch.device(asr_brain.device).type == "cuda"
+        )
+        self.scale = init_scale if self.enabled else 1.0
+        self.growth_interval = growth_interval
+        self._good_steps = 0
+
+    def scale_loss(self, loss):
+        """The loss to differentiate"""
+        return loss.float() * self.scale if self.enabled else loss
+
+    def unscale(self, *grads):
+        """
+        Unscaled float32 gradients, or None if any of them is not finite
+        (the iteration should then be skipped).
+        """
+        grads = [grad.float() / self.scale for grad in grads]
+        if not self.enabled:
+            return grads
+        if not all(torch.isfinite(grad).all() for grad in grads):
+            self.scale /= 2
+            self._good_steps = 0
+            return None
+        self._good_steps += 1
+        if self._good_steps >= self.growth_interval:
+            self.scale *= 2
+            self._good_steps = 0
+        return grads
@@ -0,0 +1 @@
+"""Benchmarks of the robust_speech components"""
@@ -0,0 +1,281 @@
+"""
+Throughput benchmark of the AugMax/AugMix augmentations on synthetic audio.
+
+Times every op of augmentations.augmentations, then aug_one, aug_all,
+augmax_combine (forward and backward, as in the attack loop) and
+AugMixModule.forward, sweeping batch size, clip duration, mixture width and
+mixture depth on CPU. The batched pitch shift is also compared with the
+torch_audiomentations one (sequential_pitch_shift). The report is written as JSON. For each configuration
+it gives the median time, the input audio samples processed per second
+(batch_size * duration * sample_rate per call), the peak RSS of the process
+so far and, for aug_all, the share of the op time spent in each op.
+
+Example:
+
+`python -m robust_speech.benchmarks.augmentation\
+     --batch_sizes 1 8 --durations 2 15 --widths 3 --depths 1 2\
+     --output augmentation_benchmark.json`
+"""
+
+import argparse
+import json
+import math
+import resource
+import sys
+import time
+from collections import defaultdict
+
+import numpy as np
+import torch
+
+from robust_speech.adversarial.attacks.augmax import AugMixModule, augmax_combine
+from robust_speech.adversarial.attacks.augmentation_engine import AugmentationEngine
+from robust_speech.adversarial.attacks.augmentations import (
+    augmentations,
+    pitch_shift,
+    sequential_pitch_shift,
+)
+
+
+class TimedAugmentationEngine(AugmentationEngine):
+    """AugmentationEngine accumulating the time spent in each operation"""
+
+    def __init__(self, *args, **kwargs):
+        super(TimedAugmentationEngine, self).__init__(*args, **kwargs)
+        self.op_times = defaultdict(float)
+
+    def apply_op(self, op, samples):
+        start = time.perf_counter()
+        out = super(TimedAugmentationEngine, self).apply_op(op, samples)
+        self.op_times[op.__name__] += time.perf_counter() - start
+        return out
+
+    def apply_stages_(self, samples, stages):
+        if not isinstance(stages, tuple):
+            return super(TimedAugmentationEngine, self).apply_stages_(samples, stages)
+        start = time.perf_counter()
+        out = super(TimedAugmentationEngine, self).apply_stages_(samples, stages)
+        self.op_times["fused_filters"] += time.perf_counter() - start
+        return out
+
+    def _apply_group_(self, samples, key, runs):
+        if runs is None:
+            return super(TimedAugmentationEngine, self)._apply_group_(
+                samples, key, runs
+            )
+        start = time.perf_counter()
+        out = super(TimedAugmentationEngine, self)._apply_group_(samples, key, runs)
+        self.op_times["fused_filters"] += time.perf_counter() - start
+        return out
+
+    def op_share(self):
+        """Fraction of the total op time spent in each operation"""
+        total = sum(self.op_times.values())
+        return {
+            name: seconds / total if total > 0 else 0.0
+            for name, seconds in sorted(self.op_times.items())
+        }
+
+
+def synthetic_speech(batch_size, num_samples, sample_rate=16000, seed=0):
+    """
+    Speech-like batch: harmonic signals with a random, slowly varying pitch
+    and syllable-rate amplitude modulation, plus a little noise.
+    """
+    generator = torch.Generator().manual_seed(seed)
+    t = torch.arange(num_samples, dtype=torch.float64) / sample_rate
+    f0 = 100 + 150 * torch.rand(
+        (batch_size, 1), generator=generator, dtype=torch.float64
+    )
+    vibrato = 1 + 0.05 * torch.sin(2 * math.pi * 3 * t)
+    phase = 2 * math.pi * torch.cumsum(f0 * vibrato, dim=1) / sample_rate
+    harmonics = sum(torch.sin(h * phase) / h for h in range(1, 11))
+    envelope = torch.sin(math.pi * 4 * t).abs()
+    noise = 0.01 * torch.randn((batch_size, num_samples), generator=generator)
+    return (0.1 * envelope * harmonics).float() + noise
+
+
+def peak_rss_mb():
+    """Peak resident set size of the process so far, in MB"""
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on Linux, bytes on macOS
+    return peak / 2 ** 20 if sys.platform == "darwin" else peak / 2 ** 10
+
+
+def measure(fn, repeats, warmup=1):
+    """Run fn warmup + repeats times and return the timings of the repeats"""
+    for _ in range(warmup):
+        fn()
+    timings = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        fn()
+        timings.append(time.perf_counter() - start)
+    return timings
+
+
+def result(timings, num_samples, sample_rate, **config):
+    """Summary of the timings of one configuration"""
+    seconds = float(np.median(timings))
+    return dict(
+        config,
+        seconds=seconds,
+        min_seconds=float(min(timings)),
+        samples_per_sec=num_samples / seconds,
+        realtime_factor=num_samples / sample_rate / seconds,
+        peak_rss_mb=peak_rss_mb(),
+    )
+
+
+def run(args):
+    """Run the sweeps described by the parsed command line arguments"""
+    torch.set_num_threads(args.num_threads)
+    np.random.seed(args.seed)
+    torch.manual_seed(args.seed)
+    sr = args.sample_rate
+    engine_kwargs = dict(
+        aug_severity=args.aug_severity,
+        sample_rate=sr,
+        per_example_chains=args.per_example_chains,
+        fuse_filters=args.fuse_filters,
+    )
+    augmix_kwargs = dict(engine_kwargs)
+    del augmix_kwargs["sample_rate"]
+    report = {
+        "config": dict(
+            vars(args),
+            torch_version=torch.__version__,
+            num_threads=torch.get_num_threads(),
+        ),
+        "ops": [],
+        "pitch_shift": [],
+        "aug_one": [],
+        "aug_all": [],
+        "augmax_combine": [],
+        "augmix": [],
+    }
+
+    for batch_size in args.batch_sizes:
+        for duration in args.durations:
+            num_samples = int(duration * sr)
+            x = synthetic_speech(batch_size, num_samples, sr, args.seed)
+            total = batch_size * num_samples
+            config = dict(batch_size=batch_size, duration=duration)
+
+            engine = TimedAugmentationEngine(**engine_kwargs)
+            for op in augmentations:
+                samples = x.clone()
+                timings = measure(
+                    lambda: engine.apply_op(op, samples.copy_(x)), args.repeats
+                )
+                report["ops"].append(
+                    result(timings, total, sr, op=op.__name__, **config)
+                )
+
+            samples = x.clone()
+            sequential = measure(
+                lambda: engine.apply_op(sequential_pitch_shift, samples.copy_(x)),
+                args.repeats,
+            )
+            batched = measure(
+                lambda: engine.apply_op(pitch_shift, samples.copy_(x)), args.repeats
+            )
+            report["pitch_shift"].append(
+                result(
+                    batched,
+                    total,
+                    sr,
+                    sequential_seconds=float(np.median(sequential)),
+                    speedup=float(np.median(sequential) / np.median(batched)),
+                    **config
+                )
+            )
+
+            for depth in args.depths:
+                engine = TimedAugmentationEngine(mixture_depth=depth, **engine_kwargs)
+                timings = measure(lambda: engine.aug_one(x), args.repeats)
+                report["aug_one"].append(
+                    result(timings, total, sr, depth=depth, **config)
+                )
+
+            for width in args.widths:
+                for depth in args.depths:
+                    engine = TimedAugmentationEngine(
+                        mixture_width=width, mixture_depth=depth, **engine_kwargs
+                    )
+                    timings = measure(lambda: engine.aug_all(x), args.repeats)
+                    report["aug_all"].append(
+                        result(
+                            timings,
+                            total,
+                            sr,
+                            width=width,
+                            depth=depth,
+                            op_share=engine.op_share(),
+                            **config
+                        )
+                    )
+
+                    augmix = AugMixModule(
+                        width, mixture_depth=depth, device="cpu", **augmix_kwargs
+                    )
+                    timings = measure(lambda: augmix(x), args.repeats)
+                    report["augmix"].append(
+                        result(timings, total, sr, width=width, depth=depth, **config)
+                    )
+
+                xs = AugmentationEngine(mixture_width=width, **engine_kwargs).aug_all(x)
+
+                def combine():
+                    m = torch.rand(batch_size, requires_grad=True)
+                    q = torch.rand((batch_size, width), requires_grad=True)
+                    augmax_combine(xs, m, q).sum().backward()
+
+                timings = measure(combine, args.repeats)
+                report["augmax_combine"].append(
+                    result(timings, total, sr, width=width, **config)
+                )
+    return report
+
+
+def parse_arguments(argv):
+    """Command line arguments of the benchmark"""
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--batch_sizes", type=int, nargs="+", default=[1, 8, 16])
+    parser.add_argument(
+        "--durations",
+        type=float,
+        nargs="+",
+        default=[2.0, 12.0],
+        help="clip durations in seconds (LibriSpeech utterances average ~12s)",
+    )
+    parser.add_argument("--widths", type=int, nargs="+", default=[3])
+    parser.add_argument("--depths", type=int, nargs="+", default=[1, 2])
+    parser.add_argument("--aug_severity", type=int, default=3)
+    parser.add_argument("--sample_rate", type=int, default=16000)
+    parser.add_argument("--per_example_chains", action="store_true")
+    parser.add_argument("--fuse_filters", action="store_true")
+    parser.add_argument("--repeats", type=int, default=3)
+    parser.add_argument("--num_threads", type=int, default=torch.get_num_threads())
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument(
+        "--output", type=str, default=None, help="JSON report path (stdout if None)"
+    )
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    """Run the benchmark and write the JSON report"""
+    args = parse_arguments(sys.argv[1:] if argv is None else argv)
+    report = run(args)
+    if args.output is None:
+        json.dump(report, sys.stdout, indent=2)
+        sys.stdout.write("\n")
+    else:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+    return report
+
+
+if __name__ == "__main__":
+    main()
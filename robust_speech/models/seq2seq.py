@@ -44,6 +44,18 @@ class S2SASR(AdvASRBrain):
                 wavs = self.hparams.augmentation(wavs, wav_lens)
         # Forward pass
         feats = self.hparams.compute_features(wavs)
+        return self.compute_forward_features(feats, wav_lens, tokens_bos, stage)
+
+    def compute_forward_from_stft(self, stft, batch, stage):
+        """Forward computations from the STFT of the waveform batches (see compute_stft)."""
+        self.modules.normalize.to(self.device)
+        wav_lens = batch.sig[1]
+        tokens_bos, _ = batch.tokens_bos
+        feats = self.compute_features_from_stft(stft)
+        return self.compute_forward_features(feats, wav_lens, tokens_bos, stage)
+
+    def compute_forward_features(self, feats, wav_lens, tokens_bos, stage):
+        """Forward computations from the features to the output probabilities."""
         if stage == sb.Stage.TRAIN:
             feats = self.modules.normalize(feats, wav_lens)
         else:
@@ -165,10 +177,18 @@ class S2SAugMaxASR(AugMaxASRBrain):
             checkpointer=checkpointer,
             attacker=attacker,
         )
-        self.augmix_model = AugMixModule(mixture_width=3, device=self.device)
+        self.augmix_model = AugMixModule(
+            mixture_width=3,
+            mixture_depth=getattr(self.hparams, "mixture_depth", -1),
+            aug_severity=getattr(self.hparams, "aug_severity", 3),
+            device=self.device,
+            per_example_chains=getattr(self.hparams, "per_example_chains", False),
+            fuse_filters=getattr(self.hparams, "fuse_filters", False),
+            augmentation_store=getattr(self.hparams, "augmentation_store", None),
+        )
 
 
-    def compute_forward(self, batch, stage, augmix=False):
+    def compute_forward(self, batch, stage, augmix=False, xs=None):
         """Forward computations from the waveform batches to the output probabilities."""
         self.modules.normalize.to(self.device)
         wavs, wav_lens = batch.sig
@@ -176,7 +196,7 @@ class S2SAugMaxASR(AugMaxASRBrain):
             batch = batch.to(self.device)
             wavs, wav_lens = wavs.to(self.device), wav_lens.to(self.device)
         if augmix:
-            wavs = self.augmix_model(wavs)
+            wavs = self.augmix_model(wavs, ids=batch.id, lengths=wav_lens, xs=xs)
         tokens_bos, _ = batch.tokens_bos
         # wavs, wav_lens = wavs.to(self.device), wav_lens.to(self.device)
         # Add augmentation if specified
@@ -191,6 +211,18 @@ class S2SAugMaxASR(AugMaxASRBrain):
         #         wavs = self.hparams.augmentation(wavs, wav_lens)
         # Forward pass
         feats = self.hparams.compute_features(wavs)
+        return self.compute_forward_features(feats, wav_lens, tokens_bos, stage)
+
+    def compute_forward_from_stft(self, stft, batch, stage):
+        """Forward computations from the STFT of the waveform batches (see compute_stft)."""
+        self.modules.normalize.to(self.device)
+        wav_lens = batch.sig[1]
+        tokens_bos, _ = batch.tokens_bos
+        feats = self.compute_features_from_stft(stft)
+        return self.compute_forward_features(feats, wav_lens, tokens_bos, stage)
+
+    def compute_forward_features(self, feats, wav_lens, tokens_bos, stage):
+        """Forward computations from the features to the output probabilities."""
         if stage == sb.Stage.TRAIN:
             feats = self.modules.normalize(feats, wav_lens)
         else:
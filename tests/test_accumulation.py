@@ -0,0 +1,80 @@
+"""Tests of the gradient accumulation of the adversarial brains"""
+
+import types
+
+import speechbrain as sb
+import torch
+from speechbrain.dataio.batch import PaddedBatch
+
+from robust_speech.adversarial.brain import AdvASRBrain
+
+
+class RegressionBrain:
+    """Minimal brain running the fit_batch of AdvASRBrain on a linear
+    regression"""
+
+    device = "cpu"
+    auto_mix_prec = False
+    max_grad_norm = 0.0
+    nonfinite_count = 0
+    fit_batch = AdvASRBrain.fit_batch
+    accumulate_gradients = AdvASRBrain.accumulate_gradients
+    step_accumulated = AdvASRBrain.step_accumulated
+    reset_accumulation = AdvASRBrain.reset_accumulation
+    accumulation_steps = AdvASRBrain.accumulation_steps
+    check_gradients = sb.Brain.check_gradients
+
+    def __init__(self, gradient_accumulation):
+        torch.manual_seed(1)
+        self.modules = torch.nn.ModuleDict({"lin": torch.nn.Linear(3, 1)})
+        self.hparams = types.SimpleNamespace(
+            gradient_accumulation=gradient_accumulation
+        )
+        self.optimizer = torch.optim.SGD(self.modules.parameters(), lr=0.1)
+        self.steps = 0
+        step = self.optimizer.step
+
+        def count_steps(*args, **kwargs):
+            self.steps += 1
+            return step(*args, **kwargs)
+
+        self.optimizer.step = count_steps
+
+    def compute_forward(self, batch, stage):
+        return self.modules.lin(batch.x.data).squeeze(-1)
+
+    def compute_objectives(self, predictions, batch, stage, adv=False):
+        return ((predictions - batch.y.data.squeeze(-1)) ** 2).mean()
+
+
+def fit(brain, xs, ys, batch_size):
+    for start in range(0, len(xs), batch_size):
+        brain.fit_batch(
+            PaddedBatch(
+                [
+                    {"x": xs[i], "y": ys[i]}
+                    for i in range(start, min(start + batch_size, len(xs)))
+                ]
+            )
+        )
+    brain.step_accumulated()
+    return brain.modules.lin.weight.detach()
+
+
+def test_accumulation_matches_large_batches():
+    torch.manual_seed(0)
+    xs, ys = torch.randn(12, 3), torch.randn(12, 1)
+    accumulated = RegressionBrain(gradient_accumulation=3)
+    large_batches = RegressionBrain(gradient_accumulation=1)
+    assert torch.allclose(
+        fit(accumulated, xs, ys, 2), fit(large_batches, xs, ys, 6), atol=1e-6
+    )
+    assert accumulated.steps == large_batches.steps == 2
+
+
+def test_accumulation_flushes_partial_steps():
+    torch.manual_seed(0)
+    xs, ys = torch.randn(12, 3), torch.randn(12, 1)
+    brain = RegressionBrain(gradient_accumulation=4)
+    fit(brain, xs, ys, 2)
+    assert brain.steps == 2  # 4 micro-batches, then a flush of 2
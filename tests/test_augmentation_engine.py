@@ -0,0 +1,88 @@
+"""Tests of the batched augmentation engine"""
+
+import pytest
+import torch
+
+from robust_speech.adversarial.attacks.augmentation_engine import (
+    AugmentationEngine,
+    _samples,
+)
+from robust_speech.adversarial.attacks.augmentations import (
+    AugmentationRegistry,
+    augmentations,
+)
+
+DEVICES = ["cpu"] + (["cuda"] if torch.cuda.is_available() else [])
+
+
+def speech(batch_size=4, length=8000, device="cpu"):
+    torch.manual_seed(0)
+    time = torch.arange(length) / 16000.0
+    return (
+        0.3 * torch.sin(2 * 3.14159 * 220 * time)
+        + 0.05 * torch.randn(batch_size, length)
+    ).to(device)
+
+
+@pytest.mark.parametrize("op", augmentations, ids=lambda op: op.__name__)
+def test_apply_op_matches_transform(op):
+    engine = AugmentationEngine(transforms=AugmentationRegistry())
+    transform = engine.transforms.get(op, engine.aug_severity, engine.sample_rate)
+    x = speech()
+    torch.manual_seed(1)
+    if hasattr(transform, "bernoulli_distribution"):
+        # the forward of torch_audiomentations first draws which examples to
+        # augment (all of them with p=1), apply_op skips this draw
+        transform.bernoulli_distribution.sample((x.size(0),))
+    out = engine.apply_op(op, x.clone())
+    torch.manual_seed(1)
+    expected = _samples(transform(x.clone().unsqueeze(1), sample_rate=16000))
+    assert torch.allclose(out, expected.squeeze(1), atol=1e-6)
+
+
+@pytest.mark.parametrize("op", augmentations, ids=lambda op: op.__name__)
+def test_apply_op_in_place(op):
+    engine = AugmentationEngine(transforms=AugmentationRegistry())
+    samples = speech()
+    data_ptr = samples.data_ptr()
+    assert engine.apply_op(op, samples).data_ptr() == data_ptr
+
+
+@pytest.mark.parametrize("device", DEVICES)
+@pytest.mark.parametrize("per_example_chains", [False, True])
+def test_aug_all_buffer(device, per_example_chains):
+    engine = AugmentationEngine(
+        mixture_width=3,
+        transforms=AugmentationRegistry(),
+        per_example_chains=per_example_chains,
+    )
+    x = speech(device=device)
+    lengths = torch.tensor([1.0, 0.9, 0.6, 0.5], device=device)
+    xs = engine.aug_all(x, lengths=lengths)
+    assert xs.shape == (4,) + tuple(x.shape)
+    assert xs.device == x.device and xs.dtype == x.dtype
+    assert torch.equal(xs[0], x)
+    assert xs.is_contiguous()
+    # the padding of every branch is zeroed
+    assert not xs[1:, 2, 4800:].any() and not xs[1:, 3, 4000:].any()
+
+
+def test_aug_one_writes_into_buffer():
+    engine = AugmentationEngine(transforms=AugmentationRegistry())
+    x = speech()
+    buffer = torch.empty((2,) + tuple(x.shape))
+    out = engine.aug_one(x, out=buffer[1])
+    assert out.data_ptr() == buffer[1].data_ptr()
+    assert torch.equal(buffer[1], out)
+
+
+def test_prefetched_branches():
+    engine = AugmentationEngine(mixture_width=2, transforms=AugmentationRegistry())
+    x = speech()
+    xs = engine.aug_all(x)
+    engine.prefetch(xs, ["a", "b", "c", "d"])
+    assert engine.aug_all(x, ids=["a", "b", "c", "d"]) is xs
+    # branches of another width are recomputed
+    engine.prefetch(xs, ["a", "b", "c", "d"])
+    engine.mixture_width = 3
+    assert engine.aug_all(x, ids=["a", "b", "c", "d"]).size(0) == 4
@@ -0,0 +1,85 @@
+"""Tests of the fused frequency-domain filter chains"""
+
+import julius
+import torch
+
+import robust_speech.adversarial.attacks.augmentations as augmentations
+import robust_speech.adversarial.attacks.fft_filters as fft_filters
+
+
+def test_next_fast_len():
+    for n in (1, 7, 100, 1000, 16001):
+        fast = fft_filters.next_fast_len(n)
+        assert fast >= n
+        for prime in (2, 3, 5):
+            while fast % prime == 0:
+                fast //= prime
+        assert fast == 1
+
+
+def sequential_filter(signal, op, low, high):
+    if op is augmentations.low_pass_filter:
+        return julius.lowpass_filter(signal, low)
+    if op is augmentations.high_pass_filter:
+        return signal - julius.lowpass_filter(signal, low)
+    if op is augmentations.band_pass_filter:
+        return julius.bandpass_filter(signal, low, high)
+    return signal - julius.bandpass_filter(signal, low, high)
+
+
+def test_filter_chains_match_sequential_filters(monkeypatch):
+    torch.manual_seed(0)
+    length = 16000
+    time = torch.arange(length) / 16000.0
+    chains = [
+        [augmentations.band_pass_filter, augmentations.low_pass_filter],
+        [augmentations.high_pass_filter],
+        [
+            augmentations.band_stop_filter,
+            augmentations.high_pass_filter,
+            augmentations.low_pass_filter,
+        ],
+        [augmentations.low_pass_filter],
+    ]
+    samples = 0.3 * torch.sin(2 * 3.14159 * 220 * time) + 0.1 * torch.randn(
+        len(chains), length
+    )
+    # record the cutoffs sampled for each (step, op) group of examples
+    sampled = []
+    sample_cutoffs = fft_filters.sample_cutoffs
+
+    def record(transform, op, n, sample_rate, device):
+        cutoffs = sample_cutoffs(transform, op, n, sample_rate, device)
+        sampled.append((op, cutoffs))
+        return cutoffs
+
+    monkeypatch.setattr(fft_filters, "sample_cutoffs", record)
+    fused = fft_filters.apply_filter_chains_(
+        samples.clone(), chains, augmentations.registry, 3
+    )
+
+    # groups are sampled step by step, ops in order of first appearance
+    cutoffs = {}
+    groups = iter(sampled)
+    for step in range(max(len(chain) for chain in chains)):
+        per_op = {}
+        for i, chain in enumerate(chains):
+            if step < len(chain):
+                per_op.setdefault(chain[step], []).append(i)
+        for op, idx in per_op.items():
+            sampled_op, (low, high) = next(groups)
+            assert sampled_op is op
+            for k, i in enumerate(idx):
+                cutoffs[i, step] = (
+                    low[k].item(),
+                    None if high is None else high[k].item(),
+                )
+
+    for i, chain in enumerate(chains):
+        expected = samples[i]
+        for step, op in enumerate(chain):
+            expected = sequential_filter(expected, op, *cutoffs[i, step])
+        # julius pads every filter, the fused chain pads its input once
+        edge = sum(int(4 / cutoffs[i, step][0]) for step in range(len(chain)))
+        error = (fused[i] - expected)[edge : length - edge].abs().max()
+        assert error <= 1e-5 * expected.abs().max()
@@ -0,0 +1,42 @@
+"""Tests of the fused Jensen-Shannon consistency loss"""
+
+import torch
+import torch.nn.functional as F
+
+from robust_speech.adversarial.losses import jsd_consistency
+
+
+def reference_jsd(log_probs, eps=1e-7):
+    probs = [torch.exp(log_p) for log_p in log_probs]
+    log_mixture = torch.clamp(sum(probs) / len(probs), eps, 1).log()
+    return sum(
+        F.kl_div(log_mixture, p, reduction="batchmean") for p in probs
+    ) / len(probs)
+
+
+def test_jsd_consistency_matches_reference():
+    torch.manual_seed(0)
+    for scale in (1.0, 30.0):  # 30: peaked distributions, clamped mixture
+        logits = [
+            (scale * torch.randn(3, 7, 11, dtype=torch.double)).requires_grad_()
+            for _ in range(3)
+        ]
+        log_probs = [x.log_softmax(-1) for x in logits]
+        expected = reference_jsd(log_probs)
+        loss = jsd_consistency(log_probs, chunk_size=3)
+        assert torch.allclose(loss, expected)
+        expected_grads = torch.autograd.grad(expected, logits, retain_graph=True)
+        grads = torch.autograd.grad(loss, logits)
+        for grad, expected_grad in zip(grads, expected_grads):
+            assert torch.allclose(grad, expected_grad, atol=1e-10)
+
+
+def test_jsd_consistency_gradcheck():
+    torch.manual_seed(0)
+    log_probs = [
+        torch.randn(2, 5, 6, dtype=torch.double).log_softmax(-1).requires_grad_()
+        for _ in range(3)
+    ]
+    assert torch.autograd.gradcheck(
+        lambda *l: jsd_consistency(list(l), chunk_size=2), log_probs
+    )
@@ -0,0 +1,49 @@
+"""Tests of the reduced-precision storage of the AugMax branches"""
+
+import pytest
+import torch
+
+from robust_speech.adversarial.attacks.augmax import augmax_combine
+from robust_speech.adversarial.attacks.packed_branches import (
+    PackedBranches,
+    packed_mix,
+)
+
+
+@pytest.mark.parametrize(
+    "dtype,tol", [("float16", 1e-3), ("bfloat16", 1e-2), ("int16", 1e-3)]
+)
+def test_packed_mix_matches_float32(dtype, tol):
+    torch.manual_seed(0)
+    width, n, length = 3, 3, 5000
+    xs = torch.randn(width + 1, n, length) * 0.1
+    lengths = torch.tensor([1.0, 0.8, 0.5])
+    m = torch.rand(n, requires_grad=True)
+    q = torch.rand(n, width, requires_grad=True)
+    expected = augmax_combine(xs, m, q, lengths=lengths)
+    weights = torch.randn_like(expected)
+    expected_grads = torch.autograd.grad((expected * weights).sum(), [m, q])
+    packed = PackedBranches.pack(xs, dtype)
+    assert packed.nbytes() < xs[1:].numel() * 4
+    out = augmax_combine(packed, m, q, lengths=lengths)
+    grads = torch.autograd.grad((out * weights).sum(), [m, q])
+    assert (out - expected).abs().max() <= tol * xs.abs().max()
+    for grad, expected_grad in zip(grads, expected_grads):
+        assert (grad - expected_grad).abs().max() <= tol * expected_grad.abs().max()
+
+
+def test_packed_mix_gradcheck():
+    # packed branches are mixed in float32: finite differences in float32
+    # are exact enough since the mix is linear in m and w
+    torch.manual_seed(0)
+    width, n = 3, 2
+    packed = PackedBranches.pack(torch.randn(width + 1, n, 50), "float16")
+    m = torch.rand(n, requires_grad=True)
+    w = torch.rand(n, width, requires_grad=True)
+    assert torch.autograd.gradcheck(
+        lambda m, w: packed_mix(packed, m, w, chunk_size=16),
+        (m, w),
+        eps=1e-2,
+        atol=1e-3,
+        rtol=1e-3,
+    )
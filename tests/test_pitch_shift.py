@@ -0,0 +1,39 @@
+"""Tests of the batched pitch shift"""
+
+import pytest
+import torch
+from torch_pitch_shift import pitch_shift
+
+from robust_speech.adversarial.attacks.pitch_shift import BatchedPitchShift
+
+
+def test_matches_torch_pitch_shift():
+    torch.manual_seed(0)
+    transform = BatchedPitchShift(sample_rate=16000)
+    samples = 0.1 * torch.randn(3, 1, 16000)
+    for shift in transform.shifts:
+        transform.transform_parameters["transpositions"] = [shift] * 3
+        out = transform.apply_transform(samples.clone(), 16000)
+        expected = pitch_shift(samples, shift, 16000)
+        assert (out - expected).abs().max() <= 1e-5 * expected.abs().max()
+
+
+def test_groups_examples_by_shift():
+    torch.manual_seed(0)
+    transform = BatchedPitchShift(sample_rate=16000)
+    samples = 0.1 * torch.randn(4, 1, 8000)
+    shifts = [transform.shifts[0], transform.shifts[-1]] * 2
+    transform.transform_parameters["transpositions"] = shifts
+    out = transform.apply_transform(samples.clone(), 16000)
+    for i, shift in enumerate(shifts):
+        transform.transform_parameters["transpositions"] = [shift]
+        single = transform.apply_transform(samples[i : i + 1].clone(), 16000)
+        assert torch.allclose(out[i], single[0], atol=1e-6)
+
+
+@pytest.mark.parametrize("step", [0.5, 1.0, 3.0])
+def test_semitone_grid_within_range(step):
+    transform = BatchedPitchShift(-4.0, 4.0, semitone_step=step)
+    low, high = 2 ** (-4 / 12), 2 ** (4 / 12)
+    assert all(low <= shift <= high for shift in transform.shifts)
+    assert all(shift.denominator <= 64 for shift in transform.shifts)
@@ -0,0 +1,27 @@
+"""Tests of the buffer of replayed PGD perturbations"""
+
+import torch
+
+from robust_speech.adversarial.attacks.replay_buffer import ReplayBuffer
+
+
+def test_replay_buffer_max_bytes():
+    buffer = ReplayBuffer(max_size=10, max_bytes=4 * 5000)
+    for i in range(5):
+        buffer.put(str(i), torch.zeros(3000))
+    assert len(buffer) == 1
+    assert buffer.nbytes == 4 * 3000
+    assert "4" in buffer
+
+
+def test_replay_buffer_folder(tmp_path):
+    buffer = ReplayBuffer(max_size=1, folder=str(tmp_path), dtype="float16")
+    delta = torch.randn(100)
+    buffer.put("a", delta)
+    assert len(list(tmp_path.iterdir())) == 1
+    assert torch.allclose(buffer.get("a"), delta, atol=1e-2)
+    buffer.put("b", delta)
+    assert [path.name for path in tmp_path.iterdir()] == ["b.pt"]
+    buffer.put("b", 2 * delta)  # replacing an entry keeps its new file
+    assert torch.allclose(buffer.get("b"), 2 * delta, atol=1e-2)
+    assert buffer.nbytes == 2 * 100
@@ -0,0 +1,66 @@
+"""Tests of the attack strength scheduler"""
+
+import types
+
+from robust_speech.adversarial.scheduler import AttackScheduler
+
+
+def pgd_attacker(nb_iter=10, eps=0.01):
+    return types.SimpleNamespace(nb_iter=nb_iter, eps=eps, iterations=[])
+
+
+def augmax_attacker(nb_iter=10, eps=0.1, mixture_width=4, restarts=1):
+    return types.SimpleNamespace(
+        nb_iter=nb_iter,
+        eps=eps,
+        mixture_width=mixture_width,
+        restarts=restarts,
+        engine=types.SimpleNamespace(mixture_width=mixture_width),
+        iterations=[],
+    )
+
+
+def test_pgd_bound_is_scaled():
+    attacker = pgd_attacker()
+    scheduler = AttackScheduler([attacker], schedule="linear", start=0.5)
+    scheduler.on_epoch_start(1, 10)
+    assert attacker.nb_iter == 5 and attacker.eps == 0.005
+    scheduler.restore()
+    assert attacker.nb_iter == 10 and attacker.eps == 0.01
+
+
+def test_augmax_step_size_is_not_scaled():
+    attacker = augmax_attacker()
+    scheduler = AttackScheduler([attacker], schedule="linear", start=0.5)
+    scheduler.on_epoch_start(1, 10)
+    assert attacker.nb_iter == 5 and attacker.eps == 0.1
+    assert attacker.mixture_width == attacker.engine.mixture_width == 2
+
+
+def test_budget_charges_recorded_iterations():
+    attacker = augmax_attacker(restarts=2)
+    scheduler = AttackScheduler(
+        [attacker], schedule="constant", forward_budget=100
+    )
+    attacker.iterations.append(7)  # validation attack, not charged
+    scheduler.on_epoch_start(1, 4)
+    scheduler.on_step()
+    assert attacker.nb_iter == 10  # 100 forwards / 4 steps / 2 restarts
+    attacker.iterations.append(3)  # early stopped
+    scheduler.on_step()
+    assert scheduler.forwards == 6
+    attacker.iterations.append(10)
+    attacker.iterations = []  # log_iterations starts a new list
+    scheduler.on_epoch_end()
+    assert scheduler.forwards == 26
+
+
+def test_budget_caps_iterations():
+    attacker = pgd_attacker()
+    scheduler = AttackScheduler([attacker], schedule="constant", forward_budget=20)
+    scheduler.on_epoch_start(1, 4)
+    for _ in range(4):
+        scheduler.on_step()
+        attacker.iterations.append(attacker.nb_iter)
+    scheduler.on_epoch_end()
+    assert scheduler.forwards <= 20
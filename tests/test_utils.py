@@ -0,0 +1,33 @@
+"""Tests of the adversarial training utilities"""
+
+import torch
+from speechbrain.dataio.batch import PaddedBatch
+
+from robust_speech.adversarial.utils import repeat_batch
+
+
+def test_repeat_batch():
+    torch.manual_seed(0)
+    examples = [
+        {
+            "id": str(i),
+            "sig": torch.randn(800 + 200 * i),
+            "tokens": torch.arange(3 + i),
+            "wrd": "a b",
+        }
+        for i in range(3)
+    ]
+    batch = PaddedBatch(examples)
+    repeated = repeat_batch(batch, 4)
+    assert len(repeated) == 12
+    assert repeated.batchsize == 12
+    assert repeated.id == batch.id * 4
+    assert repeated.wrd == batch.wrd * 4
+    for name in ("sig", "tokens"):
+        data, lengths = getattr(batch, name)
+        repeated_data, repeated_lengths = getattr(repeated, name)
+        assert torch.equal(repeated_data, data.repeat(4, 1))
+        assert torch.equal(repeated_lengths, lengths.repeat(4))
+    # repeated batches can be moved like the original ones
+    moved = repeated.to("cpu")
+    assert torch.equal(moved.sig[0], repeated.sig[0])
@@ -0,0 +1,25 @@
+"""Tests of the per-utterance LRU cache"""
+
+from robust_speech.adversarial.attacks.utterance_cache import UtteranceCache
+
+
+def test_lru_eviction():
+    cache = UtteranceCache(max_size=2)
+    cache._store("a", 1)
+    cache._store("b", 2)
+    assert cache._lookup("a") == 1  # a is now recent
+    cache._store("c", 3)
+    assert "b" not in cache
+    assert "a" in cache and "c" in cache
+    assert cache._lookup("b") is None
+    assert cache.stats() == {"size": 2, "hits": 1, "misses": 1, "hit_rate": 0.5}
+
+
+def test_store_replaces_and_refreshes():
+    cache = UtteranceCache(max_size=2)
+    cache._store("a", 1)
+    cache._store("b", 2)
+    cache._store("a", 3)  # a is now recent
+    cache._store("c", 4)
+    assert "b" not in cache
+    assert cache._lookup("a") == 3
@@ -0,0 +1,15 @@
+"""Tests of the warm-start cache of the AugMax attack"""
+
+import torch
+
+from robust_speech.adversarial.attacks.warm_start import WarmStartCache
+
+
+def test_warm_start_cache_detaches():
+    cache = WarmStartCache()
+    m = torch.tensor(0.5, requires_grad=True)
+    q = torch.zeros(3, requires_grad=True)
+    cache.put("a", m * 2, q + 1, chains=[["chain"]])
+    entry = cache.get("a")
+    assert not entry.m.requires_grad and not entry.q.requires_grad
+    assert entry.chains == [["chain"]]